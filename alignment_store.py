@@ -0,0 +1,686 @@
+import os
+import json
+import argparse
+import shutil
+import numpy as np
+import pandas as pd
+
+try:
+    # Optional multithreaded CSV reader
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa_csv = None
+
+# Columns of Diamond tabular output (--outfmt 6)
+DIAMOND_COLUMNS = {
+    "query_id": str,
+    "subject_id": str,
+    "perc_identity": np.float32,
+    "align_length": np.int32,
+    "mismatches": np.int32,
+    "gap_opens": np.int32,
+    "q_start": np.int32,
+    "q_end": np.int32,
+    "s_start": np.int32,
+    "s_end": np.int32,
+    "e_value": np.float64,
+    "bit_score": np.float32,
+}
+
+# Columns of the store, with their on-disk types
+COLUMNS = {
+    "query": np.int32,
+    "subject": np.int32,
+    "perc_identity": np.float32,
+    "bit_score": np.float32,
+}
+
+
+class AlignmentHits(object):
+    """
+    Pairwise alignment hits sorted by query and decreasing bit score (ties keep their alignment file order).
+
+    Proteins are dictionary-encoded: 'query' and 'subject' are codes into 'proteins'. 'offsets' is a CSR-like
+    per-query index, so that the hits of the query with code c are the contiguous rows offsets[c]:offsets[c + 1]
+    of every column.
+
+    Columns are typed arrays, memory-mapped when loaded from a store, and are only read when accessed.
+    Selections keep row indices into the full columns, and gather a column on first access.
+    """
+
+    def __init__(
+        self, proteins, columns, rows=None, offsets=None, path=None, metadata=None
+    ):
+        self.proteins = np.asarray(proteins, dtype=object)
+        self.columns = columns  # Full columns, possibly memory-mapped
+        self.rows = rows  # Sorted row indices of the selection, None for all rows
+        self.path = path  # Store directory the columns are mapped from
+        self.metadata = metadata or {}  # Metadata of the store
+        self._offsets = offsets
+        self._selected = {}
+
+    def __len__(self):
+        return len(self.columns["query"]) if self.rows is None else len(self.rows)
+
+    def column(self, name):
+        """Values of a column for the selected rows, read on first access."""
+        if name not in self._selected:
+            values = self.columns[name]
+            self._selected[name] = values if self.rows is None else values[self.rows]
+        return self._selected[name]
+
+    @property
+    def query(self):
+        return self.column("query")
+
+    @property
+    def subject(self):
+        return self.column("subject")
+
+    @property
+    def perc_identity(self):
+        return self.column("perc_identity")
+
+    @property
+    def bit_score(self):
+        return self.column("bit_score")
+
+    @property
+    def offsets(self):
+        """Per-query row offsets, from the query codes of the sorted hits."""
+        if self._offsets is None:
+            self._offsets = np.concatenate(
+                [
+                    [0],
+                    np.cumsum(np.bincount(self.query, minlength=len(self.proteins))),
+                ]
+            ).astype(np.int64)
+        return self._offsets
+
+    def query_hits(self, protein_code):
+        """Row slice holding the hits of a query."""
+        return slice(self.offsets[protein_code], self.offsets[protein_code + 1])
+
+    @classmethod
+    def from_frame(cls, pairwise_alignment):
+        """
+        Build sorted hits from a DataFrame with columns 'query_id', 'subject_id', 'perc_identity' and 'bit_score'.
+        Self-alignments are removed.
+        """
+        n = len(pairwise_alignment)
+        codes, proteins = pd.factorize(
+            np.concatenate(
+                [
+                    pairwise_alignment["query_id"].to_numpy(dtype=object),
+                    pairwise_alignment["subject_id"].to_numpy(dtype=object),
+                ]
+            )
+        )
+        query, subject = codes[:n], codes[n:]
+        perc_identity = pairwise_alignment["perc_identity"].to_numpy()
+        bit_score = pairwise_alignment["bit_score"].to_numpy()
+
+        # Drop hits with missing IDs, and self-alignments to avoid self-annotation transfer
+        keep = (query >= 0) & (subject >= 0) & (query != subject)
+        query, subject = query[keep], subject[keep]
+        perc_identity, bit_score = perc_identity[keep], bit_score[keep]
+
+        # Stable sort: ties keep their alignment file order
+        order = np.lexsort((-bit_score, query))
+        columns = {
+            "query": query[order],
+            "subject": subject[order],
+            "perc_identity": perc_identity[order],
+            "bit_score": bit_score[order],
+        }
+        return cls(
+            proteins,
+            {name: columns[name].astype(dtype) for name, dtype in COLUMNS.items()},
+        )
+
+    def select(self, mask):
+        """Keep the hits selected by a boolean mask over rows. The sort order is preserved."""
+        rows = np.flatnonzero(mask) if self.rows is None else self.rows[mask]
+        return AlignmentHits(
+            self.proteins,
+            self.columns,
+            rows=rows,
+            path=self.path,
+            metadata=self.metadata,
+        )
+
+    def protein_mask(self, protein_ids):
+        """Boolean mask over protein codes of the proteins in protein_ids."""
+        return (
+            pd.Index(pd.unique(np.asarray(protein_ids, dtype=object))).get_indexer(
+                self.proteins
+            )
+            >= 0
+        )
+
+    def restrict(self, queries=None, subjects=None, exclude_subjects=None):
+        """
+        Keep hits whose query is in queries and whose subject is in subjects and not in exclude_subjects.
+        Membership is resolved once per protein of the vocabulary, then applied to the hits by code.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if queries is not None:
+            mask &= self.protein_mask(queries)[self.query]
+        if subjects is not None:
+            mask &= self.protein_mask(subjects)[self.subject]
+        if exclude_subjects is not None:
+            mask &= ~self.protein_mask(exclude_subjects)[self.subject]
+        return self.select(mask)
+
+    def rename(self, id_mapping):
+        """
+        Map protein IDs with id_mapping. Hits on unmapped proteins, and hits becoming self-alignments, are dropped.
+        """
+        mapped = pd.Series(self.proteins).map(id_mapping)
+        canonical, _ = pd.factorize(mapped)  # -1 for unmapped proteins
+        query, subject = canonical[self.query], canonical[self.subject]
+        hits = AlignmentHits(
+            mapped.to_numpy(dtype=object),
+            self.columns,
+            rows=self.rows,
+            offsets=self._offsets,
+            path=self.path,
+            metadata=self.metadata,
+        )
+        return hits.select((query >= 0) & (subject >= 0) & (query != subject))
+
+    def save(self, path, **metadata):
+        """
+        Save the selected hits as a columnar store: a directory with one .npy file per column, the protein IDs,
+        the per-query offsets and a metadata.json file. The store is written aside and moved in place when complete.
+        """
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name, dtype in COLUMNS.items():
+            np.save(
+                os.path.join(tmp_path, f"{name}.npy"), self.column(name).astype(dtype)
+            )
+        np.save(os.path.join(tmp_path, "offsets.npy"), self.offsets)
+        np.save(os.path.join(tmp_path, "proteins.npy"), self.proteins.astype(str))
+        with open(os.path.join(tmp_path, "metadata.json"), "w") as f:
+            json.dump({"n_hits": len(self), **metadata}, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Open a store saved with save, memory-mapping its columns. Returns the hits and their metadata.
+        """
+        with open(os.path.join(path, "metadata.json")) as f:
+            metadata = json.load(f)
+        hits = cls(
+            np.load(os.path.join(path, "proteins.npy")).astype(object),
+            map_columns(path),
+            offsets=np.load(os.path.join(path, "offsets.npy")),
+            path=path,
+            metadata=metadata,
+        )
+        return hits, metadata
+
+    def __getstate__(self):
+        # Hits backed by a store are sent to worker processes as the store path and their row selection:
+        # workers map the same files, and share their pages through the OS page cache
+        state = dict(self.__dict__)
+        if self.path is not None:
+            state["columns"] = None
+            state["_selected"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.columns is None:
+            self.columns = map_columns(self.path)
+
+
+def map_columns(path):
+    """Memory-map the columns of a store, read-only."""
+    return {
+        name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        for name in COLUMNS
+    }
+
+
+def iter_alignment_chunks(alignment_file, columns, chunk_size=1_000_000):
+    """
+    Read a Diamond tabular alignment file by chunks of about chunk_size rows, parsing only the given columns.
+    Uses the multithreaded pyarrow CSV reader when it is installed, and pandas otherwise.
+    """
+    if os.path.getsize(alignment_file) == 0:
+        return  # No hits
+    if pa_csv is not None:
+        reader = pa_csv.open_csv(
+            alignment_file,
+            read_options=pa_csv.ReadOptions(
+                column_names=list(DIAMOND_COLUMNS), block_size=chunk_size * 64
+            ),
+            parse_options=pa_csv.ParseOptions(delimiter="\t"),
+            convert_options=pa_csv.ConvertOptions(
+                include_columns=columns,
+                column_types={
+                    name: (
+                        pa.string()
+                        if DIAMOND_COLUMNS[name] is str
+                        else pa.from_numpy_dtype(DIAMOND_COLUMNS[name])
+                    )
+                    for name in columns
+                },
+            ),
+        )
+        for batch in reader:
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(
+            alignment_file,
+            sep="\t",
+            header=None,
+            names=list(DIAMOND_COLUMNS),
+            usecols=columns,
+            dtype={name: DIAMOND_COLUMNS[name] for name in columns},
+            chunksize=chunk_size,
+        )
+
+
+def filter_alignment(
+    pairwise_alignment,
+    max_evalue=None,
+    min_identity=None,
+    min_coverage=None,
+    sequence_lengths=None,
+):
+    """
+    Filter Diamond hits. Hits with missing IDs and self-alignments are always removed. Optionally, hits with
+    an e-value above max_evalue, a percent identity below min_identity, or covering less than min_coverage %
+    of either the query or the subject sequence are removed.
+    Coverage requires sequence_lengths, a Series of sequence lengths indexed by protein ID.
+    """
+    query_id, subject_id = (
+        pairwise_alignment["query_id"],
+        pairwise_alignment["subject_id"],
+    )
+    keep = query_id.notna() & subject_id.notna() & (query_id != subject_id)
+    if max_evalue is not None:
+        keep &= pairwise_alignment["e_value"] <= max_evalue
+    if min_identity is not None:
+        keep &= pairwise_alignment["perc_identity"] >= min_identity
+    if min_coverage is not None:
+        # Proteins of unknown length fail the filter
+        for ids, start, end in [
+            (query_id, "q_start", "q_end"),
+            (subject_id, "s_start", "s_end"),
+        ]:
+            span = (pairwise_alignment[end] - pairwise_alignment[start]).abs() + 1
+            keep &= span / ids.map(sequence_lengths) * 100 >= min_coverage
+    return pairwise_alignment[keep]
+
+
+def filter_columns(max_evalue=None, min_identity=None, min_coverage=None):
+    """Diamond columns to parse to apply the given filters."""
+    columns = ["query_id", "subject_id", "perc_identity", "bit_score"]
+    if max_evalue is not None:
+        columns.append("e_value")
+    if min_coverage is not None:
+        columns += ["q_start", "q_end", "s_start", "s_end"]
+    return columns
+
+
+class AlignmentStoreWriter(object):
+    """
+    Build an alignment store from chunks of hits, holding only one chunk in memory.
+
+    Diamond writes the hits of each query together: chunks are appended in file order, only sorting the hits of
+    each query by decreasing bit score, and the hits of the last query of a chunk are held back until the next one.
+    On close, protein codes are renumbered so that queries come first, in file order, which makes the hits sorted
+    by query code. If queries turn out not to be grouped, hits are sorted on close instead, one bucket of
+    consecutive queries of about one chunk at a time (see sort_by_query).
+
+    With max_hits_per_query, only the top hits of each query by bit score are kept. As the hits of a query are
+    complete within a block, they are truncated there; queries spread over several blocks are truncated again
+    after the final sort. The number of hits of each query before truncation is saved in the store (hit_counts.npy).
+    """
+
+    def __init__(self, path, max_hits_per_query=None):
+        self.path = path
+        self.max_hits_per_query = max_hits_per_query
+        self.tmp_path = path + ".tmp"
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        self.files = {
+            name: open(os.path.join(self.tmp_path, f"{name}.bin"), "wb")
+            for name in COLUMNS
+        }
+        self.vocabulary = {}  # Protein ID -> code, in order of appearance
+        self.query_order = []  # Query codes, in order of appearance
+        self.query_counts = []  # Number of hits kept for each query, in the same order
+        # Number of hits of each query before truncation, in the same order
+        self.query_totals = []
+        self.seen_queries = set()
+        self.grouped = True
+        self.n_rows = 0
+        self.pending = None
+
+    def encode(self, protein_ids):
+        """Dictionary-encode protein IDs, adding new proteins to the vocabulary."""
+        local_codes, uniques = pd.factorize(protein_ids)
+        codes = np.empty(len(uniques), dtype=np.int64)
+        for i, protein in enumerate(uniques):
+            codes[i] = self.vocabulary.setdefault(protein, len(self.vocabulary))
+        return codes[local_codes]
+
+    def append(self, pairwise_alignment):
+        """
+        Append a chunk of filtered hits, with columns 'query_id', 'subject_id', 'perc_identity' and 'bit_score'.
+        """
+        if self.pending is not None:
+            pairwise_alignment = pd.concat([self.pending, pairwise_alignment])
+        if pairwise_alignment.empty:
+            return
+        # The last query of the chunk may go on in the next chunk
+        query_id = pairwise_alignment["query_id"].to_numpy()
+        other = np.flatnonzero(query_id != query_id[-1])
+        tail = other[-1] + 1 if len(other) else 0
+        self.pending = pairwise_alignment.iloc[tail:]
+        self.write_block(pairwise_alignment.iloc[:tail])
+
+    def write_block(self, block):
+        """Write hits of complete queries, sorted by query and decreasing bit score."""
+        if block.empty:
+            return
+        query = self.encode(block["query_id"].to_numpy(dtype=object))
+        subject = self.encode(block["subject_id"].to_numpy(dtype=object))
+        bit_score = block["bit_score"].to_numpy(dtype=np.float32)
+        perc_identity = block["perc_identity"].to_numpy(dtype=np.float32)
+
+        local_codes, block_queries = pd.factorize(query)
+        if self.seen_queries.intersection(block_queries):
+            self.grouped = False
+        self.seen_queries.update(block_queries)
+        counts = np.bincount(local_codes)
+        self.query_order.extend(block_queries)
+        self.query_totals.extend(counts)
+
+        # Stable sort: ties keep their alignment file order
+        order = np.lexsort((-bit_score, local_codes))
+        if self.max_hits_per_query is not None:
+            starts = np.cumsum(counts) - counts
+            rank = np.arange(len(order)) - starts[local_codes[order]]
+            order = order[rank < self.max_hits_per_query]
+            counts = np.minimum(counts, self.max_hits_per_query)
+        self.query_counts.extend(counts)
+        columns = {
+            "query": query,
+            "subject": subject,
+            "perc_identity": perc_identity,
+            "bit_score": bit_score,
+        }
+        for name, dtype in COLUMNS.items():
+            columns[name][order].astype(dtype).tofile(self.files[name])
+        self.n_rows += len(order)
+
+    def read_column(self, name, start=0, count=-1):
+        """Read rows of a column written so far."""
+        with open(os.path.join(self.tmp_path, f"{name}.bin"), "rb") as f:
+            dtype = np.dtype(COLUMNS[name])
+            f.seek(start * dtype.itemsize)
+            return np.fromfile(f, dtype=dtype, count=count)
+
+    def sort_by_query(self, renumber, counts, outputs, chunk_size):
+        """
+        Sort the written hits by query and decreasing bit score into outputs (arrays of each column), given the
+        number of written hits of each query (counts), in bounded memory: hits are first distributed into buckets
+        of consecutive queries holding about chunk_size hits, then each bucket is sorted on its own. Only a query
+        with more than chunk_size hits makes a bucket exceed chunk_size hits.
+        """
+        record = np.dtype(list(COLUMNS.items()))
+        bucket_of = (np.cumsum(counts) - counts) // chunk_size
+
+        def bucket_file(bucket):
+            return os.path.join(self.tmp_path, f"bucket_{bucket}.bin")
+
+        for start in range(0, self.n_rows, chunk_size):
+            rows = None
+            for name in COLUMNS:
+                values = self.read_column(name, start, chunk_size)
+                if rows is None:
+                    rows = np.empty(len(values), dtype=record)
+                rows[name] = (
+                    renumber[values] if name in ("query", "subject") else values
+                )
+            buckets = bucket_of[rows["query"]]
+            # Stable: hits of a bucket keep the order in which they were written
+            order = np.argsort(buckets, kind="stable")
+            rows, buckets = rows[order], buckets[order]
+            for part in np.split(rows, np.flatnonzero(np.diff(buckets)) + 1):
+                with open(bucket_file(bucket_of[part["query"][0]]), "ab") as f:
+                    part.tofile(f)
+
+        position = 0
+        for bucket in np.unique(bucket_of[counts > 0]):
+            rows = np.fromfile(bucket_file(bucket), dtype=record)
+            os.remove(bucket_file(bucket))
+            rows = rows[np.lexsort((-rows["bit_score"], rows["query"]))]
+            if self.max_hits_per_query is not None:
+                query = rows["query"]
+                rank = np.arange(len(rows)) - np.searchsorted(query, query, side="left")
+                rows = rows[rank < self.max_hits_per_query]
+            for name, output in outputs.items():
+                output[position : position + len(rows)] = rows[name]
+            position += len(rows)
+
+    def close(self, chunk_size=1_000_000, **metadata):
+        """
+        Finish the store and move it in place. metadata is saved along with the store.
+        """
+        if self.pending is not None:
+            self.write_block(self.pending)
+            self.pending = None
+        for f in self.files.values():
+            f.close()
+
+        # Renumber proteins: queries first, in order of appearance
+        n_proteins = len(self.vocabulary)
+        query_appearances = np.asarray(self.query_order, dtype=np.int64)
+        query_order = pd.unique(query_appearances)
+        renumber = np.full(n_proteins, -1, dtype=np.int64)
+        renumber[query_order] = np.arange(len(query_order))
+        others = renumber < 0
+        renumber[others] = np.arange(len(query_order), n_proteins)
+        proteins = np.empty(n_proteins, dtype=object)
+        proteins[renumber] = np.asarray(list(self.vocabulary), dtype=object)
+        hit_counts = np.bincount(
+            renumber[query_appearances],
+            weights=np.asarray(self.query_totals, dtype=np.float64),
+            minlength=n_proteins,
+        ).astype(np.int64)
+
+        # Number of hits of each query, after truncation within blocks then after merging its blocks
+        counts = np.bincount(
+            renumber[query_appearances],
+            weights=np.asarray(self.query_counts, dtype=np.float64),
+            minlength=n_proteins,
+        ).astype(np.int64)
+        block_counts = counts
+        if self.max_hits_per_query is not None:
+            counts = np.minimum(counts, self.max_hits_per_query)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        n_rows = int(offsets[-1])
+
+        outputs = {
+            name: np.lib.format.open_memmap(
+                os.path.join(self.tmp_path, f"{name}.npy"),
+                mode="w+",
+                dtype=dtype,
+                shape=(n_rows,),
+            )
+            for name, dtype in COLUMNS.items()
+        }
+        if self.grouped:
+            for name, output in outputs.items():
+                for start in range(0, self.n_rows, chunk_size):
+                    values = self.read_column(name, start, chunk_size)
+                    if name in ("query", "subject"):
+                        values = renumber[values]
+                    output[start : start + len(values)] = values
+        else:
+            # Hits of a query are spread over several chunks
+            self.sort_by_query(renumber, block_counts, outputs, chunk_size)
+        for name, output in outputs.items():
+            output.flush()
+            os.remove(os.path.join(self.tmp_path, f"{name}.bin"))
+        del outputs
+
+        np.save(os.path.join(self.tmp_path, "offsets.npy"), offsets)
+        np.save(os.path.join(self.tmp_path, "proteins.npy"), proteins.astype(str))
+        np.save(os.path.join(self.tmp_path, "hit_counts.npy"), hit_counts)
+        if self.max_hits_per_query is not None:
+            n_queries = len(query_order)
+            truncated = hit_counts[:n_queries] > self.max_hits_per_query
+            metadata["truncation"] = {
+                "max_hits_per_query": self.max_hits_per_query,
+                "n_queries": n_queries,
+                "n_truncated_queries": int(truncated.sum()),
+                "n_hits_before": int(hit_counts.sum()),
+                "n_hits_after": n_rows,
+            }
+        with open(os.path.join(self.tmp_path, "metadata.json"), "w") as f:
+            json.dump({"n_hits": n_rows, **metadata}, f)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmp_path, self.path)
+
+
+def ingest_alignment(
+    alignment_file,
+    path,
+    chunk_size=1_000_000,
+    sequence_lengths=None,
+    max_hits_per_query=None,
+    input_files=None,
+    **filters,
+):
+    """
+    Build the alignment store of a Diamond tabular alignment file, reading and filtering it by chunks of
+    chunk_size rows (see filter_alignment for filters), and keeping up to max_hits_per_query hits per query.
+    input_files optionally gives files to read instead of alignment_file, e.g. the shards it was merged from.
+    Memory use does not depend on the alignment file size, including when the hits of a query are not
+    contiguous in the file (as long as no single query has more than chunk_size hits).
+    The filters are saved in the store metadata, along with the alignment file size and modification time.
+    Returns the memory-mapped AlignmentHits.
+    """
+    writer = AlignmentStoreWriter(path, max_hits_per_query=max_hits_per_query)
+    for input_file in input_files or [alignment_file]:
+        for chunk in iter_alignment_chunks(
+            input_file, filter_columns(**filters), chunk_size=chunk_size
+        ):
+            writer.append(
+                filter_alignment(chunk, sequence_lengths=sequence_lengths, **filters)
+            )
+    writer.close(
+        chunk_size=chunk_size,
+        filters=store_filters(max_hits_per_query=max_hits_per_query, **filters),
+        **source_signature(alignment_file),
+    )
+    return AlignmentHits.load(path)[0]
+
+
+def store_filters(
+    max_evalue=None, min_identity=None, min_coverage=None, max_hits_per_query=None
+):
+    """Filters of an alignment store, as saved in its metadata."""
+    return {
+        "max_evalue": max_evalue,
+        "min_identity": min_identity,
+        "min_coverage": min_coverage,
+        "max_hits_per_query": max_hits_per_query,
+    }
+
+
+def truncation_report(path):
+    """
+    Queries of an alignment store truncated to their top hits: a DataFrame with the number of hits of each
+    truncated query before ('n_hits') and after ('n_kept') truncation, and the number of dropped hits,
+    sorted by decreasing number of dropped hits.
+    """
+    with open(os.path.join(path, "metadata.json")) as f:
+        max_hits_per_query = json.load(f)["filters"].get("max_hits_per_query")
+    hit_counts = np.load(os.path.join(path, "hit_counts.npy"))
+    truncated = (
+        np.flatnonzero(hit_counts > max_hits_per_query)
+        if max_hits_per_query is not None
+        else np.array([], dtype=np.int64)
+    )
+    report = pd.DataFrame(
+        {
+            "query_id": np.load(os.path.join(path, "proteins.npy"))[truncated],
+            "n_hits": hit_counts[truncated],
+            "n_kept": np.minimum(hit_counts[truncated], max_hits_per_query or 0),
+        }
+    )
+    report["n_dropped"] = report["n_hits"] - report["n_kept"]
+    return report.sort_values("n_dropped", ascending=False, kind="stable").reset_index(
+        drop=True
+    )
+
+
+def source_signature(path):
+    """Size and modification time of a file, used to invalidate caches built from it."""
+    stat = os.stat(path)
+    return {"source_size": stat.st_size, "source_mtime": stat.st_mtime}
+
+
+def store_path(alignment_file):
+    return alignment_file + ".store"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build the alignment store of a Diamond alignment file, and report on truncated queries."
+    )
+    parser.add_argument(
+        "--alignment_file", required=True, help="Diamond alignment file (--outfmt 6)."
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=1_000_000,
+        help="Number of alignment rows read at a time.",
+    )
+    parser.add_argument(
+        "--max_hits_per_query",
+        type=int,
+        default=None,
+        help="Keep only the top hits of each query by bit score.",
+    )
+    parser.add_argument(
+        "--max_evalue", type=float, default=None, help="Maximum e-value."
+    )
+    parser.add_argument(
+        "--min_identity", type=float, default=None, help="Minimum percent identity."
+    )
+    args = parser.parse_args()
+
+    store = store_path(args.alignment_file)
+    hits = ingest_alignment(
+        args.alignment_file,
+        store,
+        chunk_size=args.chunk_size,
+        max_hits_per_query=args.max_hits_per_query,
+        max_evalue=args.max_evalue,
+        min_identity=args.min_identity,
+    )
+    print(f"Saved {len(hits)} hits to {store}")
+    if args.max_hits_per_query is not None:
+        print(hits.metadata["truncation"])
+        report = truncation_report(store)
+        print(report["n_dropped"].describe().to_string())
+        print(report.head(20).to_string(index=False))
+
+# Example usage:
+# python alignment_store.py --alignment_file ./data/swissprot/2024_01/diamond_swissprot_2024_01_alignment.tsv \
+# --max_hits_per_query 100
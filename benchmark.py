@@ -0,0 +1,493 @@
+import os
+import json
+import time
+import pickle
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+import numpy as np
+import pandas as pd
+import obonet
+import beprof_eval
+import evaluation
+import ia
+import methods
+from dataloading import load_data, load_pairwise_alignment
+from instrumentation import StageTimer
+
+ROOTS = {
+    "BPO": ("GO:0008150", "biological_process", "all_bp"),
+    "CCO": ("GO:0005575", "cellular_component", "all_cc"),
+    "MFO": ("GO:0003674", "molecular_function", "all_mf"),
+}
+AMINO_ACIDS = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+
+
+def generate_ontology(obo_file, n_terms, rng):
+    """
+    Write a GO-like DAG in OBO format: n_terms terms per aspect under the aspect root, each with one or two
+    'is_a' parents among the previous terms of its aspect.
+    Returns a dict mapping each aspect to its terms (root first), and a dict mapping each term to its ancestors
+    (including itself).
+    """
+    lines = ["format-version: 1.2", "ontology: go", ""]
+    aspect_terms, ancestors = {}, {}
+    next_id = 10000
+    for aspect, (root, namespace, _) in ROOTS.items():
+        terms = [root]
+        ancestors[root] = {root}
+        lines += [
+            "[Term]",
+            f"id: {root}",
+            f"name: {namespace}",
+            f"namespace: {namespace}",
+            "",
+        ]
+        for i in range(1, n_terms + 1):
+            term = f"GO:{next_id:07d}"
+            next_id += 1
+            # Parents are drawn among recent terms, for a deep DAG
+            candidates = terms[max(0, i - 50) :]
+            parents = set(
+                rng.choice(
+                    candidates, min(len(candidates), rng.integers(1, 3)), replace=False
+                )
+            )
+            lines += [
+                "[Term]",
+                f"id: {term}",
+                f"name: term {term}",
+                f"namespace: {namespace}",
+            ]
+            lines += [
+                f"is_a: {parent} ! term {parent}" for parent in sorted(parents)
+            ] + [""]
+            ancestors[term] = {term}.union(*[ancestors[parent] for parent in parents])
+            terms.append(term)
+        aspect_terms[aspect] = terms
+    with open(obo_file, "w") as f:
+        f.write("\n".join(lines))
+    return aspect_terms, ancestors
+
+
+def generate_alignment(
+    alignment_file, proteins, families, lengths, hits_per_query, rng
+):
+    """
+    Write a Diamond-format alignment TSV (12 columns, no header) of every protein against the others.
+    Most hits of a query are on proteins of its family, with higher identities and bit scores.
+    """
+    n = len(proteins)
+    queries = np.repeat(np.arange(n), hits_per_query)
+    same_family = rng.random(len(queries)) < 0.7
+    family_members = pd.Series(np.arange(n)).groupby(families).apply(np.asarray)
+    subjects = rng.integers(0, n, len(queries))
+    for family, members in family_members.items():
+        rows = np.flatnonzero(same_family & (families[queries] == family))
+        subjects[rows] = rng.choice(members, len(rows))
+    keep = subjects != queries
+    queries, subjects, same_family = queries[keep], subjects[keep], same_family[keep]
+
+    perc_identity = np.where(
+        same_family,
+        rng.uniform(40, 100, len(queries)),
+        rng.uniform(20, 50, len(queries)),
+    )
+    align_length = np.minimum(lengths[queries], lengths[subjects])
+    bit_score = perc_identity * align_length / 50 * rng.uniform(0.8, 1.2, len(queries))
+    alignment = pd.DataFrame(
+        {
+            "query_id": proteins[queries],
+            "subject_id": proteins[subjects],
+            "perc_identity": perc_identity.round(1),
+            "align_length": align_length,
+            "mismatches": (align_length * (1 - perc_identity / 100)).astype(int),
+            "gap_opens": rng.integers(0, 5, len(queries)),
+            "q_start": 1,
+            "q_end": align_length,
+            "s_start": 1,
+            "s_end": align_length,
+            "e_value": 10 ** -(bit_score / 10),
+            "bit_score": bit_score.round(1),
+        }
+    )
+    # Diamond output is grouped by query, by decreasing bit score
+    alignment = alignment.sort_values(
+        ["query_id", "bit_score"], ascending=[True, False]
+    )
+    alignment.to_csv(alignment_file, sep="\t", header=False, index=False)
+    return len(alignment)
+
+
+def generate_data(
+    data_dir,
+    dataset,
+    db_version="2024_01",
+    n_proteins=5000,
+    n_test=500,
+    n_terms=1000,
+    n_families=200,
+    terms_per_protein=3,
+    hits_per_query=50,
+    seed=0,
+):
+    """
+    Generate a synthetic data directory with the layout read by the pipeline: a GO OBO file, SwissProt annotations
+    (all aspects, per aspect, and experimental only), Diamond alignments of all proteins, and a dataset of
+    n_test test proteins with its background annotations.
+    Proteins of a family share most of their annotations. Returns the number of rows of each generated file.
+    """
+    rng = np.random.default_rng(seed)
+    swissprot_dir = os.path.join(data_dir, "swissprot", db_version)
+    dataset_dir = os.path.join(data_dir, dataset)
+    os.makedirs(swissprot_dir, exist_ok=True)
+    os.makedirs(dataset_dir, exist_ok=True)
+
+    aspect_terms, ancestors = generate_ontology(
+        os.path.join(data_dir, "go.obo"), n_terms, rng
+    )
+
+    proteins = np.array([f"P{i:06d}" for i in range(n_proteins)], dtype=object)
+    families = rng.integers(0, n_families, n_proteins)
+    lengths = rng.integers(50, 800, n_proteins)
+    annotations = {}
+    for aspect, terms in aspect_terms.items():
+        family_terms = rng.choice(terms[1:], (n_families, terms_per_protein))
+        own_terms = rng.choice(terms[1:], (n_proteins, terms_per_protein))
+        # Each term of a protein is its family's with a probability of 0.8
+        inherited = rng.random((n_proteins, terms_per_protein)) < 0.8
+        leaves = np.where(inherited, family_terms[families], own_terms)
+        annotations[aspect] = [
+            "; ".join(sorted(set().union(*[ancestors[term] for term in row])))
+            for row in leaves
+        ]
+
+    sequences = ["".join(rng.choice(AMINO_ACIDS, length)) for length in lengths]
+    pd.DataFrame(
+        {
+            "EntryID": proteins,
+            "Entry Name": [f"{protein}_SYNTH" for protein in proteins],
+            "term": ["; ".join(terms) for terms in zip(*annotations.values())],
+            "Sequence": sequences,
+        }
+    ).to_csv(
+        os.path.join(swissprot_dir, f"swissprot_{db_version}_annotations.tsv"),
+        sep="\t",
+        index=False,
+    )
+
+    test = rng.choice(n_proteins, n_test, replace=False)
+    train = np.setdiff1d(np.arange(n_proteins), test)
+    for aspect in ROOTS:
+        frame = pd.DataFrame({"EntryID": proteins, "term": annotations[aspect]})
+        for suffix in ["", "_exp"]:
+            frame.to_csv(
+                os.path.join(
+                    swissprot_dir,
+                    f"swissprot_{db_version}_{aspect}{suffix}_annotations.tsv",
+                ),
+                sep="\t",
+                index=False,
+            )
+        frame.iloc[train].to_csv(
+            os.path.join(dataset_dir, f"{dataset}_{aspect}_train_annotations.tsv"),
+            sep="\t",
+            index=False,
+        )
+        frame.iloc[test].to_csv(
+            os.path.join(dataset_dir, f"{dataset}_{aspect}_test_annotations.tsv"),
+            sep="\t",
+            index=False,
+        )
+
+    background = {
+        proteins[i]: {
+            ROOTS[aspect][2]: set(annotations[aspect][i].split("; "))
+            for aspect in ROOTS
+        }
+        for i in train
+    }
+    with open(os.path.join(dataset_dir, f"background_{dataset}.pkl"), "wb") as f:
+        pickle.dump(background, f)
+
+    n_hits = generate_alignment(
+        os.path.join(swissprot_dir, f"diamond_swissprot_{db_version}_alignment.tsv"),
+        proteins,
+        families,
+        lengths,
+        hits_per_query,
+        rng,
+    )
+    return {
+        "proteins": n_proteins,
+        "test_proteins": n_test,
+        "terms": sum(len(terms) for terms in aspect_terms.values()),
+        "hits": n_hits,
+    }
+
+
+def run_benchmark(dataset, aspect, db_version, k_values):
+    """
+    Run every stage of the pipeline on the data directory ./data, timing each stage separately.
+    Returns the records of each stage (see StageTimer).
+    """
+    logger = logging.getLogger("benchmark")
+    bench = StageTimer()
+    alignment_file = (
+        f"./data/swissprot/{db_version}/diamond_swissprot_{db_version}_alignment.tsv"
+    )
+
+    with bench.stage("load_pairwise_alignment_ingest") as record:
+        pairwise_alignment = load_pairwise_alignment(
+            dataset, alignment_file=alignment_file
+        )
+        record["rows"] = len(pairwise_alignment)
+    with bench.stage("load_pairwise_alignment") as record:
+        pairwise_alignment = load_pairwise_alignment(
+            dataset, alignment_file=alignment_file
+        )
+        record["rows"] = len(pairwise_alignment)
+    with bench.stage("load_data") as record:
+        train, test = load_data(logger, dataset, aspect, db_version)
+        record["rows"] = len(train)
+    with bench.stage("restrict_alignment") as record:
+        pairwise_alignment = pairwise_alignment.restrict(
+            queries=test["EntryID"].unique(), subjects=train["EntryID"].unique()
+        )
+        record["rows"] = len(pairwise_alignment)
+    with bench.stage("transfer_annotations") as record:
+        _, predictions = methods.transfer_annotations(
+            logger, pairwise_alignment, train, test, k_values, timer=bench
+        )
+        record["rows"] = sum(len(p) for p in predictions.values())
+    with bench.stage("naive_baseline") as record:
+        naive = methods.naive_baseline(train, test)
+        record["rows"] = len(naive)
+
+    subontology = aspect[:2].lower()
+    alignment_score = predictions["AlignmentScore"]
+    with bench.stage("beprof_conversion") as record:
+        beprof_predictions = alignment_score.to_beprof(subontology)
+        record["rows"] = len(alignment_score)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pred_file = os.path.join(tmp_dir, "predictions.tsv")
+        with bench.stage("write_predictions_tsv") as record:
+            alignment_score.to_tsv(pred_file)
+            record["rows"] = len(alignment_score)
+        with bench.stage("beprof_conversion_tsv") as record:
+            evaluation.convert_predictions(pred_file, aspect)
+            record["rows"] = len(alignment_score)
+
+    with bench.stage("ground_truth_conversion"):
+        gt_pkl, background_pkl, go_obo_file = evaluation.evaluation_files(
+            logger, dataset, aspect
+        )
+    with bench.stage("load_ontology"):
+        go = beprof_eval.load_ontology(
+            go_obo_file, beprof_eval.read_pkl(background_pkl)
+        )
+    ground_truth = beprof_eval.read_pkl(gt_pkl)
+
+    # fmax is timed on its own within the evaluation
+    fmax = beprof_eval.fmax
+
+    def timed_fmax(*args):
+        with bench.stage("fmax"):
+            return fmax(*args)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        beprof_eval.fmax = timed_fmax
+        try:
+            with bench.stage("evaluate_predictions") as record:
+                with contextlib.redirect_stdout(open(os.devnull, "w")):
+                    beprof_eval.evaluate_predictions(
+                        beprof_predictions, tmp_dir, go, ground_truth, subontology
+                    )
+                record["rows"] = len(beprof_predictions)
+        finally:
+            beprof_eval.fmax = fmax
+
+    # ia.py: propagation of the training annotations and Information Accretion of the aspect's terms
+    with bench.stage("ia_load_ontology"):
+        ontology = ia.clean_ontology_edges(
+            obonet.read_obo(go_obo_file, ignore_obsolete=False)
+        )
+        subontologies = {aspect: ia.fetch_aspect(ontology, ROOTS[aspect][0])}
+    annotation_df = train[["EntryID", "term"]].dropna().assign(aspect=aspect)
+    with bench.stage("ia_propagation") as record:
+        with contextlib.redirect_stderr(open(os.devnull, "w")):
+            annotation_df = ia.propagate_terms(annotation_df, subontologies)
+        record["rows"] = len(annotation_df)
+    with bench.stage("ia_term_counts"):
+        aspect_terms = sorted(subontologies[aspect].nodes)
+        term_index = {term: i for i, term in enumerate(aspect_terms)}
+        counts = ia.term_counts(annotation_df, term_index).tocsc()
+    with bench.stage("ia") as record:
+        for term in aspect_terms:
+            ia.calc_ia(term, counts, subontologies[aspect], term_index)
+        record["rows"] = len(aspect_terms)
+    return {
+        record["stage"]: {key: value for key, value in record.items() if key != "stage"}
+        for record in bench.records
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_reports(report, baseline):
+    """
+    Compare the stage timings of a report with a baseline report. Returns a DataFrame with the wall times
+    of each stage and their ratio (report / baseline).
+    """
+    stages = list(report["stages"]) + [
+        s for s in baseline["stages"] if s not in report["stages"]
+    ]
+    comparison = pd.DataFrame(
+        {
+            "baseline": [
+                baseline["stages"].get(s, {}).get("wall_time") for s in stages
+            ],
+            "current": [report["stages"].get(s, {}).get("wall_time") for s in stages],
+        },
+        index=stages,
+        dtype=float,
+    )
+    comparison["ratio"] = comparison["current"] / comparison["baseline"]
+    return comparison
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark every stage of the pipeline on synthetic data of configurable scale."
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="JSON report. Defaults to benchmark_<commit>.json.",
+    )
+    parser.add_argument(
+        "--work_dir",
+        default=None,
+        help="Directory of the synthetic data (reused if it already exists). Defaults to a temporary directory.",
+    )
+    parser.add_argument(
+        "--n_proteins", type=int, default=5000, help="Number of SwissProt proteins."
+    )
+    parser.add_argument(
+        "--n_test", type=int, default=500, help="Number of test proteins."
+    )
+    parser.add_argument(
+        "--n_terms", type=int, default=1000, help="Number of GO terms per aspect."
+    )
+    parser.add_argument(
+        "--n_families", type=int, default=200, help="Number of protein families."
+    )
+    parser.add_argument(
+        "--terms_per_protein",
+        type=int,
+        default=3,
+        help="Number of leaf terms per protein and aspect.",
+    )
+    parser.add_argument(
+        "--hits_per_query",
+        type=int,
+        default=50,
+        help="Number of Diamond hits per protein.",
+    )
+    parser.add_argument(
+        "--aspect", default="BPO", help="Ontology aspect (BPO, CCO, MFO)."
+    )
+    parser.add_argument(
+        "--k_values",
+        type=int,
+        nargs="+",
+        default=[1, 3, 5, 10, 15, 20],
+        help="k values of BlastKNN.",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the data generator."
+    )
+    parser.add_argument(
+        "--compare", default=None, help="Baseline report to compare the timings with."
+    )
+    args = parser.parse_args()
+
+    scale = {
+        "n_proteins": args.n_proteins,
+        "n_test": args.n_test,
+        "n_terms": args.n_terms,
+        "n_families": args.n_families,
+        "terms_per_protein": args.terms_per_protein,
+        "hits_per_query": args.hits_per_query,
+        "seed": args.seed,
+    }
+    commit = git_commit()
+    output = os.path.abspath(args.output or f"benchmark_{commit}.json")
+    baseline_file = os.path.abspath(args.compare) if args.compare else None
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="pfp_benchmark_")
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(work_dir)  # The pipeline reads ./data
+
+    dataset, db_version = "SYNTH", "2024_01"
+    scale_file = os.path.join("data", "scale.json")
+    if os.path.exists(scale_file) and json.load(open(scale_file)) == scale:
+        print(f"Reusing synthetic data of {work_dir}")
+        sizes = json.load(open(os.path.join("data", "sizes.json")))
+    else:
+        print(f"Generating synthetic data in {work_dir}")
+        sizes = generate_data("data", dataset, db_version=db_version, **scale)
+        json.dump(scale, open(scale_file, "w"))
+        json.dump(sizes, open(os.path.join("data", "sizes.json"), "w"))
+    # Stores and converted files of previous runs would skip their stages
+    for stale in [
+        f"data/swissprot/{db_version}/diamond_swissprot_{db_version}_alignment.tsv.store",
+        f"data/{dataset}/{dataset}_{args.aspect}_test_annotations.pkl",
+    ]:
+        if os.path.isdir(stale):
+            shutil.rmtree(stale)
+        elif os.path.exists(stale):
+            os.remove(stale)
+
+    logging.basicConfig(level=logging.ERROR)
+    stages = run_benchmark(dataset, args.aspect, db_version, args.k_values)
+    columns = ["wall_time", "cpu_time", "peak_rss_mb", "rows"]
+    print(pd.DataFrame(stages).T[columns].astype(float).to_string(float_format="%.3f"))
+    report = {
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "aspect": args.aspect,
+        "k_values": args.k_values,
+        "scale": scale,
+        "sizes": sizes,
+        "stages": stages,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved benchmark report to {output}")
+
+    if baseline_file:
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        if baseline.get("scale") != scale:
+            print("Warning: the baseline report was run at a different scale.")
+        print(compare_reports(report, baseline).to_string(float_format="%.3f"))
+
+# Example usage:
+# python benchmark.py --n_proteins 20000 --n_test 2000 --output benchmark_new.json --compare benchmark_old.json
@@ -19,6 +19,9 @@ def parse_args():
     parser.add_argument("--background")
     parser.add_argument("--go")
     parser.add_argument("--metrics")
+    parser.add_argument("--bootstrap", type=int, default=0)
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--exact", action="store_true")
 
     args = parser.parse_args()
     return args
@@ -30,8 +33,19 @@ __all__ = [
     "ROOT_GO_TERMS",
     "compute_performance",
     "compute_performance_deepgoplus",
+    "load_ontology",
+    "evaluate_predictions",
+    "evaluate_shared_predictions",
     "read_pkl",
     "save_pkl",
+    "threshold_counts",
+    "threshold_statistics",
+    "statistics_metrics",
+    "count_metrics",
+    "bootstrap_intervals",
+    "StreamingEvaluator",
+    "exact_curves",
+    "StackedEvaluator",
 ]
 ROOT_GO_TERMS = {"GO:0003674", "GO:0008150", "GO:0005575"}
 
@@ -162,6 +176,333 @@ def fmax(go, targets, scores, idx_goid):
     )
 
 
+THRESHOLDS = np.array([c / 100 for c in range(101)])  # Thresholds of fmax
+
+
+def dense_block(matrix, start, stop, fill):
+    """
+    Rows [start, stop) of a dense array, or of a CSR matrix (see score_vectors) where terms without stored
+    entry get the value fill.
+    """
+    if not ssp.issparse(matrix):
+        return np.asarray(matrix[start:stop])
+    block = matrix[start:stop].tocoo()
+    dense = np.full(block.shape, fill)
+    dense[block.row, block.col] = block.data
+    return dense
+
+
+def threshold_counts(targets, scores, goic, godp, block_size=1000):
+    """
+    Per-protein counts at every threshold of fmax: number, IC sum and IC depth sum of the predicted terms
+    ('predicted', 'predicted_ic', 'predicted_dp') and of the correctly predicted ones ('correct', ...),
+    as protein x threshold arrays, along with the number, IC sum and IC depth sum of the true terms of each protein
+    ('true', 'true_ic', 'true_dp'). goic and godp are the IC and IC depth of the terms (columns).
+    Every metric of fmax can be computed from these counts (see count_metrics).
+    Targets and scores can also be CSR matrices (see score_vectors), densified block_size proteins at a time.
+    """
+    n_proteins, n_thresholds = targets.shape[0], len(THRESHOLDS)
+    counts = {
+        f"{kind}{suffix}": np.zeros((n_proteins, n_thresholds))
+        for kind in ["predicted", "correct"]
+        for suffix in ["", "_ic", "_dp"]
+    }
+    counts["true"] = np.zeros(n_proteins)
+    counts["true_ic"] = np.zeros(n_proteins)
+    counts["true_dp"] = np.zeros(n_proteins)
+
+    for start in range(0, n_proteins, block_size):
+        block_targets = dense_block(targets, start, start + block_size, 0.0)
+        # Number of thresholds passed by each score (score >= threshold)
+        levels = np.searchsorted(
+            THRESHOLDS,
+            dense_block(scores, start, start + block_size, -1.0),
+            side="right",
+        )
+        rows, cols = np.nonzero(levels)
+        levels = levels[rows, cols]
+        correct = block_targets[rows, cols] > 0
+        bins = rows * (n_thresholds + 1) + levels
+        for suffix, weights in [("", None), ("_ic", goic[cols]), ("_dp", godp[cols])]:
+            for kind, mask in [("predicted", slice(None)), ("correct", correct)]:
+                histogram = np.bincount(
+                    bins[mask],
+                    weights=None if weights is None else weights[mask],
+                    minlength=len(block_targets) * (n_thresholds + 1),
+                ).reshape(len(block_targets), n_thresholds + 1)
+                # Terms passing threshold k are the ones passing more than k thresholds
+                counts[kind + suffix][start : start + block_size] = np.cumsum(
+                    histogram[:, ::-1], axis=1
+                )[:, ::-1][:, 1:]
+        counts["true"][start : start + block_size] = block_targets.sum(axis=1)
+        counts["true_ic"][start : start + block_size] = block_targets @ goic
+        counts["true_dp"][start : start + block_size] = block_targets @ godp
+    return counts
+
+
+def threshold_statistics(counts, weights):
+    """
+    Sufficient statistics of fmax over sets of proteins, given as a replicate x protein array of protein weights:
+    for each kind of precision and recall ('', 'ic' and 'dp'), the weighted sum of the defined per-protein ratios
+    ('<kind>precision_sum', ...) and the weight of the proteins defining them ('<kind>precision_n', ...,
+    e.g. the covered proteins for precisions), along with the weighted sums of the misinformation ('mi')
+    and remaining uncertainty ('ru') and the total weight ('n'). Statistics are replicate x threshold arrays,
+    and add up over disjoint sets of proteins.
+    """
+    weights = np.atleast_2d(weights).astype(np.float64)
+    statistics = {}
+    for kind, suffix in [("", ""), ("ic", "_ic"), ("dp", "_dp")]:
+        for ratio, denominators in [
+            ("precision", counts["predicted" + suffix]),
+            ("recall", counts["true" + suffix]),
+        ]:
+            numerators = counts["correct" + suffix]
+            denominators = np.broadcast_to(
+                denominators.reshape(len(numerators), -1), numerators.shape
+            )
+            defined = denominators > 0
+            ratios = np.divide(
+                numerators, denominators, out=np.zeros(numerators.shape), where=defined
+            )
+            statistics[f"{kind}{ratio}_sum"] = weights @ ratios
+            statistics[f"{kind}{ratio}_n"] = weights @ defined
+    statistics["mi"] = weights @ (counts["predicted_ic"] - counts["correct_ic"])
+    statistics["ru"] = weights @ (counts["true_ic"][:, None] - counts["correct_ic"])
+    statistics["n"] = weights.sum(axis=1, keepdims=True)
+    return statistics
+
+
+def statistics_metrics(statistics, curves=False):
+    """
+    Compute the metrics of fmax from threshold statistics (see threshold_statistics). Returns a dict of arrays
+    with one value per replicate: 'result_fmax', 'result_smin' (S at the Fmax threshold, as reported by fmax),
+    'result_t', 'result_aupr', 'result_icaupr' and 'result_dpaupr'. If curves is set, the replicate x threshold
+    precisions, recalls ('precisions', 'recalls', 'icprecisions', ...), 'mi_values' and 'ru_values' are added.
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # Average of the defined ratios, NaN if none is defined
+        averages = {
+            f"{kind}{ratio}s": statistics[f"{kind}{ratio}_sum"]
+            / statistics[f"{kind}{ratio}_n"]
+            for kind in ["", "ic", "dp"]
+            for ratio in ["precision", "recall"]
+        }
+        precision, recall = averages["precisions"], averages["recalls"]
+        f = np.where(
+            precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0
+        )
+    mi = statistics["mi"] / statistics["n"]
+    ru = statistics["ru"] / statistics["n"]
+    s = np.sqrt(ru * ru + mi * mi)
+
+    # Best threshold of each replicate: highest F, then highest S and threshold, as in fmax
+    thresholds = np.broadcast_to(THRESHOLDS, f.shape)
+    best = np.lexsort((thresholds, s, f), axis=-1)[:, -1:]
+    results = {
+        "result_fmax": np.take_along_axis(f, best, axis=1)[:, 0],
+        "result_smin": np.take_along_axis(s, best, axis=1)[:, 0],
+        "result_t": THRESHOLDS[best[:, 0]],
+    }
+
+    def area(precisions, recalls, end_points=True):
+        # Area under the precision-recall curve, with the end points added by fmax if end_points is set
+        precisions = np.nan_to_num(precisions, nan=0.0)
+        first = (recalls[:, :1] > 0) & end_points
+        last = (recalls[:, -1:] < 1) & end_points
+        recalls = np.hstack(
+            [
+                np.where(first, 0.0, recalls[:, :1]),
+                recalls,
+                np.where(last, 1.0, recalls[:, -1:]),
+            ]
+        )
+        precisions = np.hstack(
+            [
+                np.where(first, 1.0, precisions[:, :1]),
+                precisions,
+                np.where(last, 0.0, precisions[:, -1:]),
+            ]
+        )
+        order = np.argsort(recalls, axis=1)
+        return np.trapz(
+            np.take_along_axis(precisions, order, axis=1),
+            np.take_along_axis(recalls, order, axis=1),
+            axis=1,
+        )
+
+    # fmax only keeps the end points of the IC depth curve, which are reproduced here
+    results["result_aupr"] = area(precision, recall, end_points=False)
+    results["result_icaupr"] = area(
+        averages["icprecisions"], averages["icrecalls"], end_points=False
+    )
+    results["result_dpaupr"] = area(averages["dpprecisions"], averages["dprecalls"])
+    if curves:
+        for name, values in averages.items():
+            # Undefined precisions (no covered protein) are reported as 0, as in fmax
+            results[name] = (
+                np.nan_to_num(values, nan=0.0) if "precision" in name else values
+            )
+        results["mi_values"] = mi
+        results["ru_values"] = ru
+    return results
+
+
+def count_metrics(counts, weights):
+    """
+    Compute the metrics of fmax from threshold counts (see threshold_counts) for replicates of the protein set,
+    given as a replicate x protein array of protein weights (e.g. the number of times each protein is drawn).
+    Returns a dict of arrays with one value per replicate (see statistics_metrics).
+    """
+    return statistics_metrics(threshold_statistics(counts, weights))
+
+
+def bootstrap_intervals(
+    counts, n_replicates=1000, confidence=0.95, seed=0, batch_size=100
+):
+    """
+    Bootstrap confidence intervals of the metrics of fmax: proteins are resampled with replacement as weight vectors
+    over their threshold counts (see threshold_counts), so that each batch of replicates costs a few matrix products.
+    Returns a dict mapping each metric to its point estimate, percentile interval bounds and replicate values.
+    """
+    rng = np.random.default_rng(seed)
+    n_proteins = len(counts["true"])
+    estimates = count_metrics(counts, np.ones(n_proteins))
+    replicates = {metric: [] for metric in estimates}
+    for start in range(0, n_replicates, batch_size):
+        weights = rng.multinomial(
+            n_proteins,
+            np.full(n_proteins, 1 / n_proteins),
+            size=min(batch_size, n_replicates - start),
+        )
+        for metric, values in count_metrics(counts, weights).items():
+            replicates[metric].append(values)
+
+    alpha = (1 - confidence) / 2
+    intervals = {"n_replicates": n_replicates, "confidence": confidence}
+    for metric, estimate in estimates.items():
+        values = np.concatenate(replicates[metric])
+        intervals[metric] = {
+            "estimate": float(estimate[0]),
+            "lower": float(np.nanquantile(values, alpha)),
+            "upper": float(np.nanquantile(values, 1 - alpha)),
+            "std": float(np.nanstd(values)),
+            "replicates": values,
+        }
+    return intervals
+
+
+def exact_curves(targets, scores, goic, godp):
+    """
+    Metrics of fmax at every distinct predicted score (scores >= 0) instead of the 0.01 grid of thresholds.
+    Scores are a protein x term CSR matrix whose stored entries are the predictions (see score_vectors), a
+    dense array where unpredicted terms score -1, or a 1-D array of such scores shared by every protein,
+    and targets the matching 0/1 labels.
+    Predictions are sorted once by decreasing score, and the change of each per-protein ratio brought by every
+    prediction is accumulated, so that the sweep costs O(n log n) and memory O(n) in the number n of predictions.
+    Shared scores are swept over their terms only: as every protein predicts the same terms, the ratios only
+    depend on per-term sums of the labels.
+    Returns a dict of arrays with one value per threshold, by decreasing threshold: 'thresholds', the average
+    precisions and recalls ('precisions', 'recalls', 'icprecisions', ...), 'mi_values', 'ru_values', 'f' and 's'.
+    """
+    targets = ssp.csr_matrix(targets, dtype=np.float64)
+    n_proteins = targets.shape[0]
+    term_weights = {"": np.ones(targets.shape[1]), "ic": goic, "dp": godp}
+    true = {kind: targets @ weights for kind, weights in term_weights.items()}
+    true[""] = np.asarray(targets.sum(axis=1)).ravel()
+
+    def ratio(numerators, denominators):
+        return np.divide(
+            numerators,
+            denominators,
+            out=np.zeros(len(numerators)),
+            where=denominators > 0,
+        )
+
+    # For each kind, cumulative sums over the sweep of the per-protein precisions, of the number of covered
+    # proteins, of the per-protein recalls and of the weights of the correct and wrong predictions
+    sums = {}
+    if np.ndim(scores) == 1:
+        scores = np.asarray(scores, dtype=np.float64)
+        cols = np.flatnonzero(scores >= 0)
+        cols = cols[np.argsort(-scores[cols], kind="stable")]
+        values = scores[cols]
+        labelled = np.asarray(targets.sum(axis=0)).ravel()[cols]
+        for kind, weights in term_weights.items():
+            weights = weights[cols]
+            predicted = np.cumsum(weights)
+            correct = np.cumsum(weights * labelled)
+            recalls = targets.T @ ratio(np.ones(n_proteins), true[kind])
+            sums[kind] = (
+                ratio(correct, predicted),
+                np.where(predicted > 0, n_proteins, 0),
+                np.cumsum(weights * recalls[cols]),
+                correct,
+                np.cumsum(weights * (n_proteins - labelled)),
+            )
+    else:
+        if ssp.issparse(scores):
+            scores = ssp.csr_matrix(scores)
+            scores.sort_indices()  # Predictions in row-major order, as with dense scores
+            scores = scores.tocoo()
+            predicted = scores.data >= 0
+            rows, cols = scores.row[predicted], scores.col[predicted]
+            values = scores.data[predicted]
+        else:
+            scores = np.asarray(scores)
+            rows, cols = np.nonzero(scores >= 0)
+            values = scores[rows, cols]
+        order = np.argsort(-values, kind="stable")
+        rows, cols, values = rows[order], cols[order], values[order]
+        correct = np.asarray(targets[rows, cols]).ravel() > 0
+        proteins = pd.Series(rows)
+
+        def protein_cumsum(weights):
+            # Cumulative sums of weights over the predictions of each protein in sweep order, after and before
+            # each prediction
+            cumulative = pd.Series(weights).groupby(proteins).cumsum()
+            before = cumulative.groupby(proteins).shift(1, fill_value=0.0)
+            return cumulative.to_numpy(), before.to_numpy()
+
+        for kind, weights in term_weights.items():
+            weights = weights[cols]
+            predicted, before_predicted = protein_cumsum(weights)
+            hits, before_hits = protein_cumsum(weights * correct)
+            protein_true = true[kind][rows]
+            sums[kind] = (
+                np.cumsum(
+                    ratio(hits, predicted) - ratio(before_hits, before_predicted)
+                ),
+                np.cumsum((predicted > 0).astype(np.int64) - (before_predicted > 0)),
+                np.cumsum(ratio(hits, protein_true) - ratio(before_hits, protein_true)),
+                np.cumsum(weights * correct),
+                np.cumsum(weights * ~correct),
+            )
+
+    # Last prediction of each distinct threshold
+    ends = np.flatnonzero(np.r_[np.diff(values) != 0, True])
+    curves = {"thresholds": values[ends]}
+    for kind, (precision_sum, covered, recall_sum, correct, wrong) in sums.items():
+        # Precisions are averaged over covered proteins and recalls over proteins with true terms
+        with np.errstate(invalid="ignore", divide="ignore"):
+            curves[f"{kind}precisions"] = np.nan_to_num(
+                precision_sum[ends] / covered[ends], nan=0.0
+            )
+            curves[f"{kind}recalls"] = recall_sum[ends] / np.count_nonzero(
+                true[kind] > 0
+            )
+        if kind == "ic":
+            curves["mi_values"] = wrong[ends] / n_proteins
+            curves["ru_values"] = (true[kind].sum() - correct[ends]) / n_proteins
+
+    precision, recall = curves["precisions"], curves["recalls"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        curves["f"] = np.where(
+            precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0
+        )
+    curves["s"] = np.sqrt(curves["ru_values"] ** 2 + curves["mi_values"] ** 2)
+    return curves
+
+
 def read_pkl(pklfile):
     with open(pklfile, "rb") as fr:
         data = pkl.load(fr)
@@ -413,11 +754,29 @@ class Ontology(object):
         return term_set
 
 
-def compute_performance(test_df, go, ont, output_path):
+def propagate_predictions(predictions, go, go_set, goid_idx):
+    """
+    Propagate the predictions ({term: score}) of a protein to the ancestors of their terms, keeping the
+    maximum score of each term of go_set. Terms without prediction get a score of -1.
+    """
+    pred_vals = [-1] * len(goid_idx)
+    for items, score in predictions.items():
+        if items in go_set:
+            pred_vals[goid_idx[items]] = max(score, pred_vals[goid_idx[items]])
+        go_parent = go.get_anchestors(items)
+        for go_id in go_parent:
+            if go_id in go_set:
+                pred_vals[goid_idx[go_id]] = max(pred_vals[goid_idx[go_id]], score)
+    return pred_vals
+
 
+def ontology_terms(go, ont):
+    """
+    Terms of the subontology ont ('bp', 'cc' or 'mf') evaluated by fmax (without its root),
+    as a set and as term -> index and index -> term mappings.
+    """
     go_set = go.get_namespace_terms(NAMESPACES[ont])
     go_set.remove(FUNC_DICT[ont])
-    print(len(go_set))
 
     labels = list(go_set)
     goid_idx = {}
@@ -425,46 +784,104 @@ def compute_performance(test_df, go, ont, output_path):
     for idx, goid in enumerate(labels):
         goid_idx[goid] = idx
         idx_goid[idx] = goid
+    return go_set, goid_idx, idx_goid
+
+
+def term_information(go, idx_goid):
+    """IC and IC depth of the terms of an ontology_terms index, as arrays."""
+    goic = np.array([go.get_ic(idx_goid[i]) for i in range(len(idx_goid))])
+    godp = np.array([go.get_icdepth(idx_goid[i]) for i in range(len(idx_goid))])
+    return goic, godp
+
+
+def label_vector(gos, go, go_set, goid_idx):
+    """Propagated true score vector (0 or 1 for each term of go_set) of a protein annotated with gos."""
+    true_vals = [0] * len(goid_idx)
+    annots = set()
+    for go_id in gos:
+        if go.has_term(go_id):
+            annots |= go.get_anchestors(go_id)
+    for go_id in annots:
+        if go_id in go_set:
+            true_vals[goid_idx[go_id]] = 1
+    return true_vals
+
+
+def sparse_rows(rows, n_terms):
+    """
+    Protein x term CSR matrix of rows given as (term indices, values) pairs. Stored zeros are kept, as they
+    are predictions with a score of 0.
+    """
+    indptr = np.cumsum([0] + [len(indices) for indices, _ in rows])
+    indices = np.concatenate([indices for indices, _ in rows] or [np.empty(0, int)])
+    data = np.concatenate([values for _, values in rows] or [np.empty(0)])
+    return ssp.csr_matrix(
+        (data.astype(np.float64), indices, indptr), shape=(len(rows), n_terms)
+    )
+
+
+def score_vectors(test_df, go, go_set, goid_idx, shared_vals=None, sparse=False):
+    """
+    Propagated true and predicted score vectors of the proteins of test_df, as protein x term arrays.
+    Proteins without any valid annotation in the ontology are skipped. If shared_vals (propagated scores shared
+    by every protein) is given, the predicted scores are a broadcast view of it.
+    If sparse is set, they are CSR matrices storing only the true terms and the predictions (scores >= 0),
+    so that memory grows with the number of predictions rather than with the number of terms. Shared
+    predicted scores are still a broadcast view: they are swept once over their terms (see exact_curves).
+    """
+
+    def sparse_row(values, predicted):
+        values = np.asarray(values, dtype=np.float64)
+        indices = np.flatnonzero(predicted(values))
+        return indices, values[indices]
 
     pred_scores = []
     true_scores = []
     # Annotations
     for i, row in enumerate(test_df.itertuples()):
         # true
-        true_vals = [0] * len(labels)
-        annots = set()
-        for go_id in row.gos:
-            if go.has_term(go_id):
-                annots |= go.get_anchestors(go_id)
-        for go_id in annots:
-            if go_id in go_set:
-                true_vals[goid_idx[go_id]] = 1
+        true_vals = label_vector(row.gos, go, go_set, goid_idx)
 
         # pred
-        pred_vals = [-1] * len(labels)
-        for items, score in row.predictions.items():
-            if items in go_set:
-                pred_vals[goid_idx[items]] = max(score, pred_vals[goid_idx[items]])
-            go_parent = go.get_anchestors(items)
-            for go_id in go_parent:
-                if go_id in go_set:
-                    pred_vals[goid_idx[go_id]] = max(pred_vals[goid_idx[go_id]], score)
+        if shared_vals is None:
+            pred_vals = propagate_predictions(row.predictions, go, go_set, goid_idx)
 
         # Only keep proteins with at least one valid annotation
         if sum(true_vals) > 0:
+            if sparse:
+                true_vals = sparse_row(true_vals, lambda values: values > 0)
+                if shared_vals is None:
+                    pred_vals = sparse_row(pred_vals, lambda values: values >= 0)
             true_scores.append(true_vals)
-            pred_scores.append(pred_vals)
+            if shared_vals is None:
+                pred_scores.append(pred_vals)
         else:
             print(
                 f"Skipping protein {row.protein_id}: no valid annotations in ontology."
             )
 
-    pred_scores = np.array(pred_scores)
-    true_scores = np.array(true_scores)
+    if sparse:
+        true_scores = sparse_rows(true_scores, len(goid_idx))
+    else:
+        true_scores = np.array(true_scores).reshape(-1, len(goid_idx))
+    if shared_vals is None:
+        pred_scores = (
+            sparse_rows(pred_scores, len(goid_idx))
+            if sparse
+            else np.array(pred_scores).reshape(-1, len(goid_idx))
+        )
+    else:
+        pred_scores = np.broadcast_to(np.array(shared_vals), true_scores.shape)
     # print(
     #     pred_scores.shape, true_scores.shape, sum(pred_scores < 0), sum(pred_scores > 0)
     # )
+    return true_scores, pred_scores
 
+
+def performance_results(ont, fmax_results):
+    """
+    Results of compute_performance (curves sorted by recall and areas under them) from the outputs of fmax.
+    """
     (
         result_fmax,
         result_smin,
@@ -479,7 +896,7 @@ def compute_performance(test_df, go, ont, output_path):
         ru_values,
         goic_vector,
         godp_vector,
-    ) = fmax(go, true_scores, pred_scores, idx_goid)
+    ) = fmax_results
 
     precisions = np.array(precisions)
     recalls = np.array(recalls)
@@ -502,7 +919,7 @@ def compute_performance(test_df, go, ont, output_path):
     dpprecisions = dpprecisions[sorted_index]
     result_dpaupr = np.trapz(dpprecisions, dprecalls)
 
-    save_dict = {
+    return {
         "ontology": ont,
         "recalls": recalls,
         "precisions": precisions,
@@ -521,24 +938,382 @@ def compute_performance(test_df, go, ont, output_path):
         "result_smin": result_smin,
         "result_t": result_t,
     }
+
+
+def exact_results(ont, curves, goic, godp):
+    """
+    Results of compute_performance from the exact curves of exact_curves: Fmax (and S) at its exact threshold,
+    and areas under the curves with their end points (recall 0 and 1) added. Unlike the grid results, the
+    minimum S over all thresholds and the threshold reaching it are added ('result_min_s', 'result_min_s_t'),
+    along with the thresholds of the curves.
+    """
+    thresholds = curves["thresholds"]
+    best = np.lexsort((thresholds, curves["s"], curves["f"]))[-1]
+    lowest = np.argmin(curves["s"])
+    save_dict = {"ontology": ont, "thresholds": thresholds}
+    for kind, name in [("", "aupr"), ("ic", "icaupr"), ("dp", "dpaupr")]:
+        recalls, precisions = curves[f"{kind}recalls"], curves[f"{kind}precisions"]
+        if recalls[0] > 0:
+            recalls, precisions = np.r_[0.0, recalls], np.r_[1.0, precisions]
+        if recalls[-1] < 1:
+            recalls, precisions = np.r_[recalls, 1.0], np.r_[precisions, 0.0]
+        # Recalls increase as thresholds decrease
+        save_dict[f"{kind}recalls"] = recalls
+        save_dict[f"{kind}precisions"] = precisions
+        save_dict[f"result_{name}"] = np.trapz(precisions, recalls)
+    save_dict.update(
+        {
+            "ru_values": curves["ru_values"],
+            "mi_values": curves["mi_values"],
+            "goic_vector": goic.reshape(-1, 1),
+            "godp_vector": godp.reshape(-1, 1),
+            "result_fmax": curves["f"][best],
+            "result_smin": curves["s"][best],
+            "result_t": thresholds[best],
+            "result_min_s": curves["s"][lowest],
+            "result_min_s_t": thresholds[lowest],
+        }
+    )
+    return save_dict
+
+
+def statistics_results(ont, results, goic, godp, index=0):
+    """
+    Results of compute_performance from the metrics and curves of statistics_metrics (replicate index),
+    reproducing the outputs of fmax.
+    """
+    curves = {
+        name: results[name][index].tolist()
+        for name in [
+            "precisions",
+            "recalls",
+            "icprecisions",
+            "icrecalls",
+            "dpprecisions",
+            "dprecalls",
+        ]
+    }
+    # End points added by fmax (to the IC depth curve only)
+    if curves["dprecalls"][0] > 0:
+        curves["dprecalls"].insert(0, 0.0)
+        curves["dpprecisions"].insert(0, 1.0)
+    if curves["dprecalls"][-1] < 1:
+        curves["dprecalls"].append(1.0)
+        curves["dpprecisions"].append(0.0)
+    return performance_results(
+        ont,
+        (
+            results["result_fmax"][index],
+            results["result_smin"][index],
+            results["result_t"][index],
+            curves["precisions"],
+            curves["recalls"],
+            curves["icprecisions"],
+            curves["icrecalls"],
+            curves["dpprecisions"],
+            curves["dprecalls"],
+            results["mi_values"][index].tolist(),
+            results["ru_values"][index].tolist(),
+            goic.reshape(-1, 1),
+            godp.reshape(-1, 1),
+        ),
+    )
+
+
+def save_results(output_path, save_dict, counts=None, bootstrap=0, confidence=0.95):
+    """
+    Save the results of compute_performance to output_path, along with bootstrap confidence intervals
+    computed from threshold counts if bootstrap is set.
+    """
     save_pkl(
         "{0}/beprof_eval_results.pkl".format(output_path),
         save_dict,
     )
     print(f"Saved detailed evaluation results to {output_path}/beprof_eval_results.pkl")
-    # return result_fmax, result_smin, result_aupr, result_icaupr, result_dpaupr, result_t
-
 
-def generate_result(
-    input_file,
+    if bootstrap:
+        intervals = bootstrap_intervals(
+            counts, n_replicates=bootstrap, confidence=confidence
+        )
+        save_pkl(f"{output_path}/beprof_bootstrap_results.pkl", intervals)
+        print(
+            f"Fmax {confidence:.0%} confidence interval: [{intervals['result_fmax']['lower']:.4f}, {intervals['result_fmax']['upper']:.4f}]"
+        )
+        print(
+            f"Saved bootstrap confidence intervals to {output_path}/beprof_bootstrap_results.pkl"
+        )
+
+
+def compute_performance(
+    test_df,
+    go,
+    ont,
     output_path,
-    go_file,
-    real_test_protein_mess,
-    all_protein_information,
-    metrics,
+    shared_predictions=None,
+    bootstrap=0,
+    confidence=0.95,
+    exact=False,
 ):
-    all_files = {}
-    all_files["Your_method"] = input_file
+    """
+    Evaluate predictions of the proteins of test_df with fmax, and save the results to output_path.
+    If bootstrap is set, confidence intervals of the metrics are estimated from bootstrap replicates
+    (see bootstrap_intervals) and saved along the results as beprof_bootstrap_results.pkl.
+    If exact is set, metrics are computed at every distinct predicted score (see exact_curves) instead of
+    the thresholds c/100; bootstrap intervals still use the 0.01 grid.
+    """
+
+    go_set, goid_idx, idx_goid = ontology_terms(go, ont)
+    print(len(go_set))
+
+    shared_vals = None
+    if shared_predictions is not None:
+        # Same predictions ({term: score}) for every protein: propagated once and broadcast
+        shared_vals = propagate_predictions(shared_predictions, go, go_set, goid_idx)
+
+    # Exact curves are swept over the predictions only, kept sparse
+    true_scores, pred_scores = score_vectors(
+        test_df, go, go_set, goid_idx, shared_vals, sparse=exact
+    )
+
+    if exact:
+        goic, godp = term_information(go, idx_goid)
+        # Shared predictions are swept once, not for every protein
+        exact_scores = pred_scores if shared_vals is None else np.array(shared_vals)
+        save_dict = exact_results(
+            ont, exact_curves(true_scores, exact_scores, goic, godp), goic, godp
+        )
+    else:
+        fmax_results = fmax(go, true_scores, pred_scores, idx_goid)
+        save_dict = performance_results(ont, fmax_results)
+        goic, godp = (vector.ravel() for vector in fmax_results[-2:])
+
+    counts = None
+    if bootstrap:
+        counts = threshold_counts(true_scores, pred_scores, goic, godp)
+    save_results(output_path, save_dict, counts, bootstrap, confidence)
+    return save_dict
+
+
+class StreamingEvaluator(object):
+    """
+    Out-of-core counterpart of compute_performance: proteins are added chunk by chunk, and only the sufficient
+    statistics of fmax at every threshold are accumulated (see threshold_statistics), so that memory is bounded
+    by the chunk size instead of the protein x term score matrices. finalize computes the same results as
+    compute_performance. With bootstrap, the (much smaller) per-protein threshold counts are kept as well.
+    Proteins are evaluated against the ground truth real_test_protein_mess on the subontology tag, and get
+    shared_predictions ({term: score}) if given, as in evaluate_shared_predictions.
+    """
+
+    def __init__(
+        self,
+        go,
+        real_test_protein_mess,
+        tag,
+        shared_predictions=None,
+        bootstrap=0,
+        confidence=0.95,
+    ):
+        self.go = go
+        self.real_test_protein_mess = real_test_protein_mess
+        self.tag = tag
+        self.bootstrap = bootstrap
+        self.confidence = confidence
+        self.go_set, self.goid_idx, self.idx_goid = ontology_terms(go, tag)
+        self.goic, self.godp = term_information(go, self.idx_goid)
+        self.shared_vals = None
+        if shared_predictions is not None:
+            self.shared_vals = propagate_predictions(
+                shared_predictions, go, self.go_set, self.goid_idx
+            )
+        self.statistics = None
+        self.counts = []
+        self.n_proteins = 0
+
+    def add_predictions(self, method_predict_result):
+        """
+        Add a chunk of predictions ({protein: {tag: {term: score}}}), as in evaluate_predictions.
+        """
+        save_dict = {"protein_id": [], "gos": [], "predictions": []}
+        for protein, val in method_predict_result.items():
+            gos = self.real_test_protein_mess[protein]["all_{0}".format(self.tag)]
+            if gos == set():
+                continue
+            save_dict["protein_id"].append(protein)
+            save_dict["gos"].append(gos)
+            save_dict["predictions"].append(val.get(self.tag, {}))
+        self.add(pd.DataFrame(save_dict))
+
+    def add_proteins(self, proteins):
+        """
+        Add a chunk of proteins getting the shared predictions, as in evaluate_shared_predictions.
+        """
+        save_dict = {"protein_id": [], "gos": []}
+        for protein in proteins:
+            gos = self.real_test_protein_mess[protein]["all_{0}".format(self.tag)]
+            if gos == set():
+                continue
+            save_dict["protein_id"].append(protein)
+            save_dict["gos"].append(gos)
+        self.add(pd.DataFrame(save_dict))
+
+    def add(self, test_df):
+        """Add a chunk of proteins (protein_id, gos and, without shared predictions, predictions columns)."""
+        if test_df.empty:
+            return
+        true_scores, pred_scores = score_vectors(
+            test_df, self.go, self.go_set, self.goid_idx, self.shared_vals
+        )
+        counts = threshold_counts(true_scores, pred_scores, self.goic, self.godp)
+        statistics = threshold_statistics(counts, np.ones(len(true_scores)))
+        if self.statistics is None:
+            self.statistics = statistics
+        else:
+            for name, values in statistics.items():
+                self.statistics[name] += values
+        if self.bootstrap:
+            self.counts.append(counts)
+        self.n_proteins += len(true_scores)
+
+    def finalize(self, output_path):
+        """
+        Compute the results of compute_performance from the accumulated statistics, and save them to output_path.
+        """
+        if self.statistics is None:
+            raise ValueError("No protein with valid annotations to evaluate.")
+        save_dict = statistics_results(
+            self.tag,
+            statistics_metrics(self.statistics, curves=True),
+            self.goic,
+            self.godp,
+        )
+        counts = None
+        if self.bootstrap:
+            counts = {
+                name: np.concatenate([chunk[name] for chunk in self.counts])
+                for name in self.counts[0]
+            }
+        save_results(output_path, save_dict, counts, self.bootstrap, self.confidence)
+        return save_dict
+
+
+class StackedEvaluator(object):
+    """
+    Evaluate several prediction sets of the same test proteins (e.g. every method of a run) in one batched pass.
+    The label side (propagated true terms of each protein) and the IC weights are built once and shared by all
+    prediction sets. The threshold statistics of each set (see threshold_statistics) are stacked as replicates,
+    and finalize computes the metrics and curves of every set at once, saving the same results as
+    compute_performance for each set.
+    """
+
+    def __init__(self, go, real_test_protein_mess, tag, bootstrap=0, confidence=0.95):
+        self.go = go
+        self.real_test_protein_mess = real_test_protein_mess
+        self.tag = tag
+        self.bootstrap = bootstrap
+        self.confidence = confidence
+        self.go_set, self.goid_idx, self.idx_goid = ontology_terms(go, tag)
+        self.goic, self.godp = term_information(go, self.idx_goid)
+        self.labels = {}  # Label vector of each protein, None without valid annotation
+        self.statistics = {}
+        self.counts = {}
+
+    def label_rows(self, proteins):
+        """
+        Label vectors of the proteins annotated in the ontology (built once per protein), as a protein x term
+        array, along with these proteins.
+        """
+        kept, rows = [], []
+        for protein in proteins:
+            if protein not in self.labels:
+                gos = self.real_test_protein_mess[protein]["all_{0}".format(self.tag)]
+                true_vals = None
+                if gos != set():
+                    true_vals = np.array(
+                        label_vector(gos, self.go, self.go_set, self.goid_idx),
+                        dtype=np.int8,
+                    )
+                    if true_vals.sum() == 0:
+                        print(
+                            f"Skipping protein {protein}: no valid annotations in ontology."
+                        )
+                        true_vals = None
+                self.labels[protein] = true_vals
+            if self.labels[protein] is not None:
+                kept.append(protein)
+                rows.append(self.labels[protein])
+        return kept, np.array(rows, dtype=np.int8).reshape(-1, len(self.goid_idx))
+
+    def add_predictions(self, name, method_predict_result):
+        """
+        Add the prediction set name ({protein: {tag: {term: score}}}), as in evaluate_predictions.
+        """
+        proteins, true_scores = self.label_rows(method_predict_result)
+        pred_scores = np.array(
+            [
+                propagate_predictions(
+                    method_predict_result[protein].get(self.tag, {}),
+                    self.go,
+                    self.go_set,
+                    self.goid_idx,
+                )
+                for protein in proteins
+            ]
+        ).reshape(-1, len(self.goid_idx))
+        self.add(name, true_scores, pred_scores)
+
+    def add_shared_predictions(self, name, proteins, shared_predictions):
+        """
+        Add the prediction set name, made of predictions ({term: score}) shared by all the given proteins,
+        as in evaluate_shared_predictions.
+        """
+        proteins, true_scores = self.label_rows(proteins)
+        shared_vals = propagate_predictions(
+            shared_predictions, self.go, self.go_set, self.goid_idx
+        )
+        self.add(
+            name, true_scores, np.broadcast_to(np.array(shared_vals), true_scores.shape)
+        )
+
+    def add(self, name, true_scores, pred_scores):
+        if len(true_scores) == 0:
+            raise ValueError(
+                f"No protein with valid annotations to evaluate in {name}."
+            )
+        counts = threshold_counts(true_scores, pred_scores, self.goic, self.godp)
+        self.statistics[name] = threshold_statistics(counts, np.ones(len(true_scores)))
+        if self.bootstrap:
+            self.counts[name] = counts
+
+    def finalize(self, output_paths):
+        """
+        Compute the results of every prediction set in one pass, and save them to output_paths[name].
+        Returns a dict of the results of each set.
+        """
+        names = list(self.statistics)
+        stacked = {
+            key: np.vstack([self.statistics[name][key] for name in names])
+            for key in self.statistics[names[0]]
+        }
+        results = statistics_metrics(stacked, curves=True)
+        save_dicts = {}
+        for index, name in enumerate(names):
+            save_dicts[name] = statistics_results(
+                self.tag, results, self.goic, self.godp, index
+            )
+            save_results(
+                output_paths[name],
+                save_dicts[name],
+                self.counts.get(name),
+                self.bootstrap,
+                self.confidence,
+            )
+        return save_dicts
+
+
+def load_ontology(go_file, all_protein_information):
+    """
+    Load the GO ontology and compute the IC of its terms from the background annotations.
+    """
     go = Ontology(go_file, with_rels=True)
 
     all_annotations = []
@@ -554,6 +1329,101 @@ def generate_result(
                 item_set |= go.get_anchestors(item)
         all_annotations.append(list(item_set))
     go.calculate_ic(all_annotations)
+    return go
+
+
+def evaluate_predictions(
+    method_predict_result,
+    output_path,
+    go,
+    real_test_protein_mess,
+    tag,
+    bootstrap=0,
+    confidence=0.95,
+    exact=False,
+):
+    """
+    Evaluate in-memory predictions ({protein: {tag: {term: score}}}) of a single method
+    on the subontology tag ('bp', 'cc' or 'mf'), save the results to output_path and return them.
+    bootstrap sets the number of bootstrap replicates of the confidence intervals (none if 0),
+    and exact evaluates every distinct score as a threshold (see compute_performance).
+    """
+    save_dict = {}
+    save_dict["protein_id"] = []
+    save_dict["gos"] = []
+    save_dict["predictions"] = []
+
+    for protein, val in method_predict_result.items():
+        if real_test_protein_mess[protein]["all_{0}".format(tag)] == set():
+            continue
+        if tag not in method_predict_result[protein]:
+            method_predict_result[protein][tag] = {}
+
+        save_dict["protein_id"].append(protein)
+        save_dict["gos"].append(real_test_protein_mess[protein]["all_{0}".format(tag)])
+        save_dict["predictions"].append(method_predict_result[protein][tag])
+
+    df = pd.DataFrame(save_dict)
+    return compute_performance(
+        df,
+        go,
+        tag,
+        output_path,
+        bootstrap=bootstrap,
+        confidence=confidence,
+        exact=exact,
+    )
+
+
+def evaluate_shared_predictions(
+    proteins,
+    shared_predictions,
+    output_path,
+    go,
+    real_test_protein_mess,
+    tag,
+    bootstrap=0,
+    confidence=0.95,
+    exact=False,
+):
+    """
+    Evaluate predictions ({term: score}) shared by all the given proteins, such as the Naive baseline's,
+    without building per-protein predictions. Results are saved to output_path and returned.
+    """
+    save_dict = {"protein_id": [], "gos": []}
+    for protein in proteins:
+        if real_test_protein_mess[protein]["all_{0}".format(tag)] == set():
+            continue
+        save_dict["protein_id"].append(protein)
+        save_dict["gos"].append(real_test_protein_mess[protein]["all_{0}".format(tag)])
+
+    df = pd.DataFrame(save_dict)
+    return compute_performance(
+        df,
+        go,
+        tag,
+        output_path,
+        shared_predictions=shared_predictions,
+        bootstrap=bootstrap,
+        confidence=confidence,
+        exact=exact,
+    )
+
+
+def generate_result(
+    input_file,
+    output_path,
+    go_file,
+    real_test_protein_mess,
+    all_protein_information,
+    metrics,
+    bootstrap=0,
+    confidence=0.95,
+    exact=False,
+):
+    all_files = {}
+    all_files["Your_method"] = input_file
+    go = load_ontology(go_file, all_protein_information)
 
     if "CCO" in input_file:
         all_tags = ["cc"]
@@ -580,28 +1450,19 @@ def generate_result(
 
     for num, tag in enumerate(all_tags):
         for method, mfile in all_files.items():
-            save_dict = {}
-            save_dict["protein_id"] = []
-            save_dict["gos"] = []
-            save_dict["predictions"] = []
-
             with open(mfile, "rb") as fr:
                 method_predict_result = pkl.load(fr)
 
-            for protein, val in method_predict_result.items():
-                if real_test_protein_mess[protein]["all_{0}".format(tag)] == set():
-                    continue
-                if tag not in method_predict_result[protein]:
-                    method_predict_result[protein][tag] = {}
-
-                save_dict["protein_id"].append(protein)
-                save_dict["gos"].append(
-                    real_test_protein_mess[protein]["all_{0}".format(tag)]
-                )
-                save_dict["predictions"].append(method_predict_result[protein][tag])
-
-            df = pd.DataFrame(save_dict)
-            compute_performance(df, go, tag, output_path)
+            evaluate_predictions(
+                method_predict_result,
+                output_path,
+                go,
+                real_test_protein_mess,
+                tag,
+                bootstrap=bootstrap,
+                confidence=confidence,
+                exact=exact,
+            )
 
     #         F_max, Smin, Aupr, ICAupr, DPAupr, threadhold = compute_performance(
     #             df, go, tag, output_path
@@ -647,6 +1508,9 @@ def main(
     all_protein_information_file,
     go_file,
     metrics,
+    bootstrap=0,
+    confidence=0.95,
+    exact=False,
 ):
     with open(test_data_file, "rb") as f:
         test_data = pkl.load(f)
@@ -654,7 +1518,15 @@ def main(
         all_protein_information = pkl.load(f)
     print("Test data and all protein information loaded.")
     generate_result(
-        input_file, output_path, go_file, test_data, all_protein_information, metrics
+        input_file,
+        output_path,
+        go_file,
+        test_data,
+        all_protein_information,
+        metrics,
+        bootstrap=bootstrap,
+        confidence=confidence,
+        exact=exact,
     )
 
 
@@ -676,4 +1548,7 @@ if __name__ == "__main__":
         all_protein_information_file,
         go_file,
         metrics,
+        bootstrap=args.bootstrap,
+        confidence=args.confidence,
+        exact=args.exact,
     )
@@ -1,4 +1,13 @@
+import os
+import numpy as np
 import pandas as pd
+from alignment_store import (
+    AlignmentHits,
+    ingest_alignment,
+    source_signature,
+    store_filters,
+    store_path,
+)
 from constants import *
 
 
@@ -15,51 +24,102 @@ def load_uniprot_mapping():
     return id_mapping
 
 
-def load_pairwise_alignment(dataset, id_mapping=None):
+def load_sequence_lengths():
     """
-    Load pairwise alignment data (SwissProt 2024_01) and map Query_id and Subject_id to EntryID using id_mapping
+    Load SwissProt 2024_01 sequence lengths, indexed by both EntryID and Entry Name,
+    so that they can be looked up with the protein IDs of the Diamond alignment.
     """
-    pairwise_alignment = pd.read_csv(
-        "./data/swissprot/2024_01/diamond_swissprot_2024_01_alignment.tsv",
+    sequences = pd.read_csv(
+        f"./data/swissprot/2024_01/swissprot_2024_01_annotations.tsv",
         sep="\t",
-        header=None,
-        names=[
-            "query_id",
-            "subject_id",
-            "perc_identity",
-            "align_length",
-            "mismatches",
-            "gap_opens",
-            "q_start",
-            "q_end",
-            "s_start",
-            "s_end",
-            "e_value",
-            "bit_score",
-        ],
+        usecols=["EntryID", "Entry Name", "Sequence"],
     )
+    lengths = sequences["Sequence"].str.len().to_numpy()
+    return (
+        pd.Series(
+            np.concatenate([lengths, lengths]),
+            index=pd.concat([sequences["EntryID"], sequences["Entry Name"]]),
+        )
+        .groupby(level=0)
+        .first()
+    )
+
+
+def load_pairwise_alignment(
+    dataset,
+    id_mapping=None,
+    alignment_file="./data/swissprot/2024_01/diamond_swissprot_2024_01_alignment.tsv",
+    chunk_size=1_000_000,
+    max_evalue=None,
+    min_identity=None,
+    min_coverage=None,
+    max_hits_per_query=None,
+):
+    """
+    Load pairwise alignment data (SwissProt 2024_01) as AlignmentHits sorted by query, with their per-query index,
+    and map Query_id and Subject_id to EntryID using id_mapping.
+
+    Sorted hits are saved next to the alignment file as a memory-mapped columnar store (int32 protein codes,
+    float32 scores). The store is built by reading the alignment file by chunks of chunk_size rows, keeping hits
+    with an e-value up to max_evalue, a percent identity of at least min_identity and covering at least
+    min_coverage % of both sequences, and only the top max_hits_per_query hits of each query by bit score.
+    The store is rebuilt when the alignment file or the filters change.
+    """
+    store = store_path(alignment_file)
+    filters = {
+        "max_evalue": max_evalue,
+        "min_identity": min_identity,
+        "min_coverage": min_coverage,
+    }
+    expected = {
+        "filters": store_filters(max_hits_per_query=max_hits_per_query, **filters),
+        **source_signature(alignment_file),
+    }
+    hits = None
+    if os.path.exists(os.path.join(store, "metadata.json")):
+        hits, metadata = AlignmentHits.load(store)
+        if any(metadata.get(key) != value for key, value in expected.items()):
+            hits = None
+    if hits is None:
+        hits = ingest_alignment(
+            alignment_file,
+            store,
+            chunk_size=chunk_size,
+            max_hits_per_query=max_hits_per_query,
+            sequence_lengths=(
+                load_sequence_lengths() if min_coverage is not None else None
+            ),
+            **filters,
+        )
 
     # Load Uniprot ID mapping
     if dataset in USES_ENTRYID:
-        # Diamond output uses EntryName (e.g. Q6GZX1) as protein IDs
-        pairwise_alignment["query_id"] = pairwise_alignment["query_id"].map(id_mapping)
-        pairwise_alignment["subject_id"] = pairwise_alignment["subject_id"].map(
-            id_mapping
-        )
+        # Diamond output uses EntryName (e.g. Q6GZX1) as protein IDs.
+        # Hits on unmapped proteins are dropped
+        hits = hits.rename(id_mapping)
 
-    # Drop rows with NaN values in Query_id or Subject_id
-    pairwise_alignment = pairwise_alignment[
-        pairwise_alignment["query_id"].notna()
-        & pairwise_alignment["subject_id"].notna()
-    ]
+    return hits
 
-    # Remove self-alignments
-    # This is required to avoid self-annotation transfer
-    pairwise_alignment = pairwise_alignment[
-        pairwise_alignment["query_id"] != pairwise_alignment["subject_id"]
-    ]
 
-    return pairwise_alignment
+def data_files(
+    dataset, aspect, db_version, annotations_2024_01=False, experimental_only=False
+):
+    """
+    Paths of the annotation files read by load_data with the same arguments.
+    """
+    if db_version == "":
+        train_file = f"./data/{dataset}/{dataset}_{aspect}_train_annotations.tsv"
+    elif experimental_only:
+        train_file = f"./data/swissprot/{db_version}/swissprot_{db_version}_{aspect}_exp_annotations.tsv"
+    else:
+        train_file = f"./data/swissprot/{db_version}/swissprot_{db_version}_{aspect}_annotations.tsv"
+    files = [train_file, f"./data/{dataset}/{dataset}_{aspect}_test_annotations.tsv"]
+    if annotations_2024_01:
+        exp = "_exp" if experimental_only else ""
+        files.append(
+            f"./data/swissprot/2024_01/swissprot_2024_01_{aspect}{exp}_annotations.tsv"
+        )
+    return files
 
 
 def load_data(
@@ -0,0 +1,505 @@
+import os
+import json
+import shutil
+import sys
+import hashlib
+import argparse
+import subprocess
+import concurrent.futures
+import tqdm
+import pandas as pd
+from Bio import SeqIO
+from alignment_store import ingest_alignment, source_signature, store_path
+
+
+def split_fasta(fasta_file, shard_dir, n_shards):
+    """
+    Split a FASTA file into n_shards query shards of about the same total sequence length,
+    keeping sequences in file order. Returns the shard FASTA files.
+    """
+    lengths = [len(record.seq) for record in SeqIO.parse(fasta_file, "fasta")]
+    shard_length = sum(lengths) / n_shards
+
+    os.makedirs(shard_dir, exist_ok=True)
+    shard_files = [
+        os.path.join(shard_dir, f"shard_{i:04d}.fasta") for i in range(n_shards)
+    ]
+    handles = [open(shard_file, "w") for shard_file in shard_files]
+    cumulative_length = 0
+    for record, length in zip(SeqIO.parse(fasta_file, "fasta"), lengths):
+        shard = min(int(cumulative_length / shard_length), n_shards - 1)
+        SeqIO.write(record, handles[shard], "fasta")
+        cumulative_length += length
+    for handle in handles:
+        handle.close()
+    return shard_files
+
+
+def sequence_index(fasta_file):
+    """
+    Index the sequences of a FASTA file: a DataFrame with the ID, SHA-1 hash and length of each sequence.
+    """
+    rows = [
+        (record.id, hashlib.sha1(str(record.seq).encode()).hexdigest(), len(record.seq))
+        for record in SeqIO.parse(fasta_file, "fasta")
+    ]
+    return pd.DataFrame(rows, columns=["id", "sha1", "length"])
+
+
+def sequence_index_path(alignment_file):
+    return alignment_file + ".sequences.tsv"
+
+
+def write_sequences(fasta_file, output_file, ids):
+    """Write the sequences of a FASTA file whose ID is in ids."""
+    ids = set(ids)
+    SeqIO.write(
+        (record for record in SeqIO.parse(fasta_file, "fasta") if record.id in ids),
+        output_file,
+        "fasta",
+    )
+
+
+def make_database(diamond, fasta_file, db, threads):
+    """
+    Build the Diamond database of a FASTA file, unless it was already built from the same file.
+    The database is built aside and moved in place once Diamond succeeded, along with the signature of the
+    FASTA file it was built from (<db>.dmnd.json), so that an interrupted build is never reused.
+    """
+    signature = {
+        "fasta": {"path": os.path.abspath(fasta_file), **source_signature(fasta_file)}
+    }
+    signature_file = db + ".dmnd.json"
+    if os.path.exists(db + ".dmnd") and os.path.exists(signature_file):
+        with open(signature_file) as f:
+            if json.load(f) == signature:
+                return
+    print(f"Building Diamond database {db}.dmnd...")
+    subprocess.run(
+        [
+            diamond,
+            "makedb",
+            "--in",
+            fasta_file,
+            "-d",
+            db + ".tmp",
+            "--threads",
+            str(threads),
+        ],
+        check=True,
+    )
+    os.replace(db + ".tmp.dmnd", db + ".dmnd")
+    with open(signature_file + ".tmp", "w") as f:
+        json.dump(signature, f, indent=2)
+    os.replace(signature_file + ".tmp", signature_file)
+
+
+def run_shard(
+    diamond, db, shard_file, output_file, threads, sensitivity, evalue, dbsize=None
+):
+    """
+    Align a query shard against the Diamond database. The output is written aside, and moved in place
+    along with a .done checkpoint file once Diamond succeeded.
+    dbsize optionally sets the database size used for e-values, in letters.
+    """
+    command = [diamond, "blastp"]
+    if sensitivity:
+        command.append(sensitivity)
+    command += [
+        "--db",
+        db + ".dmnd",
+        "--query",
+        shard_file,
+        "--out",
+        output_file + ".tmp",
+        "-e",
+        str(evalue),
+        "--threads",
+        str(threads),
+    ]
+    if dbsize is not None:
+        command += ["--dbsize", str(dbsize)]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    os.replace(output_file + ".tmp", output_file)
+    open(output_file + ".done", "w").close()
+    return output_file
+
+
+def run_alignment(
+    fasta_file,
+    output_file,
+    db=None,
+    work_dir=None,
+    diamond="diamond",
+    n_shards=16,
+    jobs=4,
+    threads=None,
+    sensitivity="--very-sensitive",
+    evalue=0.001,
+    build_store=True,
+    query_file=None,
+    dbsize=None,
+):
+    """
+    All-vs-all Diamond alignment of the sequences of a FASTA file, split into n_shards query shards.
+    Up to jobs shards run at a time, sharing a budget of threads CPU threads (all CPUs by default).
+    query_file optionally gives other query sequences to align against the FASTA file,
+    and dbsize the database size used for e-values, in letters.
+
+    Completed shards are checkpointed in work_dir: rerunning after an interruption only runs the remaining
+    shards, as long as the FASTA file and the alignment settings are unchanged. Shard outputs are merged
+    into output_file and, with build_store, into its alignment store. The index of the aligned sequences
+    (see sequence_index) is saved next to output_file, for later incremental alignments.
+    diamond can be any executable with the command-line interface of Diamond, e.g. a stub in tests.
+    """
+    query_file = query_file or fasta_file
+    threads = threads or os.cpu_count()
+    db = db or os.path.splitext(fasta_file)[0] + "_proteins_set"
+    work_dir = work_dir or output_file + ".shards"
+
+    # Checkpoints are only valid for the same sequences and settings
+    manifest = {
+        "fasta": {"path": os.path.abspath(fasta_file), **source_signature(fasta_file)},
+        "queries": {
+            "path": os.path.abspath(query_file),
+            **source_signature(query_file),
+        },
+        "db": os.path.abspath(db),
+        "dbsize": dbsize,
+        "n_shards": n_shards,
+        "sensitivity": sensitivity,
+        "evalue": evalue,
+    }
+    manifest_file = os.path.join(work_dir, "manifest.json")
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            if json.load(f) != manifest:
+                print(
+                    f"Alignment settings changed, discarding checkpoints in {work_dir}"
+                )
+                shutil.rmtree(work_dir)
+    if not os.path.exists(manifest_file):
+        os.makedirs(work_dir, exist_ok=True)
+        split_fasta(query_file, work_dir, n_shards)
+        with open(manifest_file, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    make_database(diamond, fasta_file, db, threads)
+
+    shard_outputs = [
+        os.path.join(work_dir, f"shard_{i:04d}.tsv") for i in range(n_shards)
+    ]
+    remaining = [
+        i
+        for i, output in enumerate(shard_outputs)
+        if not os.path.exists(output + ".done")
+    ]
+    print(
+        f"Aligning {len(remaining)} of {n_shards} shards ({jobs} at a time, {max(1, threads // jobs)} threads each)..."
+    )
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(
+                run_shard,
+                diamond,
+                db,
+                os.path.join(work_dir, f"shard_{i:04d}.fasta"),
+                shard_outputs[i],
+                max(1, threads // jobs),
+                sensitivity,
+                evalue,
+                dbsize,
+            )
+            for i in remaining
+        ]
+        for future in tqdm.tqdm(
+            concurrent.futures.as_completed(futures),
+            total=len(futures),
+            desc="Aligning shards",
+        ):
+            future.result()
+
+    # Merge shard outputs, in shard order
+    with open(output_file + ".tmp", "wb") as out:
+        for shard_output in shard_outputs:
+            with open(shard_output, "rb") as f:
+                shutil.copyfileobj(f, out)
+    os.replace(output_file + ".tmp", output_file)
+    print(f"Saved alignment to {output_file}")
+    if query_file == fasta_file:
+        sequence_index(fasta_file).to_csv(
+            sequence_index_path(output_file), sep="\t", index=False
+        )
+
+    if build_store:
+        hits = ingest_alignment(
+            output_file, store_path(output_file), input_files=shard_outputs
+        )
+        print(f"Saved {len(hits)} hits to {store_path(output_file)}")
+    return output_file
+
+
+def patch_alignment(
+    previous_alignment,
+    output_file,
+    unchanged_ids,
+    new_subject_hits,
+    new_query_hits,
+    max_target_seqs=25,
+):
+    """
+    Write the alignment of a new release from the alignment of the previous one. Hits between unchanged
+    sequences are kept, and the hits of unchanged queries on new subjects are inserted after the kept hits
+    of their query, so that the hits of each query stay together. As Diamond reports up to max_target_seqs
+    targets per query, queries with new hits keep their max_target_seqs best hits by bit score.
+    Hits of new queries are appended.
+    """
+    extra_lines = {}
+    with open(new_subject_hits) as f:
+        for line in f:
+            extra_lines.setdefault(line.split("\t", 1)[0], []).append(line)
+
+    def query_lines(query_id, lines):
+        if query_id not in extra_lines:
+            return lines
+        lines = lines + extra_lines.pop(query_id)
+        lines.sort(key=lambda line: -float(line.rsplit("\t", 1)[1]))
+        return lines[:max_target_seqs]
+
+    with open(output_file + ".tmp", "w") as out:
+        current, lines = None, []
+        with open(previous_alignment) as f:
+            for line in f:
+                query_id, subject_id = line.split("\t", 2)[:2]
+                if query_id != current:
+                    out.writelines(query_lines(current, lines))
+                    current, lines = query_id, []
+                if query_id in unchanged_ids and subject_id in unchanged_ids:
+                    lines.append(line)
+        out.writelines(query_lines(current, lines))
+        for query_id in list(extra_lines):
+            out.writelines(query_lines(query_id, []))
+        with open(new_query_hits) as f:
+            shutil.copyfileobj(f, out)
+    os.replace(output_file + ".tmp", output_file)
+
+
+def run_incremental_alignment(
+    fasta_file,
+    output_file,
+    previous_alignment,
+    previous_fasta=None,
+    work_dir=None,
+    diamond="diamond",
+    n_shards=16,
+    jobs=4,
+    threads=None,
+    sensitivity="--very-sensitive",
+    evalue=0.001,
+    build_store=True,
+    max_target_seqs=25,
+):
+    """
+    All-vs-all Diamond alignment of a new release, patching the alignment of a previous release.
+
+    Sequences are compared by ID and SHA-1 hash with the sequence index of previous_alignment
+    (or with previous_fasta). Only new or changed sequences are aligned: against all sequences as queries,
+    and against them as subjects for unchanged queries, with e-values computed for the full database size.
+    Hits between unchanged sequences are kept from previous_alignment; hits on removed or changed sequences
+    are dropped. Queries keep up to max_target_seqs hits (Diamond's default), but hits beyond the top
+    max_target_seqs of a query in previous_alignment cannot be recovered. Steps are resumable as in run_alignment.
+    """
+    work_dir = work_dir or output_file + ".incremental"
+    manifest = {
+        "fasta": {"path": os.path.abspath(fasta_file), **source_signature(fasta_file)},
+        "previous_alignment": {
+            "path": os.path.abspath(previous_alignment),
+            **source_signature(previous_alignment),
+        },
+    }
+    manifest_file = os.path.join(work_dir, "manifest.json")
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            if json.load(f) != manifest:
+                print(f"Releases changed, discarding checkpoints in {work_dir}")
+                shutil.rmtree(work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    if os.path.exists(sequence_index_path(previous_alignment)):
+        previous = pd.read_csv(sequence_index_path(previous_alignment), sep="\t")
+    elif previous_fasta is not None:
+        previous = sequence_index(previous_fasta)
+    else:
+        raise FileNotFoundError(
+            f"No sequence index for {previous_alignment}: previous_fasta is required."
+        )
+    current = sequence_index(fasta_file)
+    previous_hashes = dict(zip(previous["id"], previous["sha1"]))
+    unchanged = (
+        current["sha1"].to_numpy() == current["id"].map(previous_hashes).to_numpy()
+    )
+    unchanged_ids = set(current["id"][unchanged])
+    changed_ids = current["id"][~unchanged]
+    print(
+        f"{len(changed_ids)} new or changed sequences, {len(unchanged_ids)} unchanged, {len(set(previous['id']) - set(current['id']))} removed"
+    )
+
+    changed_fasta = os.path.join(work_dir, "changed.fasta")
+    unchanged_fasta = os.path.join(work_dir, "unchanged.fasta")
+    if not os.path.exists(changed_fasta) or not os.path.exists(unchanged_fasta):
+        write_sequences(fasta_file, changed_fasta + ".tmp", changed_ids)
+        write_sequences(fasta_file, unchanged_fasta + ".tmp", unchanged_ids)
+        os.replace(changed_fasta + ".tmp", changed_fasta)
+        os.replace(unchanged_fasta + ".tmp", unchanged_fasta)
+
+    settings = dict(
+        diamond=diamond,
+        jobs=jobs,
+        threads=threads,
+        sensitivity=sensitivity,
+        evalue=evalue,
+        build_store=False,
+    )
+    new_query_hits = os.path.join(work_dir, "new_queries.tsv")
+    new_subject_hits = os.path.join(work_dir, "new_subjects.tsv")
+    if len(changed_ids):
+        # New queries against the full database
+        run_alignment(
+            fasta_file,
+            new_query_hits,
+            query_file=changed_fasta,
+            n_shards=max(1, min(n_shards, len(changed_ids))),
+            **settings,
+        )
+        # Unchanged queries against new subjects, with e-values of the full database
+        run_alignment(
+            changed_fasta,
+            new_subject_hits,
+            db=os.path.join(work_dir, "changed_proteins_set"),
+            query_file=unchanged_fasta,
+            n_shards=n_shards,
+            dbsize=int(current["length"].sum()),
+            **settings,
+        )
+    else:
+        open(new_query_hits, "w").close()
+        open(new_subject_hits, "w").close()
+
+    patch_alignment(
+        previous_alignment,
+        output_file,
+        unchanged_ids,
+        new_subject_hits,
+        new_query_hits,
+        max_target_seqs=max_target_seqs,
+    )
+    current.to_csv(sequence_index_path(output_file), sep="\t", index=False)
+    print(f"Saved alignment to {output_file}")
+
+    if build_store:
+        hits = ingest_alignment(output_file, store_path(output_file))
+        print(f"Saved {len(hits)} hits to {store_path(output_file)}")
+    return output_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the sharded, resumable all-vs-all Diamond alignment of SwissProt sequences."
+    )
+    parser.add_argument(
+        "--fasta",
+        default="./data/swissprot/2024_01/swissprot_2024_01.fasta",
+        help="FASTA file of the sequences to align (produced by download_swissprot.py).",
+    )
+    parser.add_argument(
+        "--output",
+        default="./data/swissprot/2024_01/diamond_swissprot_2024_01_alignment.tsv",
+        help="Alignment file to write.",
+    )
+    parser.add_argument(
+        "--db",
+        default=None,
+        help="Diamond database path, without the .dmnd extension. Built if missing or if the FASTA file changed.",
+    )
+    parser.add_argument(
+        "--work_dir",
+        default=None,
+        help="Directory for shards and checkpoints. Defaults to <output>.shards.",
+    )
+    parser.add_argument(
+        "--diamond", default="diamond", help="Diamond executable (or a stub)."
+    )
+    parser.add_argument(
+        "--n_shards", type=int, default=16, help="Number of query shards."
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=4, help="Number of shards aligned concurrently."
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="Total number of CPU threads shared by concurrent shards. Defaults to all CPUs.",
+    )
+    parser.add_argument(
+        "--sensitivity",
+        default="--very-sensitive",
+        help="Diamond sensitivity flag (empty for default sensitivity).",
+    )
+    parser.add_argument("--evalue", type=float, default=0.001, help="Maximum e-value.")
+    parser.add_argument(
+        "--previous_alignment",
+        default=None,
+        help="Alignment file of a previous release: only new or changed sequences are aligned, and this alignment is patched.",
+    )
+    parser.add_argument(
+        "--previous_fasta",
+        default=None,
+        help="FASTA file of the previous release, if its alignment has no sequence index (<alignment>.sequences.tsv).",
+    )
+    parser.add_argument(
+        "--no_store",
+        action="store_true",
+        help="Only write the alignment file, without building its alignment store.",
+    )
+    args = parser.parse_args()
+
+    if args.previous_alignment is not None:
+        run_incremental_alignment(
+            args.fasta,
+            args.output,
+            args.previous_alignment,
+            previous_fasta=args.previous_fasta,
+            work_dir=args.work_dir,
+            diamond=args.diamond,
+            n_shards=args.n_shards,
+            jobs=args.jobs,
+            threads=args.threads,
+            sensitivity=args.sensitivity,
+            evalue=args.evalue,
+            build_store=not args.no_store,
+        )
+        sys.exit(0)
+
+    run_alignment(
+        args.fasta,
+        args.output,
+        db=args.db,
+        work_dir=args.work_dir,
+        diamond=args.diamond,
+        n_shards=args.n_shards,
+        jobs=args.jobs,
+        threads=args.threads,
+        sensitivity=args.sensitivity,
+        evalue=args.evalue,
+        build_store=not args.no_store,
+    )
+
+# Example usage:
+# python diamond_runner.py --fasta ./data/swissprot/2024_01/swissprot_2024_01.fasta \
+# --output ./data/swissprot/2024_01/diamond_swissprot_2024_01_alignment.tsv --n_shards 32 --jobs 4 --threads 32
+# python diamond_runner.py --fasta ./data/swissprot/2025_01/swissprot_2025_01.fasta \
+# --output ./data/swissprot/2025_01/diamond_swissprot_2025_01_alignment.tsv \
+# --previous_alignment ./data/swissprot/2024_01/diamond_swissprot_2024_01_alignment.tsv
@@ -7,6 +7,17 @@ from collections import defaultdict
 import tqdm
 import argparse
 import logging
+import beprof_eval
+import numpy as np
+from predictions import (
+    BINARY_EXTENSION,
+    NaivePredictions,
+    PredictionReader,
+    SparsePredictions,
+    is_binary_predictions,
+    iter_text_predictions,
+)
+from instrumentation import StageProfiler, StageTimer, stage
 
 
 def setup_logging(output_dir, aspect):
@@ -32,9 +43,92 @@ def setup_logging(output_dir, aspect):
     return logger
 
 
-def evaluate(logger, output_dir, dataset, aspect, k_values):
+def evaluate(
+    logger,
+    output_dir,
+    dataset,
+    aspect,
+    k_values,
+    predictions=None,
+    timer=None,
+    bootstrap=0,
+    confidence=0.95,
+    chunk_size=None,
+    exact=False,
+    stacked=False,
+):
     """
     Evaluate the predictions using the ground truth (GT) annotations and the BeProf evaluation method.
+    If predictions (dict of method name to SparsePredictions or prediction file path) are given, they are
+    evaluated in the current process; otherwise prediction files are read from output_dir.
+    The evaluation of each method is recorded as a stage 'evaluate_<method>' of timer (a StageTimer), if given.
+    If bootstrap is set, confidence intervals of the metrics are estimated from that many bootstrap replicates.
+    If chunk_size is set, in-process evaluation is streamed chunk_size proteins at a time (see evaluate_streaming).
+    If exact is set, Fmax is computed over every distinct predicted score instead of the thresholds c/100.
+    If stacked is set, in-process evaluation covers all methods in one batched pass (see evaluate_stacked).
+    """
+    if exact and chunk_size:
+        raise ValueError(
+            "Exact Fmax needs all predictions at once, and cannot be chunked."
+        )
+    if stacked and (exact or chunk_size):
+        raise ValueError("Stacked evaluation can be neither exact nor chunked.")
+    gt_pkl, background_pkl, go_obo_file = evaluation_files(logger, dataset, aspect)
+
+    if predictions is not None:
+        evaluate_in_memory(
+            logger,
+            predictions,
+            output_dir,
+            aspect,
+            gt_pkl,
+            background_pkl,
+            go_obo_file,
+            timer=timer,
+            bootstrap=bootstrap,
+            confidence=confidence,
+            chunk_size=chunk_size,
+            exact=exact,
+            stacked=stacked,
+        )
+        return
+
+    for method in ["NaiveBaseline", "IDScore", "AlignmentScore"] + [
+        f"BlastKNN_k{k}" for k in k_values
+    ]:
+        logger.info(f"Evaluating {method} predictions")
+        pred_file = find_prediction_file(output_dir, method)
+        pred_pkl = os.path.join(
+            os.path.dirname(pred_file),
+            os.path.basename(pred_file).split(".")[0] + ".pkl",
+        )
+        if os.path.exists(pred_file):
+            with stage(timer, f"evaluate_{method}") as record:
+                # Convert predictions to pkl
+                pred_dict = convert_predictions(pred_file, aspect)
+                with open(pred_pkl, "wb") as f:
+                    pickle.dump(pred_dict, f)
+                record["rows"] = len(pred_dict)
+
+                run_beprof_evaluation(
+                    logger,
+                    pred_pkl,
+                    gt_pkl,
+                    background_pkl,
+                    go_obo_file,
+                    f"{output_dir}/evaluation/{method}",
+                    bootstrap=bootstrap,
+                    confidence=confidence,
+                    exact=exact,
+                )
+        else:
+            logger.warning(f"{method} predictions file {pred_file} does not exist.")
+
+
+def evaluation_files(logger, dataset, aspect):
+    """
+    Paths of the ground truth pkl, background pkl and GO OBO files of a dataset.
+    The ground truth is converted from TSV if its pkl does not exist yet.
     """
     background_pkl = f"./data/{dataset}/background_{dataset}.pkl"
     go_obo_file = "./data/go.obo"
@@ -49,93 +143,295 @@ def evaluate(logger, output_dir, dataset, aspect, k_values):
         else:
             logger.error(f"Ground Truth TSV file {gt_tsv} does not exist.")
             raise FileNotFoundError(f"Ground Truth TSV file {gt_tsv} does not exist.")
+    return gt_pkl, background_pkl, go_obo_file
 
-    # Evaluate NaiveBaseline predictions
-    logger.info(f"Evaluating NaiveBaseline predictions")
-    pred_file = f"{output_dir}/predictions/NaiveBaseline/predictions.tsv"
-    pred_pkl = f"{output_dir}/predictions/NaiveBaseline/predictions.pkl"
-    if os.path.exists(pred_file):
-        pred_dict = convert_predictions(pred_file, aspect)
-        with open(pred_pkl, "wb") as f:
-            pickle.dump(pred_dict, f)
 
-        run_beprof_evaluation(
-            logger,
-            pred_pkl,
-            gt_pkl,
-            background_pkl,
-            go_obo_file,
-            f"{output_dir}/evaluation/NaiveBaseline",
+def prediction_file(output_dir, method, binary=False):
+    """
+    Path of the prediction file of a method ('NaiveBaseline', 'IDScore', 'AlignmentScore' or 'BlastKNN_k<k>'),
+    in the legacy TSV format or in the binary format.
+    """
+    extension = BINARY_EXTENSION if binary else ".tsv"
+    if method.startswith("BlastKNN_k"):
+        k = method[len("BlastKNN_k") :]
+        return f"{output_dir}/predictions/BlastKNN/k{k}_predictions{extension}"
+    return f"{output_dir}/predictions/{method}/predictions{extension}"
+
+
+def find_prediction_file(output_dir, method):
+    """
+    Path of the existing prediction file of a method, looking for the binary, TSV and gzipped TSV formats in turn.
+    Defaults to the TSV path if none exists.
+    """
+    for pred_file in [
+        prediction_file(output_dir, method, binary=True),
+        prediction_file(output_dir, method),
+        prediction_file(output_dir, method) + ".gz",
+    ]:
+        if os.path.exists(pred_file):
+            return pred_file
+    return prediction_file(output_dir, method)
+
+
+def evaluate_in_memory(
+    logger,
+    predictions,
+    output_dir,
+    aspect,
+    gt_pkl,
+    background_pkl,
+    go_obo_file,
+    timer=None,
+    bootstrap=0,
+    confidence=0.95,
+    chunk_size=None,
+    exact=False,
+    stacked=False,
+):
+    """
+    Evaluate predictions of every method with BeProf in the current process, without any intermediate file.
+    Predictions are SparsePredictions, NaivePredictions (evaluated by broadcasting their shared scores),
+    or paths to prediction files loaded one method at a time.
+    The ontology and its IC are computed once and shared by all methods.
+    If chunk_size is set, each method is evaluated chunk_size proteins at a time (see evaluate_streaming).
+    If stacked is set, all methods are evaluated in one batched pass (see evaluate_stacked).
+    """
+    subontology = aspect[:2].lower()
+    with stage(timer, "load_ontology"):
+        real_test_protein_mess = beprof_eval.read_pkl(gt_pkl)
+        go = beprof_eval.load_ontology(
+            go_obo_file, beprof_eval.read_pkl(background_pkl)
         )
-    else:
-        logger.warning(f"NaiveBaseline predictions file {pred_file} does not exist.")
-
-    # Evaluate IDScore predictions
-    logger.info(f"Evaluating IDScore predictions")
-    # Convert predictions to pkl
-    pred_file = f"{output_dir}/predictions/IDScore/predictions.tsv"
-    pred_pkl = f"{output_dir}/predictions/IDScore/predictions.pkl"
-    if os.path.exists(pred_file):
-        pred_dict = convert_predictions(pred_file, aspect)
-        with open(pred_pkl, "wb") as f:
-            pickle.dump(pred_dict, f)
-
-        run_beprof_evaluation(
+
+    if stacked:
+        evaluate_stacked(
             logger,
-            pred_pkl,
-            gt_pkl,
-            background_pkl,
-            go_obo_file,
-            f"{output_dir}/evaluation/IDScore",
+            predictions,
+            output_dir,
+            go,
+            real_test_protein_mess,
+            subontology,
+            timer=timer,
+            bootstrap=bootstrap,
+            confidence=confidence,
         )
+        return
+
+    for method, method_predictions in predictions.items():
+        logger.info(f"Evaluating {method} predictions")
+        with stage(timer, f"evaluate_{method}") as record:
+            eval_output_dir = f"{output_dir}/evaluation/{method}"
+            if chunk_size:
+                record["rows"] = evaluate_streaming(
+                    logger,
+                    method,
+                    method_predictions,
+                    eval_output_dir,
+                    go,
+                    real_test_protein_mess,
+                    subontology,
+                    chunk_size,
+                    bootstrap=bootstrap,
+                    confidence=confidence,
+                )
+                continue
+            if isinstance(method_predictions, str):
+                method_predictions = load_predictions(method_predictions)
+            record["rows"] = len(method_predictions)
+            if len(method_predictions) == 0:
+                logger.warning(f"No {method} predictions to evaluate.")
+                continue
+            os.makedirs(eval_output_dir, exist_ok=True)
+            if isinstance(method_predictions, NaivePredictions):
+                beprof_eval.evaluate_shared_predictions(
+                    method_predictions.proteins,
+                    method_predictions.term_scores(),
+                    eval_output_dir,
+                    go,
+                    real_test_protein_mess,
+                    subontology,
+                    bootstrap=bootstrap,
+                    confidence=confidence,
+                    exact=exact,
+                )
+            else:
+                beprof_eval.evaluate_predictions(
+                    method_predictions.to_beprof(subontology),
+                    eval_output_dir,
+                    go,
+                    real_test_protein_mess,
+                    subontology,
+                    bootstrap=bootstrap,
+                    confidence=confidence,
+                    exact=exact,
+                )
+        logger.info(f"Results saved to: {eval_output_dir}")
+
+
+def evaluate_stacked(
+    logger,
+    predictions,
+    output_dir,
+    go,
+    real_test_protein_mess,
+    subontology,
+    timer=None,
+    bootstrap=0,
+    confidence=0.95,
+):
+    """
+    Evaluate the predictions of every method (given as in evaluate_in_memory) in one batched pass with BeProf's
+    StackedEvaluator: the labels and IC weights are built once, and the metrics of all methods computed at once.
+    Building the predictions of each method is recorded as a stage 'evaluate_<method>', and the final pass
+    as a stage 'evaluate_stacked'.
+    """
+    evaluator = beprof_eval.StackedEvaluator(
+        go,
+        real_test_protein_mess,
+        subontology,
+        bootstrap=bootstrap,
+        confidence=confidence,
+    )
+    output_paths = {}
+    for method, method_predictions in predictions.items():
+        logger.info(f"Adding {method} predictions to the stacked evaluation")
+        with stage(timer, f"evaluate_{method}") as record:
+            if isinstance(method_predictions, str):
+                method_predictions = load_predictions(method_predictions)
+            record["rows"] = len(method_predictions)
+            if len(method_predictions) == 0:
+                logger.warning(f"No {method} predictions to evaluate.")
+                continue
+            if isinstance(method_predictions, NaivePredictions):
+                evaluator.add_shared_predictions(
+                    method,
+                    method_predictions.proteins,
+                    method_predictions.term_scores(),
+                )
+            else:
+                evaluator.add_predictions(
+                    method, method_predictions.to_beprof(subontology)
+                )
+        output_paths[method] = f"{output_dir}/evaluation/{method}"
+        os.makedirs(output_paths[method], exist_ok=True)
+
+    if output_paths:
+        with stage(timer, "evaluate_stacked") as record:
+            evaluator.finalize(output_paths)
+            record["rows"] = len(output_paths)
+        logger.info(f"Results saved to: {output_dir}/evaluation")
+
+
+def evaluate_streaming(
+    logger,
+    method,
+    predictions,
+    eval_output_dir,
+    go,
+    real_test_protein_mess,
+    subontology,
+    chunk_size,
+    bootstrap=0,
+    confidence=0.95,
+):
+    """
+    Evaluate the predictions of a method chunk_size proteins at a time with BeProf's StreamingEvaluator, so that
+    memory is bounded by the chunk size rather than by the number of proteins. Predictions are SparsePredictions,
+    NaivePredictions or the path of a prediction file, read chunk by chunk (see iter_protein_chunks).
+    Returns the number of predictions evaluated.
+    """
+    shared_predictions = None
+    if isinstance(predictions, NaivePredictions):
+        shared_predictions = predictions.term_scores()
+    evaluator = beprof_eval.StreamingEvaluator(
+        go,
+        real_test_protein_mess,
+        subontology,
+        shared_predictions=shared_predictions,
+        bootstrap=bootstrap,
+        confidence=confidence,
+    )
+    n_predictions = 0
+    if shared_predictions is not None:
+        for start in range(0, len(predictions.proteins), chunk_size):
+            evaluator.add_proteins(predictions.proteins[start : start + chunk_size])
+        n_predictions = len(predictions)
     else:
-        logger.warning(f"IDScore predictions file {pred_file} does not exist.")
-
-    # Evaluate AlignmentScore predictions
-    logger.info(f"Evaluating AlignmentScore predictions")
-    pred_file = f"{output_dir}/predictions/AlignmentScore/predictions.tsv"
-    pred_pkl = f"{output_dir}/predictions/AlignmentScore/predictions.pkl"
-    if os.path.exists(pred_file):
-        pred_dict = convert_predictions(pred_file, aspect)
-        with open(pred_pkl, "wb") as f:
-            pickle.dump(pred_dict, f)
-        run_beprof_evaluation(
-            logger,
-            pred_pkl,
-            gt_pkl,
-            background_pkl,
-            go_obo_file,
-            f"{output_dir}/evaluation/AlignmentScore",
+        if isinstance(predictions, str):
+            chunks = iter_protein_chunks(predictions, chunk_size)
+        else:
+            chunks = predictions.iter_batches(chunk_size)
+        for chunk in chunks:
+            evaluator.add_predictions(chunk.to_beprof(subontology))
+            n_predictions += len(chunk)
+    if n_predictions == 0:
+        logger.warning(f"No {method} predictions to evaluate.")
+        return 0
+    logger.info(f"Evaluated {evaluator.n_proteins} proteins by chunks of {chunk_size}")
+    os.makedirs(eval_output_dir, exist_ok=True)
+    evaluator.finalize(eval_output_dir)
+    logger.info(f"Results saved to: {eval_output_dir}")
+    return n_predictions
+
+
+def iter_protein_chunks(pred_file, chunk_size=1000):
+    """
+    Read a binary or TSV prediction file as SparsePredictions over chunks of chunk_size proteins, without loading
+    the whole file. The predictions of each protein must be contiguous, as in the files written by main.py.
+    """
+    if is_binary_predictions(pred_file):
+        reader = PredictionReader(pred_file)
+        rows = (
+            (reader.proteins[protein_codes], reader.terms[term_codes], scores)
+            for protein_codes, term_codes, scores in reader.iter_chunks()
         )
     else:
-        logger.warning(f"AlignmentScore predictions file {pred_file} does not exist.")
+        rows = iter_text_predictions(pred_file)
 
-    # Evaluate BlastKNN predictions for each k value
-    for k in k_values:
-        logger.info(f"Evaluating BlastKNN predictions for k={k}")
-        pred_file = f"{output_dir}/predictions/BlastKNN/k{k}_predictions.tsv"
-        pred_pkl = f"{output_dir}/predictions/BlastKNN/k{k}_predictions.pkl"
-        if os.path.exists(pred_file):
-            pred_dict = convert_predictions(pred_file, aspect)
-            with open(pred_pkl, "wb") as f:
-                pickle.dump(pred_dict, f)
-
-            run_beprof_evaluation(
-                logger,
-                pred_pkl,
-                gt_pkl,
-                background_pkl,
-                go_obo_file,
-                f"{output_dir}/evaluation/BlastKNN_k{k}",
-            )
-        else:
-            logger.warning(
-                f"BlastKNN predictions file {pred_file} for k={k} does not exist."
+    evaluated = set()
+
+    def chunk_of(df, proteins):
+        if evaluated.intersection(proteins):
+            raise ValueError(
+                f"Predictions of a protein are not contiguous in {pred_file}."
             )
+        evaluated.update(proteins)
+        return SparsePredictions.from_frame(df)
+
+    pending = None
+    for proteins, terms, scores in rows:
+        df = pd.DataFrame(
+            {
+                "target_ID": proteins,
+                "term_ID": terms,
+                "score": scores.astype(np.float64),
+            }
+        )
+        pending = df if pending is None else pd.concat([pending, df], ignore_index=True)
+        proteins = pending["target_ID"].unique()
+        # The last protein may go on in the next rows
+        while len(proteins) > chunk_size:
+            in_chunk = pending["target_ID"].isin(proteins[:chunk_size])
+            yield chunk_of(pending[in_chunk], proteins[:chunk_size])
+            pending = pending[~in_chunk]
+            proteins = proteins[chunk_size:]
+    if pending is not None:
+        proteins = pending["target_ID"].unique()
+        for start in range(0, len(proteins), chunk_size):
+            in_chunk = pending["target_ID"].isin(proteins[start : start + chunk_size])
+            yield chunk_of(pending[in_chunk], proteins[start : start + chunk_size])
 
 
 def run_beprof_evaluation(
-    logger, pred_pkl, gt_pkl, background_pkl, go_obo_file, eval_output_dir
+    logger,
+    pred_pkl,
+    gt_pkl,
+    background_pkl,
+    go_obo_file,
+    eval_output_dir,
+    bootstrap=0,
+    confidence=0.95,
+    exact=False,
 ):
     """
     Run beprof_eval.py as a subprocess.
@@ -157,7 +453,13 @@ def run_beprof_evaluation(
         go_obo_file,
         "--metrics",
         "0,1,2,3,4,5",  # All metrics: F_max, Smin, Aupr, ICAupr, DPAupr, threshold
+        "--bootstrap",
+        str(bootstrap),
+        "--confidence",
+        str(confidence),
     ]
+    if exact:
+        cmd.append("--exact")
 
     logger.info(f"Running BeProf evaluation: {' '.join(cmd)}")
 
@@ -223,12 +525,23 @@ def gt_convert(gt_tsv):
     print(f"Saved pickle file: {gt_pkl}")
 
 
+def load_predictions(pred_file):
+    """
+    Load a binary or TSV prediction file as SparsePredictions.
+    """
+    if is_binary_predictions(pred_file):
+        return PredictionReader(pred_file).read_predictions()
+    return SparsePredictions.from_frame(pd.read_csv(pred_file, sep="\t"))
+
+
 def convert_predictions(pred_file, aspect):
     """
-    Converts a TSV prediction file with columns: target_ID, term_ID
+    Converts a TSV prediction file with columns: target_ID, term_ID, or a binary prediction file,
     into a dictionary where each protein gets a 'bp' dictionary of GO term predictions.
     """
     subontology = aspect[:2].lower()
+    if is_binary_predictions(pred_file):
+        return PredictionReader(pred_file).read_predictions().to_beprof(subontology)
     df = pd.read_csv(pred_file, sep="\t")
     # Split term column by '; ' and explode
     df["term_ID"] = df["term_ID"].str.split("; ")
@@ -264,7 +577,104 @@ if __name__ == "__main__":
         default=[1, 3, 5, 10, 15, 20],
         help="List of k values for BlastKNN.",
     )
+    parser.add_argument(
+        "--profile",
+        choices=["cprofile", "sampling"],
+        default=None,
+        help="Profile the evaluation of each method (in the current process) with cProfile or by sampling call stacks. Reports are saved under <input_dir>/profiles.",
+    )
+    parser.add_argument(
+        "--profile_interval_ms",
+        type=float,
+        default=5.0,
+        help="Sampling interval of the sampling profiler (CPU time).",
+    )
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        default=0,
+        help="Number of bootstrap replicates (resampling proteins) of the confidence intervals of the metrics. No intervals if 0.",
+    )
+    parser.add_argument(
+        "--confidence",
+        type=float,
+        default=0.95,
+        help="Confidence level of the bootstrap intervals.",
+    )
+    parser.add_argument(
+        "--exact_fmax",
+        action="store_true",
+        help="Compute Fmax and Smin over every distinct predicted score instead of the thresholds 0, 0.01, ..., 1.",
+    )
+    parser.add_argument(
+        "--stacked_evaluation",
+        action="store_true",
+        help="Evaluate all methods (in the current process) in one batched pass, building the labels and IC weights once.",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=None,
+        help="Evaluate predictions (in the current process) by chunks of this many proteins, reading prediction files chunk by chunk, so that memory is bounded by the chunk size. Full evaluation if unset.",
+    )
     args = parser.parse_args()
+    if args.exact_fmax and args.chunk_size:
+        parser.error("--exact_fmax cannot be combined with --chunk_size.")
+    if args.stacked_evaluation and (args.exact_fmax or args.chunk_size):
+        parser.error(
+            "--stacked_evaluation cannot be combined with --exact_fmax or --chunk_size."
+        )
 
     logger = setup_logging(args.input_dir, args.aspect)
-    evaluate(logger, args.input_dir, args.dataset, args.aspect, args.k_values)
+    if args.profile or args.chunk_size or args.stacked_evaluation:
+        # Predictions are evaluated in the current process, for BeProf to be part of the profiles,
+        # to stream prediction files or to stack methods
+        profiler = None
+        if args.profile:
+            profiler = StageProfiler(
+                os.path.join(args.input_dir, "profiles"),
+                mode=args.profile,
+                interval_ms=args.profile_interval_ms,
+            )
+        timer = StageTimer(
+            os.path.join(args.input_dir, "logs", f"{args.aspect}_eval_stages.jsonl"),
+            profiler=profiler,
+            dataset=args.dataset,
+            aspect=args.aspect,
+        )
+        methods = ["NaiveBaseline", "IDScore", "AlignmentScore"] + [
+            f"BlastKNN_k{k}" for k in args.k_values
+        ]
+        predictions = {
+            method: find_prediction_file(args.input_dir, method) for method in methods
+        }
+        for method, pred_file in list(predictions.items()):
+            if not os.path.exists(pred_file):
+                logger.warning(f"{method} predictions file {pred_file} does not exist.")
+                del predictions[method]
+        evaluate(
+            logger,
+            args.input_dir,
+            args.dataset,
+            args.aspect,
+            args.k_values,
+            predictions=predictions,
+            timer=timer,
+            bootstrap=args.bootstrap,
+            confidence=args.confidence,
+            chunk_size=args.chunk_size,
+            exact=args.exact_fmax,
+            stacked=args.stacked_evaluation,
+        )
+        logger.info(f"Stage timings:\n{timer.summary().to_string(float_format='%.3f')}")
+    else:
+        evaluate(
+            logger,
+            args.input_dir,
+            args.dataset,
+            args.aspect,
+            args.k_values,
+            bootstrap=args.bootstrap,
+            confidence=args.confidence,
+            exact=args.exact_fmax,
+        )
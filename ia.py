@@ -7,6 +7,7 @@ import networkx as nx
 from collections import Counter
 from scipy.sparse import dok_matrix
 import tqdm
+from instrumentation import StageProfiler, StageTimer, stage
 
 
 def obsolete_terms(ontology):
@@ -181,12 +182,39 @@ def parse_inputs(argv):
         help="Compute IA for terms in this aspect only. If empty (default), IA will be computed for all terms",
     )
 
+    parser.add_argument(
+        "--profile",
+        choices=["cprofile", "sampling"],
+        default=None,
+        help="Profile the ontology loading, term propagation, term counting and IA computation with cProfile or by sampling call stacks",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        default="./profiles_ia",
+        help="Directory of the profiling reports (default ./profiles_ia)",
+    )
+    parser.add_argument(
+        "--profile_interval_ms",
+        type=float,
+        default=5.0,
+        help="Sampling interval of the sampling profiler (CPU time)",
+    )
+
     return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
 
     args = parse_inputs(sys.argv[1:])
+    timer = None
+    if args.profile:
+        timer = StageTimer(
+            profiler=StageProfiler(
+                args.profile_dir,
+                mode=args.profile,
+                interval_ms=args.profile_interval_ms,
+            )
+        )
 
     # IA should be computed using the same ontology version that was used for term propagation.
     # Otherwise, this may result in negative IA values.
@@ -213,16 +241,17 @@ if __name__ == "__main__":
         ontology_path = args.ontology
     else:
         ontology_path = "http://purl.obolibrary.org/obo/go/go.obo"
-    ontology_graph = clean_ontology_edges(
-        obonet.read_obo(
-            ontology_path,
-            ignore_obsolete=False,
+    with stage(timer, "load_ontology"):
+        ontology_graph = clean_ontology_edges(
+            obonet.read_obo(
+                ontology_path,
+                ignore_obsolete=False,
+            )
         )
-    )
-    roots = {"BPO": "GO:0008150", "CCO": "GO:0005575", "MFO": "GO:0003674"}
-    subontologies = {
-        aspect: fetch_aspect(ontology_graph, roots[aspect]) for aspect in roots
-    }
+        roots = {"BPO": "GO:0008150", "CCO": "GO:0005575", "MFO": "GO:0003674"}
+        subontologies = {
+            aspect: fetch_aspect(ontology_graph, roots[aspect]) for aspect in roots
+        }
     aspect = {
         "BPO": list(subontologies["BPO"].nodes),
         "CCO": list(subontologies["CCO"].nodes),
@@ -252,7 +281,8 @@ if __name__ == "__main__":
 
     if args.prop:
         print("Propagating Terms")
-        annotation_df = propagate_terms(annotation_df, subontologies)
+        with stage(timer, "propagate_terms"):
+            annotation_df = propagate_terms(annotation_df, subontologies)
 
     # Count term instances
     print("Counting Terms")
@@ -262,9 +292,10 @@ if __name__ == "__main__":
     for aspect, subont in subontologies.items():
         aspect_terms[aspect] = sorted(subont.nodes)  # ensure same order
         term_idx[aspect] = {t: i for i, t in enumerate(aspect_terms[aspect])}
-        aspect_counts[aspect] = term_counts(
-            annotation_df[annotation_df.aspect == aspect], term_idx[aspect]
-        )
+        with stage(timer, "term_counts"):
+            aspect_counts[aspect] = term_counts(
+                annotation_df[annotation_df.aspect == aspect], term_idx[aspect]
+            )
 
         assert aspect_counts[aspect].sum() == len(
             annotation_df[annotation_df.aspect == aspect]
@@ -280,10 +311,11 @@ if __name__ == "__main__":
         aspect: {t: 0 for t in aspect_terms[aspect]} for aspect in aspect_terms.keys()
     }
     for aspect, subontology in subontologies.items():
-        for term in aspect_ia[aspect].keys():
-            aspect_ia[aspect][term] = calc_ia(
-                term, sp_matrix[aspect], subontology, term_idx[aspect]
-            )
+        with stage(timer, "calc_ia"):
+            for term in aspect_ia[aspect].keys():
+                aspect_ia[aspect][term] = calc_ia(
+                    term, sp_matrix[aspect], subontology, term_idx[aspect]
+                )
 
     ia_df = pd.concat(
         [
@@ -315,6 +347,9 @@ if __name__ == "__main__":
         args.outfile = f"./data/{args.dataset}/IC_{args.dataset}.tsv"
     print(f"Saving to file {args.outfile}")
     ia_df[["term", "ic"]].to_csv(args.outfile, header=None, sep="\t", index=False)
+    if timer is not None:
+        print(f"Profiles saved to {args.profile_dir}")
+        print(timer.summary().to_string(float_format="%.3f"))
 
 # Example usage:
 # python ia.py --annot ./data/swissprot/2024_01/swissprot_2024_01_BPO_exp_annotations.tsv --dataset H30 --ontology ./data/go.obo --aspect BPO
@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import pstats
+import signal
+import cProfile
+import argparse
+import resource
+import contextlib
+import collections
+import pandas as pd
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS of the process (Linux only), so that the peak of each stage can be measured.
+    Returns whether the peak could be reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """Peak RSS of the process in MB, since the last reset_peak_rss."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageProfiler(object):
+    """
+    Profile stages, writing one report per stage to profile_dir:
+    - 'cprofile': deterministic profile of function calls, saved as <stage>.prof (for pstats, snakeviz, ...) along
+      with <stage>.txt listing the functions with the highest cumulative time.
+    - 'sampling': call stacks (function and line of each frame) sampled every interval_ms of CPU time, saved in
+      the collapsed stack format of flame graphs as <stage>.folded (for flamegraph.pl, speedscope, ...).
+    Repeated stages accumulate in the same report. A cProfile profile only covers the outermost stage at a time
+    (nested stages are part of it), while samples are counted for every open stage.
+    """
+
+    def __init__(self, profile_dir, mode="cprofile", interval_ms=5.0):
+        if mode not in ("cprofile", "sampling"):
+            raise ValueError(f"Unknown profiling mode {mode}")
+        self.profile_dir = profile_dir
+        self.mode = mode
+        self.interval = interval_ms / 1000
+        self.profiles = {}
+        self.stacks = collections.defaultdict(collections.Counter)
+        self.open_stages = []
+        os.makedirs(profile_dir, exist_ok=True)
+
+    def start(self, name):
+        self.open_stages.append(name)
+        if len(self.open_stages) > 1:
+            return
+        if self.mode == "cprofile":
+            self.profiles.setdefault(name, cProfile.Profile()).enable()
+        else:
+            self.previous_handler = signal.signal(signal.SIGPROF, self.sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(
+                f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+            )
+            frame = frame.f_back
+        stack = ";".join(reversed(stack))
+        for name in set(self.open_stages):
+            self.stacks[name][stack] += 1
+
+    def stop(self, name):
+        self.open_stages.pop()
+        path = os.path.join(self.profile_dir, name)
+        if self.mode == "sampling":
+            if not self.open_stages:
+                signal.setitimer(signal.ITIMER_PROF, 0)
+                signal.signal(signal.SIGPROF, self.previous_handler)
+            with open(path + ".folded", "w") as f:
+                for stack, count in self.stacks[name].most_common():
+                    f.write(f"{stack} {count}\n")
+        elif not self.open_stages:
+            profile = self.profiles[name]
+            profile.disable()
+            profile.dump_stats(path + ".prof")
+            with open(path + ".txt", "w") as f:
+                pstats.Stats(profile, stream=f).sort_stats("cumulative").print_stats(50)
+
+
+class StageTimer(object):
+    """
+    Record the wall time, CPU time, peak RSS and output size of pipeline stages.
+    Every stage is appended as a JSON line to path (if given), along with the context fields
+    (e.g. dataset, db_version and aspect). Stages are also profiled by profiler (a StageProfiler), if given.
+    """
+
+    def __init__(self, path=None, profiler=None, **context):
+        self.path = path
+        self.profiler = profiler
+        self.context = context
+        self.records = []
+        self.open_peaks = []  # Peak RSS of the enclosing stages, for nested stages
+        if path is not None:
+            open(path, "w").close()
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        """
+        Time the enclosed code as stage name. The yielded dict can be given more fields, such as the number of
+        rows produced by the stage ('rows').
+        """
+        record = dict(fields)
+        # Peak RSS is measured per stage when the kernel allows it, or over the whole process otherwise.
+        # The peak reached so far is kept for the enclosing stages before it is reset.
+        self.open_peaks = [max(peak, peak_rss_mb()) for peak in self.open_peaks]
+        per_stage_peak = reset_peak_rss()
+        self.open_peaks.append(0.0)
+        if self.profiler is not None:
+            self.profiler.start(name)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            if self.profiler is not None:
+                self.profiler.stop(name)
+            peak = max(self.open_peaks.pop(), peak_rss_mb())
+            self.open_peaks = [max(p, peak) for p in self.open_peaks]
+            record = {
+                **self.context,
+                "stage": name,
+                "wall_time": wall,
+                "cpu_time": cpu,
+                "peak_rss_mb": peak,
+                "process_peak": not per_stage_peak,
+                **record,
+            }
+            self.records.append(record)
+            if self.path is not None:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+
+    def summary(self, by=()):
+        """
+        Summary table of the recorded stages: number of calls, total wall and CPU times, maximum peak RSS and total
+        rows of each stage, grouped by the given context fields.
+        """
+        return summary_table(self.records, by=by)
+
+
+def stage(timer, name, **fields):
+    """Stage of a StageTimer, or a context doing nothing if timer is None."""
+    if timer is None:
+        return contextlib.nullcontext(dict(fields))
+    return timer.stage(name, **fields)
+
+
+def summary_table(records, by=()):
+    """
+    Aggregate stage records (e.g. read from the JSON lines of several runs) per stage, in order of first occurrence.
+    """
+    records = pd.DataFrame(records)
+    if records.empty:
+        return records
+    if "rows" not in records:
+        records["rows"] = float("nan")
+    keys = list(by) + ["stage"]
+    return records.groupby(keys, sort=False).agg(
+        calls=("stage", "size"),
+        wall_time=("wall_time", "sum"),
+        cpu_time=("cpu_time", "sum"),
+        peak_rss_mb=("peak_rss_mb", "max"),
+        rows=("rows", lambda rows: rows.sum(min_count=1)),
+    )
+
+
+def read_records(paths):
+    """Read the stage records of JSON lines files."""
+    records = []
+    for path in paths:
+        with open(path) as f:
+            records += [json.loads(line) for line in f if line.strip()]
+    return records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Summarize the stage timings (JSON lines) of pipeline runs."
+    )
+    parser.add_argument("files", nargs="+", help="Stage JSON lines files.")
+    parser.add_argument(
+        "--by",
+        nargs="*",
+        default=["db_version", "aspect"],
+        help="Fields to group stages by.",
+    )
+    args = parser.parse_args()
+    print(
+        summary_table(read_records(args.files), by=args.by).to_string(
+            float_format="%.3f"
+        )
+    )
+
+# Example usage:
+# python instrumentation.py ./results/ATGO/*/logs/*_stages.jsonl --by aspect
@@ -7,6 +7,10 @@ from constants import *
 from dataloading import *
 import methods
 import evaluation
+from predictions import open_prediction_writer
+from prediction_cache import PredictionCache
+from stage_cache import StageCache, cached_stage, cached_stages
+from instrumentation import StageProfiler, StageTimer, summary_table
 
 
 def setup_logging(output_dir, aspect):
@@ -33,6 +37,267 @@ def setup_logging(output_dir, aspect):
     return logger
 
 
+def parse_pruning(top_n_args, min_score_args):
+    """
+    Parse pruning arguments ('<value>' or '<method>=<value>') into the per-method settings used by
+    methods.transfer_annotations, e.g. {'*': {'top_n': 500}, 'AlignmentScore': {'min_score': 0.01}}.
+    """
+    pruning = {}
+    for setting, values, cast in [
+        ("top_n", top_n_args, int),
+        ("min_score", min_score_args, float),
+    ]:
+        for value in values:
+            method, _, value = value.rpartition("=")
+            pruning.setdefault(method or "*", {})[setting] = cast(value)
+    # Method-specific settings complete the ones applying to all methods
+    for method in pruning:
+        if method != "*":
+            pruning[method] = {**pruning.get("*", {}), **pruning[method]}
+    return pruning
+
+
+def export_predictions(output_dir, batches, binary=True, compression=None):
+    """
+    Write batches of predictions ({method: SparsePredictions}) to one prediction file per method.
+    Returns a dict mapping each method to its prediction file path and number of written predictions.
+    """
+    writers = {}
+    try:
+        for batch in batches:
+            for method, method_predictions in batch.items():
+                if method not in writers:
+                    pred_file = evaluation.prediction_file(
+                        output_dir, method, binary=binary
+                    )
+                    os.makedirs(os.path.dirname(pred_file), exist_ok=True)
+                    writers[method] = open_prediction_writer(
+                        pred_file, compression=compression
+                    )
+                writers[method].write_predictions(method_predictions)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return {method: (writer.path, len(writer)) for method, writer in writers.items()}
+
+
+def job_output_dir(args, db_version, aspect):
+    """Output directory of the job of a SwissProt version and aspect."""
+    output_dir = f"./results/{args.dataset}/baselines_{args.dataset}_{db_version}_{aspect}{args.output_suffix}"
+    if args.experimental_only:
+        output_dir += "_exp"
+    if args.annotations_2024_01:
+        output_dir += "_2024_annotations"
+    if args.one_vs_all:
+        output_dir += "_one_vs_all"
+    return output_dir
+
+
+def leakage_report_file(args, db_version, aspect):
+    """Path of the report of hits on test proteins removed from a job (unless one-vs-all)."""
+    return os.path.join(
+        job_output_dir(args, db_version, aspect),
+        f"leakage_report_{args.dataset}_{db_version}_{aspect}.tsv",
+    )
+
+
+def source_files(*modules):
+    """Paths of the source files of the given modules of this package."""
+    return [
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{module}.py")
+        for module in modules
+    ]
+
+
+def stage_keys(stage_cache, args, db_version, aspect, pruning):
+    """
+    Keys of the cached stages of a job (see StageCache.fingerprint), in the order they run. Each stage is keyed by
+    its input files, the code it runs, its parameters and the keys of the stages it depends on, so that the keys
+    of all stages are known before running any of them.
+    """
+    mapping_file = "./data/swissprot/2024_01/swissprot_2024_01_annotations.tsv"
+    keys = {}
+    keys["load_data"] = stage_cache.fingerprint(
+        "load_data",
+        files=data_files(
+            args.dataset,
+            aspect,
+            db_version,
+            annotations_2024_01=args.annotations_2024_01,
+            experimental_only=args.experimental_only,
+        )
+        + [mapping_file]
+        + source_files("dataloading"),
+        dataset=args.dataset,
+        aspect=aspect,
+        db_version=db_version,
+        annotations_2024_01=args.annotations_2024_01,
+        experimental_only=args.experimental_only,
+        one_vs_all=args.one_vs_all,
+    )
+    keys["prepare_transfer"] = stage_cache.fingerprint(
+        "prepare_transfer",
+        files=[args.alignment_dir, mapping_file]
+        + source_files("dataloading", "alignment_store", "methods"),
+        depends=[keys["load_data"]],
+        max_evalue=args.max_evalue,
+        min_identity=args.min_identity,
+        min_coverage=args.min_coverage,
+        max_hits_per_query=args.max_hits_per_query,
+        one_vs_all=args.one_vs_all,
+    )
+    method_keys = {
+        method: stage_cache.fingerprint(
+            "score",
+            files=source_files("methods", "predictions"),
+            depends=[keys["prepare_transfer"]],
+            method=method,
+            pruning=methods.method_pruning(pruning, method),
+        )
+        for method in methods.method_names(args.k_values)
+    }
+    if not args.skip_naive:
+        method_keys["NaiveBaseline"] = stage_cache.fingerprint(
+            "naive_baseline",
+            files=source_files("methods", "predictions"),
+            depends=[keys["load_data"]],
+        )
+    for method, key in method_keys.items():
+        keys["naive_baseline" if method == "NaiveBaseline" else f"score_{method}"] = key
+    # The ground truth pkl is converted from its TSV by the first evaluation (see evaluation.evaluation_files):
+    # only the TSV is fingerprinted, unless the pkl is given alone
+    gt_file = f"./data/{args.dataset}/{args.dataset}_{aspect}_test_annotations.tsv"
+    if not os.path.exists(gt_file):
+        gt_file = os.path.splitext(gt_file)[0] + ".pkl"
+    evaluation_inputs = [
+        gt_file,
+        f"./data/{args.dataset}/background_{args.dataset}.pkl",
+        "./data/go.obo",
+    ]
+    for method, key in method_keys.items():
+        keys[f"evaluate_{method}"] = stage_cache.fingerprint(
+            "evaluate",
+            files=evaluation_inputs
+            + source_files("evaluation", "beprof_eval", "predictions"),
+            depends=[key],
+            bootstrap=args.bootstrap,
+            confidence=args.confidence,
+            exact=args.exact_fmax,
+            chunk_size=args.eval_chunk_size,
+            stacked=args.stacked_evaluation,
+            stream_predictions=args.stream_predictions,
+        )
+    return keys
+
+
+def load_alignment(logger, args, timer, train, test, id_mapping):
+    """
+    Load the pairwise alignments (from their store, see load_pairwise_alignment), restricted to hits of test
+    proteins on training proteins.
+    """
+    logger.info("Loading pairwise alignments...")
+    with timer.stage("load_pairwise_alignment") as record:
+        pairwise_alignment = load_pairwise_alignment(
+            args.dataset,
+            id_mapping=id_mapping,
+            alignment_file=args.alignment_dir,
+            chunk_size=args.ingest_chunk_size,
+            max_evalue=args.max_evalue,
+            min_identity=args.min_identity,
+            min_coverage=args.min_coverage,
+            max_hits_per_query=args.max_hits_per_query,
+        )
+        record["rows"] = len(pairwise_alignment)
+    if "truncation" in pairwise_alignment.metadata:
+        logger.info(
+            f"Alignment truncated to the top hits of each query: {pairwise_alignment.metadata['truncation']}"
+        )
+
+    with timer.stage("restrict_alignment") as record:
+        pairwise_alignment = pairwise_alignment.restrict(
+            queries=test["EntryID"].unique(),
+            subjects=train["EntryID"].unique(),
+        )
+        record["rows"] = len(pairwise_alignment)
+
+    logger.info(f"Loaded {len(pairwise_alignment)} pairwise alignments")
+    return pairwise_alignment
+
+
+def load_all_aspects(logger, args, db_version, id_mapping):
+    """Load the data of every aspect of a SwissProt version, as a dict mapping each aspect to (train, test)."""
+    return {
+        aspect: load_data(
+            logger,
+            args.dataset,
+            aspect,
+            db_version,
+            annotations_2024_01=args.annotations_2024_01,
+            id_mapping=id_mapping,
+            experimental_only=args.experimental_only,
+            one_vs_all=args.one_vs_all,
+        )
+        for aspect in args.aspects
+    }
+
+
+def transfer_all_aspects(logger, args, timer, db_version, id_mapping, pruning, data):
+    """
+    Transfer annotations to the test proteins of all aspects of a SwissProt version in a single pass over the
+    alignment hits (see methods.multi_aspect_transfer_annotations), given the data of every aspect
+    (see load_all_aspects).
+    Returns a dict mapping each aspect to its unaligned test protein IDs and predictions.
+    """
+    trains = {aspect: train for aspect, (train, _) in data.items()}
+    tests = {aspect: test for aspect, (_, test) in data.items()}
+    leakage_files = {}
+    for aspect in data:
+        leakage_files[aspect] = leakage_report_file(args, db_version, aspect)
+        os.makedirs(os.path.dirname(leakage_files[aspect]), exist_ok=True)
+        if os.path.exists(leakage_files[aspect]):
+            os.remove(leakage_files[aspect])  # Stale report of a previous run
+    pairwise_alignment = load_alignment(
+        logger,
+        args,
+        timer,
+        pd.concat(trains.values()),
+        pd.concat(tests.values()),
+        id_mapping,
+    )
+    return methods.multi_aspect_transfer_annotations(
+        logger,
+        pairwise_alignment,
+        trains,
+        tests,
+        args.k_values,
+        one_vs_all=args.one_vs_all,
+        pruning=pruning,
+        leakage_files=leakage_files,
+        timer=timer,
+    )
+
+
+def read_outputs(directory):
+    """Contents of the files of a directory, as a dict mapping file names to bytes."""
+    outputs = {}
+    if os.path.isdir(directory):
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                with open(path, "rb") as f:
+                    outputs[name] = f.read()
+    return outputs
+
+
+def write_outputs(directory, outputs):
+    """Write files read by read_outputs back to a directory."""
+    if outputs:
+        os.makedirs(directory, exist_ok=True)
+    for name, content in outputs.items():
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(content)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Run baseline annotation transfer methods."
@@ -87,6 +352,157 @@ def main():
         help="Whether to use only experimental annotations.",
     )
 
+    parser.add_argument(
+        "--skip_naive",
+        action="store_true",
+        help="Skip the Naive baseline.",
+    )
+    parser.add_argument(
+        "--export_predictions",
+        action="store_true",
+        help="Also write predictions to files (evaluation is run in memory).",
+    )
+    parser.add_argument(
+        "--export_format",
+        type=str,
+        choices=["binary", "tsv"],
+        default="binary",
+        help="Format of exported predictions: compact binary format or legacy TSV.",
+    )
+    parser.add_argument(
+        "--stream_predictions",
+        action="store_true",
+        help="Compute predictions by batches of test proteins and stream them to files, to bound memory usage.",
+    )
+    parser.add_argument(
+        "--ingest_chunk_size",
+        type=int,
+        default=1_000_000,
+        help="Number of alignment rows read at a time when building the alignment store.",
+    )
+    parser.add_argument(
+        "--max_evalue",
+        type=float,
+        default=None,
+        help="Drop alignment hits with an e-value above this value.",
+    )
+    parser.add_argument(
+        "--min_identity",
+        type=float,
+        default=None,
+        help="Drop alignment hits with a percent identity below this value.",
+    )
+    parser.add_argument(
+        "--min_coverage",
+        type=float,
+        default=None,
+        help="Drop alignment hits covering less than this percentage of the query or subject sequence.",
+    )
+    parser.add_argument(
+        "--max_hits_per_query",
+        type=int,
+        default=None,
+        help="Keep only the top hits of each query by bit score when building the alignment store.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1000,
+        help="Number of test proteins per batch when streaming predictions.",
+    )
+    parser.add_argument(
+        "--compress_predictions",
+        action="store_true",
+        help="Compress exported predictions (zlib chunks for the binary format, gzip for TSV).",
+    )
+
+    parser.add_argument(
+        "--multi_aspect",
+        action="store_true",
+        help="Score the test proteins of all aspects in a single pass over the alignment hits, with one annotation matrix covering the terms of all aspects. Results are still saved per aspect.",
+    )
+
+    parser.add_argument(
+        "--prune_top_n",
+        type=str,
+        nargs="+",
+        default=[],
+        help="Keep only the N best terms per protein, e.g. '500' for all methods or 'AlignmentScore=500 BlastKNN=200'.",
+    )
+    parser.add_argument(
+        "--prune_min_score",
+        type=str,
+        nargs="+",
+        default=[],
+        help="Drop scores below a floor, e.g. '0.01' for all methods or 'AlignmentScore=0.01'.",
+    )
+
+    parser.add_argument(
+        "--prediction_cache_dir",
+        type=str,
+        default=None,
+        help="Directory of the on-disk cache of per-query predictions, reused across runs. No cache if unset.",
+    )
+    parser.add_argument(
+        "--prediction_cache_size",
+        type=int,
+        default=1_000_000,
+        help="Maximum number of per-query predictions kept in memory by the prediction cache.",
+    )
+
+    parser.add_argument(
+        "--stage_cache_dir",
+        type=str,
+        default=None,
+        help="Directory of the cache of stage outputs (loaded data, encoded alignments, predictions and evaluation results of each method), keyed by their input files and parameters, so that reruns only run the stages whose inputs changed. No cache if unset.",
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Only list the stages of each job that would run or be loaded from the stage cache.",
+    )
+
+    parser.add_argument(
+        "--profile",
+        choices=["cprofile", "sampling"],
+        default=None,
+        help="Profile every stage with cProfile or by sampling call stacks; reports are saved under <output_dir>/profiles.",
+    )
+    parser.add_argument(
+        "--profile_interval_ms",
+        type=float,
+        default=5.0,
+        help="Sampling interval of the sampling profiler (CPU time).",
+    )
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        default=0,
+        help="Number of bootstrap replicates (resampling test proteins) of the confidence intervals of the evaluation metrics. No intervals if 0.",
+    )
+    parser.add_argument(
+        "--confidence",
+        type=float,
+        default=0.95,
+        help="Confidence level of the bootstrap intervals.",
+    )
+    parser.add_argument(
+        "--exact_fmax",
+        action="store_true",
+        help="Compute Fmax and Smin over every distinct predicted score instead of the thresholds 0, 0.01, ..., 1.",
+    )
+    parser.add_argument(
+        "--stacked_evaluation",
+        action="store_true",
+        help="Evaluate all methods in one batched pass, building the labels and IC weights of the test proteins once.",
+    )
+    parser.add_argument(
+        "--eval_chunk_size",
+        type=int,
+        default=None,
+        help="Evaluate predictions by chunks of this many test proteins (prediction files are read chunk by chunk), so that evaluation memory is bounded by the chunk size. Full evaluation if unset.",
+    )
+
     parser.add_argument(
         "--stringdb",
         action="store_true",
@@ -94,91 +510,261 @@ def main():
     )
 
     args = parser.parse_args()
+    if args.exact_fmax and args.eval_chunk_size:
+        parser.error("--exact_fmax cannot be combined with --eval_chunk_size.")
+    if args.stacked_evaluation and (args.exact_fmax or args.eval_chunk_size):
+        parser.error(
+            "--stacked_evaluation cannot be combined with --exact_fmax or --eval_chunk_size."
+        )
+    if args.stage_cache_dir and args.stream_predictions:
+        parser.error("--stage_cache_dir cannot be combined with --stream_predictions.")
+    if args.multi_aspect and (
+        args.stream_predictions or args.prediction_cache_dir or args.stage_cache_dir
+    ):
+        parser.error(
+            "--multi_aspect cannot be combined with --stream_predictions, --prediction_cache_dir or --stage_cache_dir."
+        )
+    if args.dry_run and not args.stage_cache_dir:
+        parser.error("--dry_run requires --stage_cache_dir.")
+
+    pruning = parse_pruning(args.prune_top_n, args.prune_min_score)
+    compression = "zlib" if args.compress_predictions else None
+    if args.compress_predictions and args.export_format == "tsv":
+        compression = "gzip"
+
+    cache = None
+    if args.prediction_cache_dir is not None:
+        cache = PredictionCache(
+            args.prediction_cache_dir, max_entries=args.prediction_cache_size
+        )
+
+    stage_cache = None
+    if args.stage_cache_dir is not None:
+        stage_cache = StageCache(args.stage_cache_dir)
+
+    stage_records = []  # Stage timings of every job, summarized at the end of the run
 
     # Mapping from SwissProt Entry Name (e.g. Q6GZX1) to EntryID (004R_FRG3G)
     id_mapping = load_uniprot_mapping()
 
     for db_version in tqdm.tqdm(args.db_versions, desc="Processing databases"):
+        multi_aspect = {}  # Predictions of the aspects scored along a previous one
+        # Data of all aspects, loaded with the first one (multi-aspect)
+        aspect_data = {}
         for aspect in args.aspects:
 
-            output_dir = f"./results/{args.dataset}/baselines_{args.dataset}_{db_version}_{aspect}{args.output_suffix}"
-            if args.experimental_only:
-                output_dir += "_exp"
-            if args.annotations_2024_01:
-                output_dir += "_2024_annotations"
-            if args.one_vs_all:
-                output_dir += "_one_vs_all"
-            os.makedirs(f"{output_dir}/predictions", exist_ok=True)
+            output_dir = job_output_dir(args, db_version, aspect)
+
+            # Stage keys (empty without stage cache)
+            keys = {}
+            if stage_cache is not None:
+                keys = stage_keys(stage_cache, args, db_version, aspect, pruning)
+            if args.dry_run:
+                print(f"{output_dir}:")
+                for stage, key in keys.items():
+                    status = "cached" if stage_cache.has(stage, key) else "run"
+                    print(f"  {status:<6} {stage} ({key[:12]})")
+                continue
+            os.makedirs(output_dir, exist_ok=True)
+
+            if cache is not None:
+                cache.reset_stats()  # Prediction cache stats are reported per job
 
             # Setup logging for this aspect
             logger = setup_logging(output_dir, aspect)
             logger.info(
                 f"Starting processing for {aspect} with database version {db_version}"
             )
+            # Wall time, CPU time, peak RSS and rows of each stage, saved as JSON lines next to the logs
+            profiler = None
+            if args.profile:
+                profiler = StageProfiler(
+                    os.path.join(output_dir, "profiles"),
+                    mode=args.profile,
+                    interval_ms=args.profile_interval_ms,
+                )
+            timer = StageTimer(
+                os.path.join(output_dir, "logs", f"{aspect}_stages.jsonl"),
+                profiler=profiler,
+                dataset=args.dataset,
+                db_version=db_version,
+                aspect=aspect,
+            )
 
             # Load data
             logger.info(f"Loading data for {args.dataset} with aspect {aspect}")
-            train, test = load_data(
-                logger,
-                args.dataset,
-                aspect,
-                db_version,
-                annotations_2024_01=args.annotations_2024_01,
-                id_mapping=id_mapping,
-                experimental_only=args.experimental_only,
-                one_vs_all=args.one_vs_all,
-            )
+            with timer.stage("load_data") as record:
+                if args.multi_aspect:
+                    if aspect not in aspect_data:
+                        aspect_data = load_all_aspects(
+                            logger, args, db_version, id_mapping
+                        )
+                    train, test = aspect_data[aspect]
+                else:
+                    train, test = cached_stage(
+                        stage_cache,
+                        "load_data",
+                        keys.get("load_data"),
+                        lambda: load_data(
+                            logger,
+                            args.dataset,
+                            aspect,
+                            db_version,
+                            annotations_2024_01=args.annotations_2024_01,
+                            id_mapping=id_mapping,
+                            experimental_only=args.experimental_only,
+                            one_vs_all=args.one_vs_all,
+                        ),
+                    )
+                record["rows"] = len(train)
+                record["test_rows"] = len(test)
             logger.info(
                 f"Loaded {train['EntryID'].nunique()} training proteins and {test['EntryID'].nunique()} test proteins"
             )
             logger.info(f"One-vs-All approach: {args.one_vs_all}.")
             logger.info(f"Experimental annotations only: {args.experimental_only}")
             logger.info(f"SwissProt 2024 annotations: {args.annotations_2024_01}")
+            if pruning:
+                logger.info(f"Prediction pruning: {pruning}")
             logger.info(f"Output directory: {output_dir}")
             logger.info(f"Train set:\n{train}")
             logger.info(f"Test set:\n{test}")
 
-            # Comment out to skip Naive Baseline
-            # logger.info("Running Naive Baseline...")
-            # os.makedirs(f"{output_dir}/predictions/NaiveBaseline", exist_ok=True)
-            # methods.naive_baseline(output_dir, train, test)
-            # logger.info(f"Naive Baseline predictions saved to {output_dir}/predictions")
-            # ---
-
-            logger.info("Loading pairwise alignments...")
-            pairwise_alignment = load_pairwise_alignment(
-                args.dataset,
-                id_mapping=id_mapping,
-            )
-
-            pairwise_alignment = pairwise_alignment[
-                pairwise_alignment["query_id"].isin(test["EntryID"].unique())
-                & pairwise_alignment["subject_id"].isin(train["EntryID"].unique())
-            ]
-
-            if not args.one_vs_all:
-                logger.info(f"Removing test proteins from alignment subjects...")
-                pairwise_alignment = pairwise_alignment[
-                    ~pairwise_alignment["subject_id"].isin(test["EntryID"].unique())
-                ]
-
-            logger.info(f"Loaded {len(pairwise_alignment)} pairwise alignments")
-
             logger.info("Running alignment-based methods...")
-            os.makedirs(f"{output_dir}/predictions/AlignmentScore", exist_ok=True)
-            os.makedirs(f"{output_dir}/predictions/BlastKNN", exist_ok=True)
-            os.makedirs(f"{output_dir}/predictions/IDScore", exist_ok=True)
-            unaligned_protein_ids, ascore_pred, blastknn_preds_dict, idscore_pred = (
-                methods.transfer_annotations(
+            # Hits on test proteins are removed, and reported here (unless one-vs-all)
+            leakage_file = leakage_report_file(args, db_version, aspect)
+            if os.path.exists(leakage_file) and aspect not in multi_aspect:
+                os.remove(leakage_file)  # Stale report of a previous run
+            if args.stream_predictions:
+                # Predictions are written batch by batch and evaluated from files
+                unaligned_protein_ids, batches = methods.stream_transfer_annotations(
                     logger,
-                    pairwise_alignment,
+                    load_alignment(logger, args, timer, train, test, id_mapping),
                     train,
                     test,
                     args.k_values,
                     one_vs_all=args.one_vs_all,
+                    batch_size=args.batch_size,
+                    pruning=pruning,
+                    leakage_file=leakage_file,
+                    cache=cache,
+                    timer=timer,
                 )
-            )
+                # Batches are scored as they are written: this stage includes the scoring stages
+                with timer.stage("transfer_and_export_predictions") as record:
+                    exported = export_predictions(
+                        output_dir,
+                        batches,
+                        binary=args.export_format == "binary",
+                        compression=compression,
+                    )
+                    record["rows"] = sum(count for _, count in exported.values())
+                predictions = {method: path for method, (path, _) in exported.items()}
+                counts = {method: count for method, (_, count) in exported.items()}
+            else:
+
+                def prepare():
+                    # The leakage report is kept along the encoded hits, to be restored with them
+                    prepared = methods.prepare_transfer(
+                        logger,
+                        load_alignment(logger, args, timer, train, test, id_mapping),
+                        train,
+                        test,
+                        one_vs_all=args.one_vs_all,
+                        leakage_file=leakage_file,
+                    )
+                    leakage = None
+                    if os.path.exists(leakage_file):
+                        leakage = pd.read_csv(leakage_file, sep="\t")
+                    return prepared, leakage
+
+                def score(stages):
+                    scored = methods.score_hits(
+                        hits,
+                        annotations,
+                        queries,
+                        terms,
+                        args.k_values,
+                        pruning=pruning,
+                        cache=cache,
+                        timer=timer,
+                        only=[stage[len("score_") :] for stage in stages],
+                    )
+                    return {f"score_{method}": p for method, p in scored.items()}
+
+                with timer.stage("transfer_annotations") as record:
+                    if args.multi_aspect:
+                        # All aspects are scored in a single pass over the hits, with the first one
+                        if aspect not in multi_aspect:
+                            multi_aspect = transfer_all_aspects(
+                                logger,
+                                args,
+                                timer,
+                                db_version,
+                                id_mapping,
+                                pruning,
+                                aspect_data,
+                            )
+                        unaligned_protein_ids, predictions = multi_aspect.pop(aspect)
+                    else:
+                        (
+                            (queries, terms, annotations, hits, unaligned_protein_ids),
+                            leakage,
+                        ) = cached_stage(
+                            stage_cache,
+                            "prepare_transfer",
+                            keys.get("prepare_transfer"),
+                            prepare,
+                        )
+                        if leakage is not None and not os.path.exists(leakage_file):
+                            leakage.to_csv(leakage_file, sep="\t", index=False)
+                        scored = cached_stages(
+                            stage_cache,
+                            {
+                                f"score_{method}": keys.get(f"score_{method}")
+                                for method in methods.method_names(args.k_values)
+                            },
+                            score,
+                        )
+                        predictions = {
+                            stage[len("score_") :]: p for stage, p in scored.items()
+                        }
+                    counts = {method: len(p) for method, p in predictions.items()}
+                    record["rows"] = sum(counts.values())
+                if args.export_predictions:
+                    with timer.stage("export_predictions") as record:
+                        export_predictions(
+                            output_dir,
+                            [predictions],
+                            binary=args.export_format == "binary",
+                            compression=compression,
+                        )
+                        record["rows"] = sum(counts.values())
+
+            if not args.skip_naive:
+                # Naive scores are a single term frequency vector shared by all test proteins
+                logger.info("Running Naive Baseline...")
+                with timer.stage("naive_baseline") as record:
+                    predictions["NaiveBaseline"] = cached_stage(
+                        stage_cache,
+                        "naive_baseline",
+                        keys.get("naive_baseline"),
+                        lambda: methods.naive_baseline(train, test),
+                    )
+                    counts["NaiveBaseline"] = len(predictions["NaiveBaseline"])
+                    record["rows"] = counts["NaiveBaseline"]
+                if args.export_predictions or args.stream_predictions:
+                    with timer.stage("export_predictions") as record:
+                        export_predictions(
+                            output_dir,
+                            [{"NaiveBaseline": predictions["NaiveBaseline"]}],
+                            binary=args.export_format == "binary",
+                            compression=compression,
+                        )
+                        record["rows"] = counts["NaiveBaseline"]
 
+            if cache is not None:
+                logger.info(f"Prediction cache: {cache.stats}")
             logger.info(f"Found {len(unaligned_protein_ids)} unannotated test proteins")
 
             unannotated_path = os.path.join(
@@ -189,52 +775,72 @@ def main():
                 for pid in unaligned_protein_ids:
                     f.write(f"{pid}\n")
 
-            if idscore_pred:
-                pd.DataFrame(idscore_pred).to_csv(
-                    f"{output_dir}/predictions/IDScore/predictions.tsv",
-                    sep="\t",
-                    index=False,
-                )
-                logger.info(
-                    f"Saved {len(idscore_pred)} Best identity % score predictions"
-                )
-            else:
-                logger.warning("No IDScore predictions were made.")
-
-            if ascore_pred:
-                pd.DataFrame(ascore_pred).to_csv(
-                    f"{output_dir}/predictions/AlignmentScore/predictions.tsv",
-                    sep="\t",
-                    index=False,
-                )
-                logger.info(f"Saved {len(ascore_pred)} AlignmentScore predictions")
-            else:
-                logger.warning("No AlignmentScore predictions were made.")
-
-            for k in args.k_values:
-                pred_count = len(blastknn_preds_dict[k])
-                if pred_count != 0:
-                    pd.DataFrame(blastknn_preds_dict[k]).to_csv(
-                        f"{output_dir}/predictions/BlastKNN/k{k}_predictions.tsv",
-                        sep="\t",
-                        index=False,
-                    )
-                    logger.info(f"Saved {pred_count} BlastKNN predictions for k={k}")
+            for method, count in counts.items():
+                if count != 0:
+                    logger.info(f"Computed {count} {method} predictions")
                 else:
-                    logger.warning(f"No BlastKNN predictions for k={k}")
-
-            logger.info(f"All predictions saved to {output_dir}/predictions")
+                    logger.warning(f"No {method} predictions were made.")
+            if args.export_predictions or args.stream_predictions:
+                logger.info(f"All predictions saved to {output_dir}/predictions")
             logger.info(f"Completed processing for {aspect}")
 
             logger.info("Evaluating predictions...")
 
-            evaluation.evaluate(
-                logger, output_dir, args.dataset, aspect, k_values=args.k_values
-            )
+            def evaluate(stages):
+                evaluated = [stage[len("evaluate_") :] for stage in stages]
+                evaluation.evaluate(
+                    logger,
+                    output_dir,
+                    args.dataset,
+                    aspect,
+                    k_values=args.k_values,
+                    predictions={method: predictions[method] for method in evaluated},
+                    timer=timer,
+                    bootstrap=args.bootstrap,
+                    confidence=args.confidence,
+                    chunk_size=args.eval_chunk_size,
+                    exact=args.exact_fmax,
+                    stacked=args.stacked_evaluation,
+                )
+                # Evaluation results are cached as the contents of their files
+                return {
+                    f"evaluate_{method}": read_outputs(
+                        f"{output_dir}/evaluation/{method}"
+                    )
+                    for method in evaluated
+                }
+
+            if stage_cache is None:
+                evaluate([f"evaluate_{method}" for method in predictions])
+            else:
+                evaluated = cached_stages(
+                    stage_cache,
+                    {
+                        f"evaluate_{method}": keys[f"evaluate_{method}"]
+                        for method in predictions
+                    },
+                    evaluate,
+                )
+                for stage, outputs in evaluated.items():
+                    write_outputs(
+                        f"{output_dir}/evaluation/{stage[len('evaluate_') :]}", outputs
+                    )
             logger.info(f"Evaluation completed for aspect {aspect}")
+            logger.info(
+                f"Stage timings (also saved to {timer.path}):\n{timer.summary().to_string(float_format='%.3f')}"
+            )
+            stage_records += timer.records
 
         print("Done!")
 
+    if stage_records:
+        print("Stage timings:")
+        print(
+            summary_table(stage_records, by=["db_version", "aspect"]).to_string(
+                float_format="%.3f"
+            )
+        )
+
 
 if __name__ == "__main__":
     main()
@@ -243,3 +849,11 @@ if __name__ == "__main__":
 # python main.py --dataset ATGO \
 # --alignment_dir ./data/swissprot/2024_01/diamond_swissprot_2024_01_alignment.tsv --k_values 1 3 5 10 15 20 \
 # --aspects BPO CCO MFO --experimental_only
+# Reruns with a stage cache only run the stages whose inputs changed (listed beforehand with --dry_run):
+# python main.py --dataset ATGO \
+# --alignment_dir ./data/swissprot/2024_01/diamond_swissprot_2024_01_alignment.tsv --k_values 1 3 5 10 15 20 \
+# --aspects BPO CCO MFO --stage_cache_dir ./cache/stages --dry_run
+# All aspects scored in one pass over the alignment hits:
+# python main.py --dataset ATGO \
+# --alignment_dir ./data/swissprot/2024_01/diamond_swissprot_2024_01_alignment.tsv --k_values 1 3 5 10 15 20 \
+# --aspects BPO CCO MFO --multi_aspect
@@ -1,177 +1,528 @@
+import numpy as np
 import pandas as pd
-from collections import defaultdict
+import scipy.sparse as ssp
 import tqdm
+from predictions import NaivePredictions, SparsePredictions
+from instrumentation import stage
 
 
-def score(E):
+def annotation_matrix(train):
     """
-    Compute the Diamond Score for a query sequence against GO annotation terms.
+    Build the binary subject x term annotation matrix of the known protein set.
 
     Parameters:
-    E (dataframe): Dataframe of similar sequences according to Diamond blast results filtered by e-value of 0.001,
-                    with columns 'subject_id', 'bit_score' and 'subject_annotations'.
+    train (dataframe): Exploded training annotations with columns 'EntryID' and 'term'.
+
+    Returns the subject IDs (rows), the GO terms (columns) and the CSR matrix.
     """
-    go_terms = defaultdict(float)
-    for _, row in E.iterrows():
-        subject_annotations = row["subject_annotations"]
-        bit_score = row["bit_score"]
-        for annotation in subject_annotations:
-            go_terms[annotation] += bit_score
-    return go_terms
+    subject_codes, subjects = pd.factorize(train["EntryID"])
+    # Proteins without GO terms (NaN term) are kept as annotated subjects transferring no known term
+    term_codes, terms = pd.factorize(train["term"], use_na_sentinel=False)
+    matrix = ssp.coo_matrix(
+        (np.ones(len(train), dtype=np.float64), (subject_codes, term_codes)),
+        shape=(len(subjects), len(terms)),
+    ).tocsr()
+    matrix.data[:] = 1.0  # Duplicated annotations count once
+    return np.asarray(subjects, dtype=object), np.asarray(terms, dtype=object), matrix
 
 
-def alignment_score(E):
+def hit_matrix(hits, weights, n_queries, n_subjects):
+    """
+    Build a query x subject matrix from encoded hits. Repeated (query, subject) pairs are summed,
+    as every alignment row contributes its own score. Scores are summed in double precision.
     """
-    Compute the Diamond Score for a query sequence against GO annotation terms.
+    return ssp.coo_matrix(
+        (
+            np.asarray(weights, dtype=np.float64),
+            (hits["query_code"], hits["subject_code"]),
+        ),
+        shape=(n_queries, n_subjects),
+    ).tocsr()
 
-    Parameters:
-    E (dataframe): Dataframe of similar sequences according to Diamond blast results filtered by e-value of 0.001,
-                    with columns 'subject_id', 'bit_score' and 'subject_annotations'.
+
+def normalize_rows(matrix, totals):
+    """Divide each row of a CSR matrix by its total, leaving rows with a null total untouched."""
+    matrix = ssp.csr_matrix(matrix)
+    totals = np.repeat(
+        np.asarray(totals, dtype=np.float64).ravel(), np.diff(matrix.indptr)
+    )
+    np.divide(matrix.data, totals, out=matrix.data, where=totals > 0)
+    return matrix
+
+
+def alignment_score(hits, annotations, n_queries):
     """
-    go_terms = score(E)
-    # Normalize scores by the sum of bit scores
-    for key in go_terms:
-        go_terms[key] = go_terms[key] / E["bit_score"].sum()
+    Compute the Diamond Score for every query against GO annotation terms:
+    the bit scores of all hits carrying a term, normalized by the sum of bit scores of the query.
 
-    return go_terms
+    Parameters:
+    hits (dict): Encoded Diamond hits with arrays 'query_code', 'subject_code' and 'bit_score'.
+    annotations (csr_matrix): Binary subject x term annotation matrix.
+    n_queries (int): Number of query proteins.
+    """
+    H = hit_matrix(hits, hits["bit_score"], n_queries, annotations.shape[0])
+    # Totals are accumulated in the same order as term scores, so that a term shared by all hits scores exactly 1
+    return normalize_rows(H @ annotations, H @ np.ones(H.shape[1]))
 
 
-def alignment_knn(E, k=5):
+def alignment_knn(hits, annotations, n_queries, k=5):
     """
     Transfer annotations from the k most similar proteins based on bit score.
 
     Parameters:
-    E (dataframe): Dataframe of similar sequences according to Diamond blast results,
-                  with columns 'subject_id', 'bit_score' and 'subject_annotations'.
+    hits (dict): Encoded Diamond hits sorted by query and decreasing bit score,
+                 with a 'rank' array giving the position of each hit within its query.
+    annotations (csr_matrix): Binary subject x term annotation matrix.
+    n_queries (int): Number of query proteins.
     k (int): Number of nearest neighbors to consider
     """
+    return alignment_score(take_hits(hits, hits["rank"] < k), annotations, n_queries)
 
-    # Sort by bit_score (descending) and get top k
-    top_k = E.sort_values(by="bit_score", ascending=False).head(k)
-    go_terms = score(top_k)
 
-    # Normalize scores
-    total_score = top_k["bit_score"].sum()
-    if total_score > 0:  # Avoid division by zero
-        for key in go_terms:
-            go_terms[key] = go_terms[key] / total_score
+def best_percent_identity(hits, annotations, n_queries):
+    """
+    Transfer the annotations of the hit with the best percent identity, with a score of 1.0 per term.
 
-    return go_terms
+    Parameters:
+    hits (dict): Encoded Diamond hits sorted by query, with arrays 'query_code', 'subject_code', 'perc_identity'.
+    annotations (csr_matrix): Binary subject x term annotation matrix.
+    n_queries (int): Number of query proteins.
+    """
+    # Stable sort: ties are broken by hit order (decreasing bit score, then alignment file order)
+    order = np.lexsort((-hits["perc_identity"], hits["query_code"]))
+    query_codes = hits["query_code"][order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = query_codes[1:] != query_codes[:-1]
+    best = take_hits(hits, order[first])
+    H = hit_matrix(best, np.ones(first.sum()), n_queries, annotations.shape[0])
+    return H @ annotations
 
 
-def best_percent_identity(E):
+def naive_baseline(train, val):
+    """
+    Assign to every query protein the frequency of each GO term across the training set.
+    The scores are shared by all query proteins and kept as a single term frequency vector.
     """
-    Get the best percent identity from the alignments. Transfer its annotations to current protein.
+    go_term_counts = train["term"].value_counts()
+    go_term_scores = go_term_counts / train["EntryID"].nunique()
 
-    Parameters:
-    E (dataframe): Dataframe of similar sequences according to Diamond blast results,
-                  with columns 'subject_id', 'perc_identity'.
+    query_proteins = val["EntryID"].unique()
+    return NaivePredictions(
+        query_proteins, go_term_scores.index, go_term_scores.to_numpy()
+    )
+
+
+HIT_COLUMNS = ["query_code", "subject_code", "perc_identity", "bit_score", "rank"]
+
+
+def take_hits(hits, rows):
     """
-    if E.empty:
-        return {}
+    Select rows of encoded hits with a boolean mask, an index array or a slice (slices are zero-copy views).
+    """
+    return {column: hits[column][rows] for column in HIT_COLUMNS}
 
-    # Get the row with the maximum percent identity
-    best_row = E.loc[E["perc_identity"].idxmax()]
-    annotations = best_row["subject_annotations"]
-    go_terms = {term: 1.0 for term in annotations}  # Assign a score of 1.0 to each term
 
-    return go_terms
+def encode_hits(alignment_hits, query_ids, subjects):
+    """
+    Map the pairwise alignments (AlignmentHits) to row indices of the query set and of the annotation matrix.
+    Hits on unknown queries or on subjects without annotations are dropped.
 
+    Queries are ordered by their code in the alignment, so that hits stay sorted by query and decreasing bit score,
+    and the hits of a query, or of a range of queries, are a contiguous block of rows.
+    Returns the queries (aligned ones first, then unaligned ones in query_ids order) and the encoded hits:
+    a dict of arrays 'query_code', 'subject_code', 'perc_identity', 'bit_score' and 'rank' (position of each hit
+    within its query), along with 'offsets', the per-query row offsets.
+    """
+    query_ids = np.asarray(query_ids, dtype=object)
+    subject_index = pd.Index(subjects).get_indexer(alignment_hits.proteins)
+    alignment_hits = alignment_hits.select(
+        alignment_hits.protein_mask(query_ids)[alignment_hits.query]
+        & (subject_index[alignment_hits.subject] >= 0)
+    )
 
-def naive_baseline(input_dir, train, val):
-    # Compute the frequency of each GO term across all proteins in the training set
-    go_term_counts = train["term"].value_counts()
-    go_term_scores = go_term_counts / train["EntryID"].nunique()
+    aligned = np.flatnonzero(np.diff(alignment_hits.offsets) > 0)
+    aligned_ids = alignment_hits.proteins[aligned]
+    unaligned_ids = query_ids[pd.Index(aligned_ids).get_indexer(query_ids) < 0]
+    queries = np.concatenate([aligned_ids, unaligned_ids])
 
-    # Assign the same scores to all query proteins
-    query_proteins = val["EntryID"].unique()
-    predictions = pd.DataFrame(
+    query_position = np.full(len(alignment_hits.proteins), -1, dtype=np.int64)
+    query_position[aligned] = np.arange(len(aligned))
+    offsets = np.concatenate(
         [
-            (protein, term, score)
-            for protein in query_proteins
-            for term, score in go_term_scores.items()
-        ],
-        columns=["target_ID", "term_ID", "score"],
+            alignment_hits.offsets[aligned],
+            np.full(len(unaligned_ids) + 1, len(alignment_hits), dtype=np.int64),
+        ]
     )
-    predictions.to_csv(
-        f"{input_dir}/predictions/NaiveBaseline/predictions.tsv",
-        sep="\t",
-        index=False,
+    query_codes = query_position[alignment_hits.query]
+    return queries, {
+        "query_code": query_codes,
+        "subject_code": subject_index[alignment_hits.subject],
+        "perc_identity": alignment_hits.perc_identity,
+        "bit_score": alignment_hits.bit_score,
+        "rank": np.arange(len(alignment_hits)) - offsets[query_codes],
+        "offsets": offsets,
+    }
+
+
+def method_pruning(pruning, method):
+    """
+    Pruning settings ({'top_n': ..., 'min_score': ...}) of a method. Settings are looked up by method name
+    ('BlastKNN_k5'), then by method family ('BlastKNN'), then under the '*' key applying to all methods.
+    """
+    if not pruning:
+        return {}
+    for key in (method, method.split("_k")[0], "*"):
+        if key in pruning:
+            return pruning[key]
+    return {}
+
+
+def prune(predictions, pruning):
+    """
+    Apply per-method top-N / minimum score pruning to a dict of SparsePredictions.
+    """
+    for method, method_predictions in predictions.items():
+        settings = method_pruning(pruning, method)
+        if settings:
+            predictions[method] = method_predictions.pruned(**settings)
+    return predictions
+
+
+def method_names(k_values):
+    """Names of the alignment-based methods: 'IDScore', 'AlignmentScore' and 'BlastKNN_k<k>' for each k."""
+    return ["IDScore", "AlignmentScore"] + [f"BlastKNN_k{k}" for k in k_values]
+
+
+def method_scores(method, hits, annotations, n_queries):
+    """
+    Compute the query x term score matrix of an alignment-based method (see method_names) from encoded hits.
+    """
+    if method == "IDScore":  # CAFA3 baseline: Best percent identity
+        return best_percent_identity(hits, annotations, n_queries)
+    if method == "AlignmentScore":  # Alignment Score, DiamondKNN (based off bitscore)
+        return alignment_score(hits, annotations, n_queries)
+    # Compute from k closest alignments
+    return alignment_knn(hits, annotations, n_queries, k=int(method.split("_k")[1]))
+
+
+def score_hits(
+    hits,
+    annotations,
+    queries,
+    terms,
+    k_values,
+    pruning=None,
+    cache=None,
+    timer=None,
+    only=None,
+):
+    """
+    Run every alignment-based method (or only the given methods) on encoded hits of the given queries.
+    Returns a dict mapping each method ('IDScore', 'AlignmentScore', 'BlastKNN_k<k>') to its SparsePredictions,
+    pruned according to pruning (see method_pruning).
+    If a PredictionCache is given, only the predictions of queries missing from the cache are computed.
+    Predictions are cached before pruning, so that pruning settings can change without recomputing them.
+    The scoring of each method is recorded as a stage 'score_<method>' of timer (a StageTimer), if given.
+    """
+
+    def compute(method, hits, annotations, n_queries):
+        with stage(timer, f"score_{method}") as record:
+            matrix = method_scores(method, hits, annotations, n_queries)
+            record["rows"] = matrix.nnz
+        return matrix
+
+    methods = method_names(k_values)
+    if only is not None:
+        methods = [method for method in methods if method in only]
+    if cache is not None:
+        matrices = cache.score(hits, annotations, terms, len(queries), methods, compute)
+    else:
+        matrices = {
+            method: compute(method, hits, annotations, len(queries))
+            for method in methods
+        }
+    predictions = {
+        method: SparsePredictions(queries, terms, matrices[method])
+        for method in methods
+    }
+    return prune(predictions, pruning)
+
+
+def leakage_report(alignment_hits, query_ids, subjects):
+    """
+    Find annotation leakage between protein sets: hits of a query protein on an annotated subject which is
+    itself a query protein. Membership is resolved once per protein code, so the check is a single pass over hits.
+    Returns a DataFrame with one row per leaked hit ('query_id', 'subject_id', 'perc_identity', 'bit_score').
+    """
+    is_query = alignment_hits.protein_mask(query_ids)
+    is_annotated = alignment_hits.protein_mask(subjects)
+    leaked = (
+        is_query[alignment_hits.query]
+        & is_query[alignment_hits.subject]
+        & is_annotated[alignment_hits.subject]
+    )
+    return pd.DataFrame(
+        {
+            "query_id": alignment_hits.proteins[alignment_hits.query[leaked]],
+            "subject_id": alignment_hits.proteins[alignment_hits.subject[leaked]],
+            "perc_identity": alignment_hits.perc_identity[leaked],
+            "bit_score": alignment_hits.bit_score[leaked],
+        }
+    )
+
+
+def prepare_transfer(
+    logger, pairwise_alignment, train, test, one_vs_all=False, leakage_file=None
+):
+    """
+    Encode the pairwise alignments (AlignmentHits) against the test proteins and the annotation matrix
+    of the training set.
+    Unless one_vs_all is set, hits leaking annotations of test proteins are reported (saved to leakage_file if given)
+    and removed.
+    Returns the queries, the GO terms, the annotation matrix, the encoded hits and the unaligned test protein IDs.
+    """
+    query_ids = test["EntryID"].unique()
+    subjects, terms, annotations = annotation_matrix(train)
+
+    if not one_vs_all:
+        report = leakage_report(pairwise_alignment, query_ids, subjects)
+        if not report.empty:
+            logger.warning(
+                f"Annotation leakage has been found beetween protein sets: {len(report)} hits of {report['query_id'].nunique()} test proteins on {report['subject_id'].nunique()} annotated test proteins. Removing them."
+            )
+            logger.warning(f"Leakage in:\n{report}")
+            if leakage_file is not None:
+                report.to_csv(leakage_file, sep="\t", index=False)
+                logger.warning(f"Leakage report saved to {leakage_file}")
+            pairwise_alignment = pairwise_alignment.restrict(exclude_subjects=query_ids)
+
+    queries, hits = encode_hits(pairwise_alignment, query_ids, subjects)
+
+    aligned = np.diff(hits["offsets"]) > 0
+    unaligned_protein_ids = list(queries[~aligned])
+
+    unaligned_proteins = len(unaligned_protein_ids)
+    logger.info(
+        f"Number of unaligned proteins: {unaligned_proteins} out of {len(queries)} ({unaligned_proteins / len(queries) * 100} %); No annotations have been transfered for alignment-based methods."
     )
+    return queries, terms, annotations, hits, unaligned_protein_ids
 
 
 def transfer_annotations(
-    logger, pairwise_alignment, train, test, k_values, one_vs_all=False
+    logger,
+    pairwise_alignment,
+    train,
+    test,
+    k_values,
+    one_vs_all=False,
+    pruning=None,
+    leakage_file=None,
+    cache=None,
+    timer=None,
 ):
-    # Annotations for each sequence in the known protein set (used to transfer annotations)
-    # Ts: A dictionary of annotations like {'protein_name': ['go_term1', 'go_term2', ...], ...}
-    Ts = train.groupby("EntryID")["term"].apply(list).to_dict()
-
-    pairwise_alignment["subject_annotations"] = pairwise_alignment["subject_id"].map(Ts)
-    pairwise_alignment = pairwise_alignment[
-        pairwise_alignment["subject_annotations"].map(
-            lambda x: len(x) if isinstance(x, list) else 0
-        )
-        > 0
-    ]  # Drop rows without annotations
-
-    grouped = pairwise_alignment.groupby(
-        "query_id"
-    )  # Group by test protein for faster processing
-
-    ascore_pred, idscore_pred = [], []
-    blastknn_preds_dict = {k: [] for k in k_values}
-
-    unaligned_proteins = 0
-    unaligned_protein_ids = []  # Store unannotated protein IDs
-    for protein in tqdm.tqdm(
-        test["EntryID"].unique(), desc="Computing Diamond-based predictions"
-    ):
-        try:
-            group = grouped.get_group(protein)
-        except KeyError:  # No alignments for this protein
-            unaligned_proteins += 1
-            unaligned_protein_ids.append(protein)
-            continue
+    """
+    Transfer annotations of aligned training proteins to the test proteins with every alignment-based method.
+    pruning optionally maps methods to top-N / minimum score settings (see method_pruning).
+    Leaked hits are removed and reported to leakage_file (see prepare_transfer).
+    Cached predictions are looked up in cache (a PredictionCache) before computing them.
+    The scoring of each method is timed by timer (a StageTimer), if given.
+
+    Returns the IDs of test proteins without any annotated hit, and a dict mapping each method
+    ('IDScore', 'AlignmentScore', 'BlastKNN_k<k>') to its SparsePredictions.
+    """
+    queries, terms, annotations, hits, unaligned_protein_ids = prepare_transfer(
+        logger,
+        pairwise_alignment,
+        train,
+        test,
+        one_vs_all=one_vs_all,
+        leakage_file=leakage_file,
+    )
+    return unaligned_protein_ids, score_hits(
+        hits,
+        annotations,
+        queries,
+        terms,
+        k_values,
+        pruning=pruning,
+        cache=cache,
+        timer=timer,
+    )
+
+
+def aspect_ranks(query_codes):
+    """Rank of each hit within its query, for hits sorted by query code."""
+    return np.arange(len(query_codes)) - np.searchsorted(
+        query_codes, query_codes, side="left"
+    )
+
+
+def multi_aspect_transfer_annotations(
+    logger,
+    pairwise_alignment,
+    trains,
+    tests,
+    k_values,
+    one_vs_all=False,
+    pruning=None,
+    leakage_files=None,
+    timer=None,
+):
+    """
+    Same as transfer_annotations for several GO aspects at once, given as dicts mapping each aspect to its
+    training and test sets. The hits of all test proteins are encoded once against a single subject x term
+    annotation matrix whose column blocks are the terms of each aspect, where subjects leaking annotations of
+    an aspect's test proteins (see prepare_transfer) are masked out of that aspect's block.
+    AlignmentScore is computed with a single product over all aspects, then normalized per aspect by the bit
+    scores of the hits on the aspect's subjects. IDScore and BlastKNN select hits per aspect (best hit, k nearest
+    subjects annotated in the aspect), and are computed per aspect from the shared encoded hits.
+    Scores equal the ones of transfer_annotations up to the summation order of floating point values.
+
+    Returns a dict mapping each aspect to the IDs of its test proteins without any annotated hit,
+    and to a dict mapping each method to its SparsePredictions.
+    """
+    aspects = list(trains)
+    query_ids = {aspect: tests[aspect]["EntryID"].unique() for aspect in aspects}
+    matrices = {aspect: annotation_matrix(trains[aspect]) for aspect in aspects}
+    all_query_ids = pd.unique(np.concatenate(list(query_ids.values())))
+    all_subjects = pd.unique(
+        np.concatenate([subjects for subjects, _, _ in matrices.values()])
+    )
+
+    blocks = []
+    subject_masks = np.zeros((len(all_subjects), len(aspects)))
+    for i, aspect in enumerate(aspects):
+        subjects, terms, annotations = matrices[aspect]
+        kept = np.ones(len(subjects), dtype=bool)
         if not one_vs_all:
-            try:
-                assert (
-                    not group["subject_id"].isin(test["EntryID"].unique()).any()
-                ), "Annotation leakage has been found beetween protein sets !"
-            except AssertionError as e:
-                logger.warning(f"Warning for protein {protein}: {e}")
+            report = leakage_report(pairwise_alignment, query_ids[aspect], subjects)
+            if not report.empty:
                 logger.warning(
-                    f"Leakage in:\n{group[group['subject_id'].isin(test['EntryID'].unique())]}"
+                    f"Annotation leakage has been found beetween {aspect} protein sets: {len(report)} hits of {report['query_id'].nunique()} test proteins on {report['subject_id'].nunique()} annotated test proteins. Removing them."
                 )
-                exit(1)
-
-        # CAFA3 baseline: Best percent identity
-        idscore = best_percent_identity(group)
-        if idscore:
-            idscore_pred.extend(
-                {"target_ID": protein, "term_ID": term_id, "score": score}
-                for term_id, score in idscore.items()
-            )
+                logger.warning(f"Leakage in:\n{report}")
+                if leakage_files is not None:
+                    report.to_csv(leakage_files[aspect], sep="\t", index=False)
+                    logger.warning(f"Leakage report saved to {leakage_files[aspect]}")
+                kept = ~pd.Index(subjects).isin(query_ids[aspect])
+        rows = pd.Index(all_subjects).get_indexer(subjects)
+        subject_masks[rows[kept], i] = 1.0
+        annotations = annotations.tocoo()
+        entries = kept[annotations.row]
+        blocks.append(
+            ssp.coo_matrix(
+                (
+                    annotations.data[entries],
+                    (rows[annotations.row[entries]], annotations.col[entries]),
+                ),
+                shape=(len(all_subjects), len(terms)),
+            ).tocsr()
+        )
 
-        # Alignment Score, DiamondKNN (based off bitscore)
-        ascore_preds = alignment_score(group)  # Compute from all alignments
-        for k in k_values:  # Compute from k closest alignments
-            knn_preds = alignment_knn(group, k=k)
+    queries, hits = encode_hits(pairwise_alignment, all_query_ids, all_subjects)
+    n_queries = len(queries)
 
-            blastknn_preds_dict[k].extend(
-                [
-                    {"target_ID": protein, "term_ID": term_id, "score": score}
-                    for term_id, score in knn_preds.items()
-                ]
+    with stage(timer, "score_AlignmentScore") as record:
+        H = hit_matrix(hits, hits["bit_score"], n_queries, len(all_subjects))
+        # One product for all aspects; totals are accumulated in the same order as term scores
+        scores = (H @ ssp.hstack(blocks, format="csr")).tocsc()
+        totals = H @ subject_masks
+        record["rows"] = scores.nnz
+
+    results = {}
+    column = 0
+    for i, aspect in enumerate(aspects):
+        terms = matrices[aspect][1]
+        is_query = pd.Index(queries).isin(query_ids[aspect])
+        aspect_hits = take_hits(
+            hits,
+            is_query[hits["query_code"]] & (subject_masks[hits["subject_code"], i] > 0),
+        )
+        aspect_hits["rank"] = aspect_ranks(aspect_hits["query_code"])
+        matrices_by_method = {
+            "AlignmentScore": normalize_rows(
+                scores[:, column : column + len(terms)].tocsr(), totals[:, i]
             )
+        }
+        column += len(terms)
+        for method in method_names(k_values):
+            if method != "AlignmentScore":
+                with stage(timer, f"score_{method}") as record:
+                    matrices_by_method[method] = method_scores(
+                        method, aspect_hits, blocks[i], n_queries
+                    )
+                    record["rows"] = matrices_by_method[method].nnz
 
-        ascore_pred.extend(
-            [
-                {"target_ID": protein, "term_ID": term_id, "score": score}
-                for term_id, score in ascore_preds.items()
-            ]
+        rows = np.flatnonzero(is_query)
+        predictions = {
+            method: SparsePredictions(
+                queries[rows], terms, ssp.csr_matrix(matrices_by_method[method])[rows]
+            )
+            for method in method_names(k_values)
+        }
+
+        aligned = np.zeros(n_queries, dtype=bool)
+        aligned[aspect_hits["query_code"]] = True
+        aligned_ids = set(queries[aligned])
+        unaligned_protein_ids = [
+            pid for pid in query_ids[aspect] if pid not in aligned_ids
+        ]
+        logger.info(
+            f"Number of unaligned {aspect} proteins: {len(unaligned_protein_ids)} out of {len(query_ids[aspect])} ({len(unaligned_protein_ids) / len(query_ids[aspect]) * 100} %); No annotations have been transfered for alignment-based methods."
         )
-    logger.info(
-        f"Number of unaligned proteins: {unaligned_proteins} out of {len(test['EntryID'].unique())} ({unaligned_proteins / test['EntryID'].nunique() * 100} %); No annotations have been transfered for alignment-based methods."
+        results[aspect] = unaligned_protein_ids, prune(predictions, pruning)
+    return results
+
+
+def stream_transfer_annotations(
+    logger,
+    pairwise_alignment,
+    train,
+    test,
+    k_values,
+    one_vs_all=False,
+    batch_size=1000,
+    pruning=None,
+    leakage_file=None,
+    cache=None,
+    timer=None,
+):
+    """
+    Same as transfer_annotations, but predictions are computed for batches of batch_size test proteins
+    at a time, so that only one batch of predictions is held in memory.
+
+    Returns the IDs of test proteins without any annotated hit, and a generator yielding for each batch
+    a dict mapping each method to the SparsePredictions of the batch.
+    """
+    queries, terms, annotations, hits, unaligned_protein_ids = prepare_transfer(
+        logger,
+        pairwise_alignment,
+        train,
+        test,
+        one_vs_all=one_vs_all,
+        leakage_file=leakage_file,
     )
-    return unaligned_protein_ids, ascore_pred, blastknn_preds_dict, idscore_pred
+
+    def batches():
+        # Hits are sorted by query: each batch of queries is a contiguous block of hits, found by its offsets
+        for start in tqdm.tqdm(
+            range(0, len(queries), batch_size),
+            desc="Computing Diamond-based predictions",
+        ):
+            stop = min(start + batch_size, len(queries))
+            batch_hits = take_hits(
+                hits, slice(hits["offsets"][start], hits["offsets"][stop])
+            )
+            batch_hits["query_code"] = batch_hits["query_code"] - start
+            yield score_hits(
+                batch_hits,
+                annotations,
+                queries[start:stop],
+                terms,
+                k_values,
+                pruning=pruning,
+                cache=cache,
+                timer=timer,
+            )
+
+    return unaligned_protein_ids, batches()
@@ -0,0 +1,207 @@
+import os
+import hashlib
+import sqlite3
+import collections
+import numpy as np
+import scipy.sparse as ssp
+
+
+def snapshot_id(annotations, terms):
+    """
+    Content hash of a training annotation snapshot: the subject x term annotation matrix and its terms.
+    """
+    annotations = ssp.csr_matrix(annotations)
+    annotations.sort_indices()
+    digest = hashlib.sha1()
+    digest.update(np.asarray(annotations.shape, dtype=np.int64).tobytes())
+    digest.update(annotations.indptr.astype(np.int64).tobytes())
+    digest.update(annotations.indices.astype(np.int64).tobytes())
+    digest.update("\n".join(map(str, terms)).encode())
+    return digest.hexdigest()
+
+
+def query_offsets(hits, n_queries):
+    """Per-query row offsets of encoded hits sorted by query."""
+    if "offsets" in hits:
+        return hits["offsets"]
+    counts = np.bincount(hits["query_code"], minlength=n_queries)
+    return np.concatenate([[0], np.cumsum(counts)])
+
+
+def query_fingerprints(hits, offsets):
+    """
+    Fingerprint of the hit list of each query: its subjects, percent identities and bit scores, in hit order.
+    Values are hashed in a fixed precision, so that fingerprints do not depend on the dtypes of the hits.
+    """
+    subjects = hits["subject_code"].astype(np.int64)
+    perc_identity = hits["perc_identity"].astype(np.float64)
+    bit_score = hits["bit_score"].astype(np.float64)
+    fingerprints = []
+    for start, stop in zip(offsets[:-1], offsets[1:]):
+        digest = hashlib.sha1(subjects[start:stop].tobytes())
+        digest.update(perc_identity[start:stop].tobytes())
+        digest.update(bit_score[start:stop].tobytes())
+        fingerprints.append(digest.digest())
+    return fingerprints
+
+
+def take_queries(hits, offsets, queries):
+    """
+    Select the hits of some queries, renumbering them 0..len(queries)-1 in the given order.
+    """
+    counts = offsets[queries + 1] - offsets[queries]
+    starts = np.repeat(offsets[queries], counts)
+    rows = (
+        starts + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    )
+    selected = {column: hits[column][rows] for column in hits if column != "offsets"}
+    selected["query_code"] = np.repeat(np.arange(len(queries)), counts)
+    return selected
+
+
+class PredictionCache(object):
+    """
+    Content-addressed cache of per-query predictions. An entry is keyed by the hash of the query's hit list,
+    the training annotation snapshot (see snapshot_id) and the method (including k), and holds the term codes
+    and scores of the query.
+    Entries are kept in an in-memory LRU tier of max_entries entries and, if cache_dir is given,
+    in an on-disk SQLite tier shared by later runs.
+    """
+
+    def __init__(self, cache_dir=None, max_entries=1_000_000):
+        self.max_entries = max_entries
+        self.memory = collections.OrderedDict()
+        self.snapshots = {}
+        self.db = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.db = sqlite3.connect(os.path.join(cache_dir, "predictions.sqlite"))
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS predictions (key BLOB PRIMARY KEY, terms BLOB, scores BLOB)"
+            )
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Reset the hit and miss counts, e.g. between the jobs of a run."""
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    def snapshot(self, annotations, terms):
+        # Annotations are hashed once per matrix object (e.g. once for all batches of a run)
+        key = id(annotations)
+        if key not in self.snapshots or self.snapshots[key][0] is not annotations:
+            self.snapshots[key] = (
+                annotations,
+                snapshot_id(annotations, terms).encode(),
+            )
+        return self.snapshots[key][1]
+
+    def remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def get_many(self, keys):
+        """Look up keys in the memory tier, then in the disk tier. Returns a dict of the entries found."""
+        found = {}
+        for key in keys:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                found[key] = self.memory[key]
+        self.stats["memory_hits"] += len(found)
+
+        missing = [key for key in keys if key not in found]
+        if self.db is not None:
+            for start in range(0, len(missing), 500):
+                chunk = missing[start : start + 500]
+                rows = self.db.execute(
+                    f"SELECT key, terms, scores FROM predictions WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+                for key, terms, scores in rows:
+                    value = (
+                        np.frombuffer(terms, dtype=np.int32),
+                        np.frombuffer(scores, dtype=np.float64),
+                    )
+                    self.remember(key, value)
+                    found[key] = value
+                    self.stats["disk_hits"] += 1
+        self.stats["misses"] += len(keys) - len(found)
+        return found
+
+    def put_many(self, entries):
+        for key, value in entries.items():
+            self.remember(key, value)
+        if self.db is not None:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)",
+                [
+                    (
+                        key,
+                        terms.astype(np.int32).tobytes(),
+                        scores.astype(np.float64).tobytes(),
+                    )
+                    for key, (terms, scores) in entries.items()
+                ],
+            )
+            self.db.commit()
+
+    def score(self, hits, annotations, terms, n_queries, methods, compute):
+        """
+        Compute the query x term matrix of each method with compute(method, hits, annotations, n_queries),
+        only for the queries whose predictions are not cached. Returns a dict mapping methods to CSR matrices.
+        Queries without hits get no predictions and are not cached.
+        """
+        snapshot = self.snapshot(annotations, terms)
+        offsets = query_offsets(hits, n_queries)
+        aligned = np.flatnonzero(np.diff(offsets) > 0)
+        fingerprints = query_fingerprints(hits, offsets)
+
+        matrices = {}
+        for method in methods:
+            prefix = snapshot + method.encode()
+            keys = [
+                hashlib.sha1(prefix + fingerprints[query]).digest() for query in aligned
+            ]
+            rows = self.get_many(keys)
+            missing = np.array(
+                [i for i, key in enumerate(keys) if key not in rows], dtype=np.int64
+            )
+            if len(missing):
+                matrix = ssp.csr_matrix(
+                    compute(
+                        method,
+                        take_queries(hits, offsets, aligned[missing]),
+                        annotations,
+                        len(missing),
+                    )
+                )
+                computed = {}
+                for row, i in enumerate(missing):
+                    span = slice(matrix.indptr[row], matrix.indptr[row + 1])
+                    computed[keys[i]] = (matrix.indices[span], matrix.data[span])
+                self.put_many(computed)
+                rows.update(computed)
+
+            lengths = np.zeros(n_queries, dtype=np.int64)
+            lengths[aligned] = [len(rows[key][0]) for key in keys]
+            indptr = np.concatenate([[0], np.cumsum(lengths)])
+            indices = [rows[key][0] for key in keys]
+            data = [rows[key][1] for key in keys]
+            matrices[method] = ssp.csr_matrix(
+                (
+                    np.concatenate(data) if data else np.array([], dtype=np.float64),
+                    (
+                        np.concatenate(indices)
+                        if indices
+                        else np.array([], dtype=np.int32)
+                    ),
+                    indptr,
+                ),
+                shape=(n_queries, len(terms)),
+            )
+        return matrices
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
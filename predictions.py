@@ -0,0 +1,595 @@
+import os
+import json
+import gzip
+import zlib
+import argparse
+import numpy as np
+import pandas as pd
+import scipy.sparse as ssp
+
+
+class SparsePredictions(object):
+    """
+    Prediction scores of a single method, stored as a protein x term sparse matrix.
+    Rows without any non-zero score correspond to proteins that received no prediction.
+    """
+
+    def __init__(self, proteins, terms, matrix):
+        self.proteins = np.asarray(proteins, dtype=object)
+        self.terms = np.asarray(terms, dtype=object)
+        self.matrix = ssp.csr_matrix(matrix, dtype=np.float64)
+        self.matrix.eliminate_zeros()
+
+    def __len__(self):
+        return self.matrix.nnz
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        Build predictions from a DataFrame with columns 'target_ID', 'term_ID' and 'score'.
+        """
+        protein_codes, proteins = pd.factorize(df["target_ID"])
+        term_codes, terms = pd.factorize(df["term_ID"])
+        matrix = ssp.coo_matrix(
+            (df["score"].to_numpy(dtype=np.float64), (protein_codes, term_codes)),
+            shape=(len(proteins), len(terms)),
+        )
+        return cls(proteins, terms, matrix.tocsr())
+
+    def pruned(self, top_n=None, min_score=None):
+        """
+        Return a copy keeping, for each protein, only scores >= min_score and among them the top_n best ones.
+        Only rows holding more than top_n scores are sorted; ties are broken by term order.
+        """
+        matrix = self.matrix.copy()
+        if min_score is not None:
+            matrix.data[matrix.data < min_score] = 0.0
+            matrix.eliminate_zeros()
+        if top_n is not None:
+            row_nnz = np.diff(matrix.indptr)
+            long_rows = np.flatnonzero(row_nnz > top_n)
+            if len(long_rows):
+                rows = np.repeat(np.arange(matrix.shape[0]), row_nnz)
+                entries = np.flatnonzero(np.isin(rows, long_rows))
+                order = entries[
+                    np.lexsort(
+                        (
+                            matrix.indices[entries],
+                            -matrix.data[entries],
+                            rows[entries],
+                        )
+                    )
+                ]
+                rank = np.arange(len(order)) - np.repeat(
+                    np.cumsum(row_nnz[long_rows]) - row_nnz[long_rows],
+                    row_nnz[long_rows],
+                )
+                matrix.data[order[rank >= top_n]] = 0.0
+                matrix.eliminate_zeros()
+        return SparsePredictions(self.proteins, self.terms, matrix)
+
+    def iter_batches(self, batch_size=1000):
+        """Yield SparsePredictions over consecutive batches of batch_size proteins."""
+        for start in range(0, len(self.proteins), batch_size):
+            stop = start + batch_size
+            yield SparsePredictions(
+                self.proteins[start:stop], self.terms, self.matrix[start:stop]
+            )
+
+    def predicted_proteins(self):
+        """Indices of the rows holding at least one prediction."""
+        return np.flatnonzero(np.diff(self.matrix.indptr))
+
+    def to_frame(self):
+        """Return predictions as a DataFrame with columns 'target_ID', 'term_ID', 'score'."""
+        coo = self.matrix.tocoo()
+        return pd.DataFrame(
+            {
+                "target_ID": self.proteins[coo.row],
+                "term_ID": self.terms[coo.col],
+                "score": coo.data,
+            }
+        )
+
+    def to_tsv(self, path):
+        """Export predictions to the legacy TSV format (target_ID, term_ID, score)."""
+        self.to_frame().to_csv(path, sep="\t", index=False)
+
+    def to_beprof(self, subontology):
+        """
+        Convert predictions to the nested dictionary expected by BeProf:
+        {protein: {subontology: {term: score}}}
+        """
+        pred_dict = {}
+        indptr, indices, data = (
+            self.matrix.indptr,
+            self.matrix.indices,
+            self.matrix.data,
+        )
+        for row in self.predicted_proteins():
+            start, end = indptr[row], indptr[row + 1]
+            pred_dict[self.proteins[row]] = {
+                subontology: dict(
+                    zip(self.terms[indices[start:end]], data[start:end].tolist())
+                )
+            }
+        return pred_dict
+
+
+class NaivePredictions(object):
+    """
+    Predictions shared by every protein (e.g. the Naive baseline), stored as a single term score vector.
+    The protein x term product is never materialised, except batch by batch when exported.
+    """
+
+    def __init__(self, proteins, terms, scores):
+        self.proteins = np.asarray(proteins, dtype=object)
+        self.terms = np.asarray(terms, dtype=object)
+        self.scores = np.asarray(scores, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.proteins) * int(np.count_nonzero(self.scores))
+
+    def term_scores(self):
+        """Shared predictions as a dict {term: score}."""
+        nonzero = self.scores != 0
+        return dict(zip(self.terms[nonzero], self.scores[nonzero].tolist()))
+
+    def iter_batches(self, batch_size=1000):
+        """Yield SparsePredictions over consecutive batches of batch_size proteins."""
+        row = ssp.csr_matrix(self.scores.reshape(1, -1))
+        for start in range(0, len(self.proteins), batch_size):
+            proteins = self.proteins[start : start + batch_size]
+            yield SparsePredictions(
+                proteins, self.terms, ssp.vstack([row] * len(proteins), format="csr")
+            )
+
+    def to_tsv(self, path):
+        """Export predictions to the legacy TSV format (target_ID, term_ID, score), batch by batch."""
+        with TextPredictionWriter(path) as writer:
+            writer.write_predictions(self)
+
+
+BINARY_MAGIC = b"PFPPRED1"
+# Scores are stored in double precision, so that evaluating prediction files matches in-memory evaluation.
+# Files of version 1 stored float32 scores, and are still read.
+SCORE_DTYPE = np.float64
+BINARY_EXTENSION = ".pfpb"
+CAFA_KEYWORDS = ("AUTHOR", "MODEL", "KEYWORDS", "ACCURACY", "END")
+
+
+class PredictionWriter(object):
+    """
+    Streaming writer of the binary prediction format.
+
+    The file holds chunks of (protein code, term code, score) columns stored as int32/int32/float64,
+    optionally zlib-compressed column by column, followed by a footer with the protein and term dictionaries, the chunk table and, if rows of each
+    protein are written contiguously, a per-protein (first row, last row + 1) index for random access:
+
+        magic | chunk 0 | chunk 1 | ... | index | footer (JSON) | footer size (uint64) | magic
+    """
+
+    def __init__(self, path, chunk_size=1_000_000, index=True, compression=None):
+        if compression not in (None, "zlib"):
+            raise ValueError(f"Unsupported compression: {compression}")
+        self.path = path
+        self.chunk_size = chunk_size
+        self.index = index
+        self.compression = compression
+        self._file = open(path, "wb")
+        self._file.write(BINARY_MAGIC)
+        self._protein_codes = {}
+        self._term_codes = {}
+        self._buffer = []
+        self._buffered_rows = 0
+        self._chunks = []
+        self._n_rows = 0
+        # (protein code, first row) of each run of identical protein codes
+        self._runs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self._n_rows + self._buffered_rows
+
+    def _encode(self, values, codes):
+        """Dictionary-encode values, extending the dictionary with unseen ones."""
+        values_codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        mapping = np.array(
+            [codes.setdefault(value, len(codes)) for value in uniques], dtype=np.int32
+        )
+        return mapping[values_codes]
+
+    def _update_index(self, protein_codes):
+        """Record the runs of identical protein codes, used to build the per-protein index."""
+        if not self.index or len(protein_codes) == 0:
+            return
+        starts = np.flatnonzero(np.diff(protein_codes, prepend=-1) != 0)
+        self._runs.append((protein_codes[starts], starts + len(self)))
+
+    def _build_index(self):
+        """
+        Per-protein (first row, last row + 1) arrays, or None if the rows of a protein are not contiguous.
+        """
+        codes = np.concatenate([c for c, _ in self._runs] or [np.empty(0, np.int32)])
+        starts = np.concatenate([s for _, s in self._runs] or [np.empty(0, np.int64)])
+        stops = np.append(starts[1:], self._n_rows)
+        # Merge runs split across write calls
+        new_run = np.diff(codes, prepend=-1) != 0
+        codes, starts = codes[new_run], starts[new_run]
+        stops = stops[np.append(np.flatnonzero(new_run)[1:] - 1, len(new_run) - 1)]
+        if len(np.unique(codes)) != len(codes):
+            return None
+        index = np.zeros((2, len(self._protein_codes)), dtype=np.int64)
+        index[0, codes], index[1, codes] = starts, stops
+        return index
+
+    def write(self, proteins, terms, scores):
+        """Append prediction rows given as parallel arrays of protein IDs, term IDs and scores."""
+        protein_codes = self._encode(proteins, self._protein_codes)
+        term_codes = self._encode(terms, self._term_codes)
+        self._write_codes(
+            protein_codes, term_codes, np.asarray(scores, dtype=SCORE_DTYPE)
+        )
+
+    def write_predictions(self, predictions):
+        """Append every non-zero score of a SparsePredictions or NaivePredictions."""
+        term_map = self._encode(predictions.terms, self._term_codes)
+        for batch in predictions.iter_batches():
+            protein_map = self._encode(batch.proteins, self._protein_codes)
+            coo = batch.matrix.tocoo()
+            self._write_codes(
+                protein_map[coo.row], term_map[coo.col], coo.data.astype(SCORE_DTYPE)
+            )
+
+    def _write_codes(self, protein_codes, term_codes, scores):
+        self._update_index(protein_codes)
+        self._buffer.append((protein_codes, term_codes, scores))
+        self._buffered_rows += len(scores)
+        while self._buffered_rows >= self.chunk_size:
+            self._flush(self.chunk_size)
+
+    def _flush(self, n_rows):
+        """Write the first n_rows buffered rows as one chunk."""
+        columns = [np.concatenate(column) for column in zip(*self._buffer)]
+        chunk, rest = [c[:n_rows] for c in columns], [c[n_rows:] for c in columns]
+        self._buffer = [tuple(rest)] if len(rest[0]) else []
+        self._buffered_rows = len(rest[0])
+
+        offset = self._file.tell()
+        sizes = []
+        for column in chunk:
+            data = column.tobytes()
+            if self.compression == "zlib":
+                data = zlib.compress(data, 1)
+            self._file.write(data)
+            sizes.append(len(data))
+        self._chunks.append(
+            {
+                "offset": offset,
+                "n_rows": len(chunk[0]),
+                "sizes": sizes,
+                "compression": self.compression,
+            }
+        )
+        self._n_rows += len(chunk[0])
+
+    def close(self):
+        if self._file is None:
+            return
+        if self._buffered_rows:
+            self._flush(self._buffered_rows)
+
+        footer = {
+            "version": 2,
+            "score_dtype": np.dtype(SCORE_DTYPE).name,
+            "n_rows": self._n_rows,
+            "proteins": list(self._protein_codes),
+            "terms": list(self._term_codes),
+            "chunks": self._chunks,
+            "index": None,
+        }
+        index = self._build_index() if self.index else None
+        if index is not None:
+            footer["index"] = {"offset": self._file.tell()}
+            self._file.write(index.tobytes())
+
+        data = json.dumps(footer).encode("utf-8")
+        self._file.write(data)
+        self._file.write(np.uint64(len(data)).tobytes())
+        self._file.write(BINARY_MAGIC)
+        self._file.close()
+        self._file = None
+
+
+class TextPredictionWriter(object):
+    """
+    Streaming writer of the legacy TSV prediction format (target_ID, term_ID, score).
+    Files ending with '.gz' are gzip-compressed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = gzip.open(path, "wt") if path.endswith(".gz") else open(path, "w")
+        self._file.write("target_ID\tterm_ID\tscore\n")
+        self._n_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self._n_rows
+
+    def write_predictions(self, predictions):
+        """Append every non-zero score of a SparsePredictions or NaivePredictions."""
+        for batch in predictions.iter_batches():
+            df = batch.to_frame()
+            df.to_csv(self._file, sep="\t", header=False, index=False)
+            self._n_rows += len(df)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def open_prediction_writer(path, compression=None, chunk_size=1_000_000):
+    """
+    Open a streaming prediction writer, in the binary format for '.pfpb' files and in the legacy TSV format
+    otherwise. For TSV files, compression appends '.gz' to the file name.
+    """
+    if path.endswith(BINARY_EXTENSION):
+        return PredictionWriter(path, chunk_size=chunk_size, compression=compression)
+    if compression is not None and not path.endswith(".gz"):
+        path += ".gz"
+    return TextPredictionWriter(path)
+
+
+class PredictionReader(object):
+    """
+    Reader of the binary prediction format written by PredictionWriter.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+                raise ValueError(f"{path} is not a binary prediction file.")
+            f.seek(-len(BINARY_MAGIC) - 8, os.SEEK_END)
+            footer_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            f.seek(-len(BINARY_MAGIC) - 8 - footer_size, os.SEEK_END)
+            footer = json.loads(f.read(footer_size).decode("utf-8"))
+            self._index = None
+            if footer["index"] is not None:
+                f.seek(footer["index"]["offset"])
+                self._index = np.fromfile(
+                    f, dtype=np.int64, count=2 * len(footer["proteins"])
+                ).reshape(2, -1)
+        self.n_rows = footer["n_rows"]
+        self.proteins = np.array(footer["proteins"], dtype=object)
+        self.terms = np.array(footer["terms"], dtype=object)
+        self._chunks = footer["chunks"]
+        self.score_dtype = np.dtype(footer.get("score_dtype", "float32"))
+        self._chunk_starts = np.cumsum([0] + [c["n_rows"] for c in self._chunks])
+        self._protein_codes = None
+
+    def __len__(self):
+        return self.n_rows
+
+    @property
+    def has_index(self):
+        return self._index is not None
+
+    def _read_chunk(self, f, chunk, start=0, stop=None):
+        """Read rows [start, stop) of a chunk as (protein codes, term codes, scores)."""
+        stop = chunk["n_rows"] if stop is None else stop
+        columns = []
+        offset = chunk["offset"]
+        for size, dtype in zip(chunk["sizes"], (np.int32, np.int32, self.score_dtype)):
+            if chunk.get("compression") == "zlib":
+                f.seek(offset)
+                column = np.frombuffer(zlib.decompress(f.read(size)), dtype=dtype)
+                columns.append(column[start:stop])
+            else:
+                f.seek(offset + start * np.dtype(dtype).itemsize)
+                columns.append(np.fromfile(f, dtype=dtype, count=stop - start))
+            offset += size
+        return tuple(columns)
+
+    def iter_chunks(self):
+        """Yield chunks of (protein codes, term codes, scores)."""
+        with open(self.path, "rb") as f:
+            for chunk in self._chunks:
+                yield self._read_chunk(f, chunk)
+
+    def read_rows(self, start, stop):
+        """Read the global rows [start, stop) as (protein codes, term codes, scores)."""
+        parts = []
+        first = np.searchsorted(self._chunk_starts, start, side="right") - 1
+        with open(self.path, "rb") as f:
+            for i in range(first, len(self._chunks)):
+                chunk_start = self._chunk_starts[i]
+                if chunk_start >= stop:
+                    break
+                parts.append(
+                    self._read_chunk(
+                        f,
+                        self._chunks[i],
+                        max(start - chunk_start, 0),
+                        min(stop, self._chunk_starts[i + 1]) - chunk_start,
+                    )
+                )
+        if not parts:
+            return (
+                np.empty(0, np.int32),
+                np.empty(0, np.int32),
+                np.empty(0, self.score_dtype),
+            )
+        return tuple(np.concatenate(column) for column in zip(*parts))
+
+    def get(self, protein):
+        """Return the predictions of a single protein as a dict {term: score}, using the index."""
+        if not self.has_index:
+            raise ValueError(f"{self.path} has no per-protein index.")
+        if self._protein_codes is None:
+            self._protein_codes = {p: i for i, p in enumerate(self.proteins)}
+        code = self._protein_codes.get(protein)
+        if code is None:
+            return {}
+        _, term_codes, scores = self.read_rows(
+            self._index[0, code], self._index[1, code]
+        )
+        return dict(zip(self.terms[term_codes], scores.tolist()))
+
+    def read_frame(self):
+        """Read all predictions as a DataFrame with columns 'target_ID', 'term_ID', 'score'."""
+        chunks = list(self.iter_chunks())
+        if not chunks:
+            return pd.DataFrame(columns=["target_ID", "term_ID", "score"])
+        protein_codes, term_codes, scores = (np.concatenate(c) for c in zip(*chunks))
+        return pd.DataFrame(
+            {
+                "target_ID": self.proteins[protein_codes],
+                "term_ID": self.terms[term_codes],
+                "score": scores,
+            }
+        )
+
+    def read_predictions(self):
+        """Read all predictions as a SparsePredictions."""
+        rows, cols, data = [], [], []
+        for protein_codes, term_codes, scores in self.iter_chunks():
+            rows.append(protein_codes)
+            cols.append(term_codes)
+            data.append(scores.astype(np.float64))
+        matrix = ssp.coo_matrix(
+            (
+                np.concatenate(data) if data else np.empty(0),
+                (
+                    np.concatenate(rows) if rows else np.empty(0, np.int32),
+                    np.concatenate(cols) if cols else np.empty(0, np.int32),
+                ),
+            ),
+            shape=(len(self.proteins), len(self.terms)),
+        )
+        return SparsePredictions(self.proteins, self.terms, matrix.tocsr())
+
+
+def is_binary_predictions(path):
+    """Whether a prediction file is in the binary format."""
+    with open(path, "rb") as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def iter_text_predictions(path, cafa=False, chunk_size=1_000_000):
+    """
+    Read a legacy TSV (header 'target_ID', 'term_ID', 'score') or CAFA (headerless, with optional
+    AUTHOR/MODEL/KEYWORDS/END lines) prediction file in chunks of (proteins, terms, scores).
+    """
+    reader = pd.read_csv(
+        path,
+        sep="\t" if not cafa else r"\s+",
+        header=None if cafa else 0,
+        names=["target_ID", "term_ID", "score"] if cafa else None,
+        usecols=[0, 1, 2] if cafa else None,
+        comment=None,
+        chunksize=chunk_size,
+        dtype={"target_ID": str, "term_ID": str},
+    )
+    for df in reader:
+        if cafa:
+            df = df[~df["target_ID"].isin(CAFA_KEYWORDS)]
+        df = df.dropna(subset=["term_ID"])
+        yield (
+            df["target_ID"].to_numpy(dtype=object),
+            df["term_ID"].to_numpy(dtype=object),
+            df["score"].to_numpy(dtype=np.float64),
+        )
+
+
+def convert_prediction_file(input_file, output_file, input_format, output_format):
+    """
+    Convert a prediction file between the legacy TSV, CAFA and binary formats, chunk by chunk.
+    """
+    if input_format == "binary":
+        reader = PredictionReader(input_file)
+        chunks = (
+            (reader.proteins[p], reader.terms[t], s) for p, t, s in reader.iter_chunks()
+        )
+    else:
+        chunks = iter_text_predictions(input_file, cafa=input_format == "cafa")
+
+    if output_format == "binary":
+        with PredictionWriter(output_file) as writer:
+            for proteins, terms, scores in chunks:
+                writer.write(proteins, terms, scores)
+        return
+
+    with open(output_file, "w") as f:
+        if output_format == "cafa":
+            f.write("AUTHOR PFP_baselines\nMODEL 1\nKEYWORDS sequence alignment.\n")
+        else:
+            f.write("target_ID\tterm_ID\tscore\n")
+        for proteins, terms, scores in chunks:
+            df = pd.DataFrame(
+                {"target_ID": proteins, "term_ID": terms, "score": scores}
+            )
+            if output_format == "cafa":
+                # CAFA scores are in (0.00, 1.00] with two decimals
+                df["score"] = df["score"].round(2)
+                df = df[df["score"] > 0]
+                df.to_csv(f, sep="\t", header=False, index=False, float_format="%.2f")
+            else:
+                df.to_csv(f, sep="\t", header=False, index=False)
+        if output_format == "cafa":
+            f.write("END\n")
+
+
+def guess_format(path):
+    if path.endswith(BINARY_EXTENSION):
+        return "binary"
+    if path.endswith(".txt") or path.endswith(".cafa"):
+        return "cafa"
+    return "tsv"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert prediction files between the legacy TSV, CAFA and binary formats."
+    )
+    parser.add_argument("--input", required=True, help="Input prediction file")
+    parser.add_argument("--output", required=True, help="Output prediction file")
+    parser.add_argument(
+        "--input_format",
+        choices=["tsv", "cafa", "binary"],
+        default=None,
+        help="Input format. Guessed from the file extension if not set.",
+    )
+    parser.add_argument(
+        "--output_format",
+        choices=["tsv", "cafa", "binary"],
+        default=None,
+        help="Output format. Guessed from the file extension if not set.",
+    )
+    args = parser.parse_args()
+
+    input_format = args.input_format or (
+        "binary" if is_binary_predictions(args.input) else guess_format(args.input)
+    )
+    output_format = args.output_format or guess_format(args.output)
+    convert_prediction_file(args.input, args.output, input_format, output_format)
+    print(f"Converted {args.input} ({input_format}) to {args.output} ({output_format})")
+
+
+if __name__ == "__main__":
+    main()
+
+# Example usage:
+# python predictions.py --input ./results/ATGO/baselines_ATGO_2024_01_BPO/predictions/AlignmentScore/predictions.pfpb --output predictions.tsv
@@ -0,0 +1,138 @@
+import os
+import time
+import argparse
+import itertools
+import pandas as pd
+import beprof_eval
+import evaluation
+
+
+def pruning_report(
+    logger, input_dir, dataset, aspect, methods, top_n_values, min_score_values
+):
+    """
+    Evaluate exported predictions of each method under every combination of top-N / minimum score pruning.
+    Returns a DataFrame with the size of the pruned predictions, the evaluation time and the metrics,
+    along with their difference to the unpruned predictions (top_n and min_score of 0 mean no pruning).
+    """
+    subontology = aspect[:2].lower()
+    gt_pkl, background_pkl, go_obo_file = evaluation.evaluation_files(
+        logger, dataset, aspect
+    )
+    real_test_protein_mess = beprof_eval.read_pkl(gt_pkl)
+    go = beprof_eval.load_ontology(go_obo_file, beprof_eval.read_pkl(background_pkl))
+
+    rows = []
+    for method in methods:
+        pred_file = evaluation.find_prediction_file(input_dir, method)
+        if not os.path.exists(pred_file):
+            logger.warning(f"{method} predictions file {pred_file} does not exist.")
+            continue
+        predictions = evaluation.load_predictions(pred_file)
+
+        # Unpruned predictions come first, as the reference
+        for top_n, min_score in itertools.chain(
+            [(None, None)],
+            (
+                (top_n or None, min_score or None)
+                for top_n, min_score in itertools.product(
+                    top_n_values, min_score_values
+                )
+                if top_n or min_score
+            ),
+        ):
+            pruned = predictions.pruned(top_n=top_n, min_score=min_score)
+            output_path = os.path.join(
+                input_dir, "pruning", method, f"top{top_n}_min{min_score}"
+            )
+            os.makedirs(output_path, exist_ok=True)
+
+            start = time.perf_counter()
+            results = beprof_eval.evaluate_predictions(
+                pruned.to_beprof(subontology),
+                output_path,
+                go,
+                real_test_protein_mess,
+                subontology,
+            )
+            rows.append(
+                {
+                    "method": method,
+                    "top_n": top_n or 0,
+                    "min_score": min_score or 0.0,
+                    "n_predictions": len(pruned),
+                    "eval_time": time.perf_counter() - start,
+                    "fmax": results["result_fmax"],
+                    "smin": results["result_smin"],
+                    "threshold": results["result_t"],
+                    "aupr": results["result_aupr"],
+                    "icaupr": results["result_icaupr"],
+                    "dpaupr": results["result_dpaupr"],
+                }
+            )
+            logger.info(f"{rows[-1]}")
+
+    report = pd.DataFrame(rows)
+    if report.empty:
+        return report
+    reference = report.groupby("method").transform("first")
+    report["size_ratio"] = report["n_predictions"] / reference["n_predictions"]
+    report["speedup"] = reference["eval_time"] / report["eval_time"]
+    for metric in ["fmax", "smin", "aupr"]:
+        report[f"delta_{metric}"] = report[metric] - reference[metric]
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Report the impact of prediction pruning on evaluation metrics, size and evaluation time."
+    )
+    parser.add_argument(
+        "--input_dir",
+        required=True,
+        help="Output directory of main.py holding exported predictions. The report is saved there.",
+    )
+    parser.add_argument("--dataset", required=True, help="Dataset name.")
+    parser.add_argument(
+        "--aspect", required=True, help="Ontology aspect (BPO, CCO, MFO)."
+    )
+    parser.add_argument(
+        "--methods",
+        nargs="+",
+        default=["AlignmentScore"],
+        help="Methods to report on, e.g. AlignmentScore BlastKNN_k20.",
+    )
+    parser.add_argument(
+        "--top_n",
+        nargs="+",
+        type=int,
+        default=[0, 50, 100, 200, 500],
+        help="Top-N values to try (0: no top-N pruning).",
+    )
+    parser.add_argument(
+        "--min_score",
+        nargs="+",
+        type=float,
+        default=[0, 0.01, 0.05],
+        help="Minimum scores to try (0: no score floor).",
+    )
+    args = parser.parse_args()
+
+    logger = evaluation.setup_logging(args.input_dir, args.aspect)
+    report = pruning_report(
+        logger,
+        args.input_dir,
+        args.dataset,
+        args.aspect,
+        args.methods,
+        args.top_n,
+        args.min_score,
+    )
+    report_file = os.path.join(args.input_dir, "pruning_report.tsv")
+    report.to_csv(report_file, sep="\t", index=False)
+    print(report.to_string(index=False))
+    print(f"Saved pruning report to {report_file}")
+
+# Example usage:
+# python pruning_report.py --input_dir ./results/ATGO/baselines_ATGO_2024_01_BPO_exp --dataset ATGO --aspect BPO \
+# --methods AlignmentScore BlastKNN_k20 --top_n 0 100 500 --min_score 0 0.01
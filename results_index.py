@@ -0,0 +1,294 @@
+import os
+import re
+import glob
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+import beprof_eval
+from constants import SUBONTOLOGIES
+
+# Flags appended by main.py to the output directory of a run, in order
+RUN_FLAGS = [
+    ("experimental_only", "_exp"),
+    ("annotations_2024_01", "_2024_annotations"),
+    ("one_vs_all", "_one_vs_all"),
+]
+METRICS = [
+    "result_fmax",
+    "result_smin",
+    "result_t",
+    "result_aupr",
+    "result_icaupr",
+    "result_dpaupr",
+    "result_min_s",  # Exact evaluation only
+    "result_min_s_t",
+]
+CURVES = [
+    "precisions",
+    "recalls",
+    "icprecisions",
+    "icrecalls",
+    "dpprecisions",
+    "dprecalls",
+    "mi_values",
+    "ru_values",
+    "thresholds",  # Exact evaluation only
+]
+INTERVAL_FIELDS = ["estimate", "lower", "upper", "std"]
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS runs (
+        run_dir TEXT PRIMARY KEY, dataset TEXT, db_version TEXT, aspect TEXT, suffix TEXT,
+        experimental_only INTEGER, annotations_2024_01 INTEGER, one_vs_all INTEGER
+    )""",
+    f"""CREATE TABLE IF NOT EXISTS metrics (
+        run_dir TEXT, method TEXT, k INTEGER, mtime_ns INTEGER, size INTEGER,
+        {", ".join(f"{metric} REAL" for metric in METRICS)},
+        PRIMARY KEY (run_dir, method)
+    )""",
+    f"""CREATE TABLE IF NOT EXISTS curves (
+        run_dir TEXT, method TEXT, {", ".join(f"{curve} BLOB" for curve in CURVES)},
+        PRIMARY KEY (run_dir, method)
+    )""",
+    f"""CREATE TABLE IF NOT EXISTS intervals (
+        run_dir TEXT, method TEXT, metric TEXT, confidence REAL, n_replicates INTEGER,
+        {", ".join(f"{field} REAL" for field in INTERVAL_FIELDS)},
+        PRIMARY KEY (run_dir, method, metric)
+    )""",
+]
+
+
+def parse_run_dir(run_dir):
+    """
+    Parse the configuration of a run from its output directory, named by main.py as
+    results/<dataset>/baselines_<dataset>_<db_version>_<aspect><suffix>[_exp][_2024_annotations][_one_vs_all].
+    Returns a dict of the configuration, or None if the directory does not follow this scheme.
+    """
+    dataset = os.path.basename(os.path.dirname(os.path.normpath(run_dir)))
+    name = os.path.basename(os.path.normpath(run_dir))
+    match = re.fullmatch(
+        rf"baselines_{re.escape(dataset)}_(.*?)_({'|'.join(SUBONTOLOGIES)})(.*)", name
+    )
+    if match is None:
+        return None
+    db_version, aspect, rest = match.groups()
+    config = {"dataset": dataset, "db_version": db_version, "aspect": aspect}
+    for flag, ending in reversed(RUN_FLAGS):
+        config[flag] = rest.endswith(ending)
+        if config[flag]:
+            rest = rest[: -len(ending)]
+    config["suffix"] = rest
+    return config
+
+
+def connect(index_path):
+    """Open (and create if needed) a results index."""
+    db = sqlite3.connect(index_path)
+    for statement in SCHEMA:
+        db.execute(statement)
+    return db
+
+
+def method_k(method):
+    """k of a BlastKNN_k<k> method, None for other methods."""
+    match = re.fullmatch(r"BlastKNN_k(\d+)", method)
+    return int(match.group(1)) if match else None
+
+
+def index_results(db, run_dir, method, results_file, stat):
+    """Add (or replace) the metrics, curves and bootstrap intervals of a method's evaluation."""
+    results = beprof_eval.read_pkl(results_file)
+    db.execute(
+        f"INSERT OR REPLACE INTO metrics VALUES ({', '.join('?' * (5 + len(METRICS)))})",
+        [run_dir, method, method_k(method), stat.st_mtime_ns, stat.st_size]
+        + [float(results[metric]) if metric in results else None for metric in METRICS],
+    )
+    db.execute(
+        f"INSERT OR REPLACE INTO curves VALUES ({', '.join('?' * (2 + len(CURVES)))})",
+        [run_dir, method]
+        + [
+            (
+                np.asarray(results[curve], dtype=np.float64).tobytes()
+                if curve in results
+                else None
+            )
+            for curve in CURVES
+        ],
+    )
+    db.execute(
+        "DELETE FROM intervals WHERE run_dir = ? AND method = ?", (run_dir, method)
+    )
+    bootstrap_file = os.path.join(
+        os.path.dirname(results_file), "beprof_bootstrap_results.pkl"
+    )
+    if os.path.exists(bootstrap_file):
+        intervals = beprof_eval.read_pkl(bootstrap_file)
+        db.executemany(
+            f"INSERT INTO intervals VALUES ({', '.join('?' * (5 + len(INTERVAL_FIELDS)))})",
+            [
+                [
+                    run_dir,
+                    method,
+                    metric,
+                    intervals["confidence"],
+                    intervals["n_replicates"],
+                ]
+                + [values[field] for field in INTERVAL_FIELDS]
+                for metric, values in intervals.items()
+                if isinstance(values, dict)
+            ],
+        )
+
+
+def update_index(index_path, results_dir="./results"):
+    """
+    Scan the evaluation results of every run under results_dir and update the index: only results that are new or
+    changed since the last update (by file modification time and size) are read, and results whose file was
+    removed are dropped. Returns the number of added, updated, removed and unchanged results.
+    """
+    db = connect(index_path)
+    known = {
+        (run_dir, method): (mtime_ns, size)
+        for run_dir, method, mtime_ns, size in db.execute(
+            "SELECT run_dir, method, mtime_ns, size FROM metrics"
+        )
+    }
+    counts = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+    found = set()
+    pattern = os.path.join(
+        results_dir, "*", "baselines_*", "evaluation", "*", "beprof_eval_results.pkl"
+    )
+    for results_file in sorted(glob.glob(pattern)):
+        method_dir = os.path.dirname(results_file)
+        run_dir = os.path.relpath(
+            os.path.dirname(os.path.dirname(method_dir)), results_dir
+        )
+        method = os.path.basename(method_dir)
+        config = parse_run_dir(os.path.join(results_dir, run_dir))
+        if config is None:
+            print(f"Skipping {run_dir}: not a run directory of main.py.")
+            continue
+        found.add((run_dir, method))
+        stat = os.stat(results_file)
+        if known.get((run_dir, method)) == (stat.st_mtime_ns, stat.st_size):
+            counts["unchanged"] += 1
+            continue
+        counts["updated" if (run_dir, method) in known else "added"] += 1
+        db.execute(
+            "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                run_dir,
+                config["dataset"],
+                config["db_version"],
+                config["aspect"],
+                config["suffix"],
+                config["experimental_only"],
+                config["annotations_2024_01"],
+                config["one_vs_all"],
+            ),
+        )
+        index_results(db, run_dir, method, results_file, stat)
+
+    for run_dir, method in set(known) - found:
+        for table in ["metrics", "curves", "intervals"]:
+            db.execute(
+                f"DELETE FROM {table} WHERE run_dir = ? AND method = ?",
+                (run_dir, method),
+            )
+        counts["removed"] += 1
+    db.execute("DELETE FROM runs WHERE run_dir NOT IN (SELECT run_dir FROM metrics)")
+    db.commit()
+    db.close()
+    return counts
+
+
+def load_metrics(index_path, **filters):
+    """
+    Load the metrics of the indexed results, along with the configuration of their runs, as a DataFrame.
+    Filters select runs by configuration, e.g. load_metrics(path, dataset="ATGO", aspect="BPO", one_vs_all=False).
+    """
+    db = connect(index_path)
+    where = " AND ".join(f"runs.{column} = ?" for column in filters) or "1"
+    metrics = pd.read_sql_query(
+        f"SELECT runs.*, metrics.* FROM metrics JOIN runs USING (run_dir) WHERE {where}",
+        db,
+        params=[
+            int(value) if isinstance(value, bool) else value
+            for value in filters.values()
+        ],
+    )
+    db.close()
+    metrics = metrics.loc[:, ~metrics.columns.duplicated()]
+    for flag, _ in RUN_FLAGS:
+        metrics[flag] = metrics[flag].astype(bool)
+    metrics["k"] = metrics["k"].astype("Int64")
+    return metrics.drop(columns=["mtime_ns", "size"])
+
+
+def load_curves(index_path, run_dir, method):
+    """Load the curves (precisions, recalls, ...) of an indexed result as a dict of arrays."""
+    db = connect(index_path)
+    row = db.execute(
+        f"SELECT {', '.join(CURVES)} FROM curves WHERE run_dir = ? AND method = ?",
+        (run_dir, method),
+    ).fetchone()
+    db.close()
+    if row is None:
+        raise KeyError(f"No {method} results of {run_dir} in {index_path}.")
+    return {
+        curve: np.frombuffer(values, dtype=np.float64)
+        for curve, values in zip(CURVES, row)
+        if values is not None
+    }
+
+
+def load_intervals(index_path, **filters):
+    """Load the bootstrap intervals of the indexed results as a DataFrame, filtered as in load_metrics."""
+    db = connect(index_path)
+    where = " AND ".join(f"runs.{column} = ?" for column in filters) or "1"
+    intervals = pd.read_sql_query(
+        f"SELECT runs.dataset, runs.db_version, runs.aspect, intervals.* FROM intervals "
+        f"JOIN runs USING (run_dir) WHERE {where}",
+        db,
+        params=[
+            int(value) if isinstance(value, bool) else value
+            for value in filters.values()
+        ],
+    )
+    db.close()
+    return intervals
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Index the evaluation results of all runs in a single SQLite database."
+    )
+    parser.add_argument(
+        "--results_dir", default="./results", help="Directory of the run results."
+    )
+    parser.add_argument(
+        "--index",
+        default=None,
+        help="Path of the index. Defaults to <results_dir>/results_index.sqlite.",
+    )
+    args = parser.parse_args()
+
+    index_path = args.index or os.path.join(args.results_dir, "results_index.sqlite")
+    counts = update_index(index_path, args.results_dir)
+    print(
+        ", ".join(f"{count} {status}" for status, count in counts.items())
+        + f" results in {index_path}"
+    )
+    metrics = load_metrics(index_path)
+    if not metrics.empty:
+        print(
+            metrics.groupby(["dataset", "aspect"])
+            .agg(runs=("run_dir", "nunique"), results=("method", "size"))
+            .to_string()
+        )
+
+# Example usage:
+# python results_index.py --results_dir ./results
+# Then, e.g. in a notebook:
+# results_index.load_metrics("./results/results_index.sqlite", dataset="ATGO", aspect="BPO", experimental_only=True)
@@ -0,0 +1,518 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import http
+import numpy as np
+import pandas as pd
+import scipy.sparse as ssp
+import beprof_eval
+import methods
+from alignment_store import DIAMOND_COLUMNS
+from constants import *
+
+
+def load_annotations(annotation_file):
+    """
+    Load training annotations (columns 'EntryID' and 'term', with terms separated by '; '), one row per term.
+    """
+    train = pd.read_csv(annotation_file, sep="\t", usecols=["EntryID", "term"])
+    train["term"] = train["term"].str.split("; ")
+    return train.explode("term").drop_duplicates()
+
+
+def ancestor_closure(go, terms):
+    """
+    Binary term x term matrix of the ontology closure: row i holds term i and its ancestors among terms.
+    """
+    term_index = pd.Index(terms)
+    rows, cols = [], []
+    for i, term in enumerate(terms):
+        codes = term_index.get_indexer(list(go.get_anchestors(term) | {term}))
+        codes = codes[codes >= 0]
+        rows.append(np.full(len(codes), i))
+        cols.append(codes)
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    return ssp.csr_matrix(
+        (np.ones(len(rows)), (rows, cols)), shape=(len(terms), len(terms))
+    )
+
+
+def propagate(matrix, closure):
+    """
+    Propagate the scores of a query x term matrix to the ancestors of each term, keeping the maximum score,
+    as done for evaluation.
+    """
+    matrix = matrix.tocoo()
+    counts = np.diff(closure.indptr)[matrix.col]
+    starts = np.repeat(closure.indptr[matrix.col], counts)
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    rows = np.repeat(matrix.row, counts)
+    cols = closure.indices[starts + within]
+    scores = np.repeat(matrix.data, counts)
+
+    # Keep the maximum score of each (query, term) pair
+    order = np.lexsort((-scores, cols, rows))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    return ssp.csr_matrix(
+        (scores[first], (rows[first], cols[first])), shape=matrix.shape
+    )
+
+
+class AnnotationIndex(object):
+    """
+    Training annotations kept in memory to score the hits of new queries: the annotation matrix and,
+    optionally, the GO ontology closure of its terms and their information content (IC).
+    """
+
+    def __init__(self, train, k_values, go=None):
+        self.subjects, self.terms, self.annotations = methods.annotation_matrix(train)
+        self.subject_index = pd.Index(self.subjects)
+        self.k_values = k_values
+        self.closure = None
+        self.ic = {}
+        if go is not None:
+            self.closure = ancestor_closure(go, self.terms)
+            if getattr(go, "ic", None):
+                self.ic = {
+                    term: go.get_ic(term) for term in self.terms if term in go.ic
+                }
+
+    def methods(self):
+        return methods.method_names(self.k_values)
+
+    def encode_requests(self, requests):
+        """
+        Encode the hits of several requests as one table. Queries of each request get their own codes,
+        so that identical query IDs of different requests are scored separately.
+        Returns the number of queries of each request and the encoded hits.
+        """
+        frames, n_queries, offset = [], [], 0
+        for request in requests:
+            hits = request["hits"]
+            query_codes, query_ids = pd.factorize(hits["query_id"])
+            frames.append(
+                pd.DataFrame(
+                    {
+                        "query_code": query_codes + offset,
+                        "subject_code": self.subject_index.get_indexer(
+                            hits["subject_id"]
+                        ),
+                        "perc_identity": hits["perc_identity"].to_numpy(
+                            dtype=np.float64
+                        ),
+                        "bit_score": hits["bit_score"].to_numpy(dtype=np.float64),
+                        "self_hit": (hits["query_id"] == hits["subject_id"]).to_numpy(),
+                    }
+                )
+            )
+            request["query_ids"] = np.asarray(query_ids, dtype=object)
+            n_queries.append(len(query_ids))
+            offset += len(query_ids)
+
+        hits = pd.concat(frames, ignore_index=True) if frames else None
+        if hits is None or hits.empty:
+            return n_queries, {column: np.array([]) for column in methods.HIT_COLUMNS}
+        hits = hits[(hits["subject_code"] >= 0) & ~hits["self_hit"]]
+
+        # Stable sort: ties keep their hit list order
+        order = np.lexsort(
+            (-hits["bit_score"].to_numpy(), hits["query_code"].to_numpy())
+        )
+        encoded = {
+            column: hits[column].to_numpy()[order]
+            for column in methods.HIT_COLUMNS[:-1]
+        }
+        counts = np.bincount(encoded["query_code"], minlength=offset)
+        encoded["rank"] = (
+            np.arange(len(order)) - (np.cumsum(counts) - counts)[encoded["query_code"]]
+        )
+        return n_queries, encoded
+
+    def score(self, requests):
+        """
+        Score the hits of several requests in a single vectorized call.
+        Each request is a dict with 'hits', a DataFrame with columns 'query_id', 'subject_id', 'perc_identity'
+        and 'bit_score', and optionally 'methods' and 'propagate'. Returns the response of each request,
+        mapping each query to the {term: score} predictions of each method.
+        """
+        n_queries, hits = self.encode_requests(requests)
+        queries = np.arange(sum(n_queries))
+        predictions = methods.score_hits(
+            hits, self.annotations, queries, self.terms, self.k_values
+        )
+
+        responses, start = [], 0
+        for request, n in zip(requests, n_queries):
+            response = {query_id: {} for query_id in request["query_ids"]}
+            for method in request.get("methods") or self.methods():
+                if method not in predictions:
+                    raise ValueError(f"Unknown method {method}")
+                matrix = predictions[method].matrix[start : start + n]
+                if request.get("propagate") and self.closure is not None:
+                    matrix = propagate(matrix, self.closure)
+                matrix = ssp.csr_matrix(matrix)
+                for i, query_id in enumerate(request["query_ids"]):
+                    row = slice(matrix.indptr[i], matrix.indptr[i + 1])
+                    response[query_id][method] = dict(
+                        zip(self.terms[matrix.indices[row]], matrix.data[row].tolist())
+                    )
+            responses.append(response)
+            start += n
+        return responses
+
+
+class MicroBatcher(object):
+    """
+    Collect concurrent requests and score them as one sparse batch: a batch is closed max_wait_ms after its
+    first request, or once it holds max_batch_queries queries, then scored in a worker thread while the next
+    batch is being collected. At most max_queue_size requests wait to be batched.
+    """
+
+    def __init__(
+        self, index, max_batch_queries=1000, max_wait_ms=2.0, max_queue_size=10000
+    ):
+        self.index = index
+        self.max_batch_queries = max_batch_queries
+        self.max_wait_ms = max_wait_ms
+        self.pending = asyncio.Queue(maxsize=max_queue_size)
+        self.worker = None
+        self.stats = {
+            "requests": 0,
+            "queries": 0,
+            "batches": 0,
+            "max_queue_depth": 0,
+            "scoring_time": 0.0,
+            "waiting_time": 0.0,
+        }
+
+    async def submit(self, request):
+        """Score a request with the next batch, and return its response."""
+        # Invalid requests are rejected here, not to fail the whole batch
+        unknown = set(request.get("methods") or []) - set(self.index.methods())
+        if unknown:
+            raise ValueError(f"Unknown methods {sorted(unknown)}")
+        if self.worker is None:
+            self.worker = asyncio.ensure_future(self.run())
+        future = asyncio.get_running_loop().create_future()
+        await self.pending.put((request, future, time.perf_counter()))
+        self.stats["max_queue_depth"] = max(
+            self.stats["max_queue_depth"], self.pending.qsize()
+        )
+        return await future
+
+    async def next_batch(self):
+        batch = [await self.pending.get()]
+        n_queries = batch[0][0]["hits"]["query_id"].nunique()
+        deadline = time.perf_counter() + self.max_wait_ms / 1000
+        while n_queries < self.max_batch_queries:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.pending.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+            n_queries += batch[-1][0]["hits"]["query_id"].nunique()
+        return batch, n_queries
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch, n_queries = await self.next_batch()
+            requests = [request for request, _, _ in batch]
+            start = time.perf_counter()
+            try:
+                responses = await loop.run_in_executor(None, self.index.score, requests)
+            except Exception as e:
+                responses = [e] * len(batch)
+
+            end = time.perf_counter()
+            self.stats["requests"] += len(batch)
+            self.stats["queries"] += n_queries
+            self.stats["batches"] += 1
+            self.stats["scoring_time"] += end - start
+            self.stats["waiting_time"] += sum(
+                start - submitted for _, _, submitted in batch
+            )
+            for (_, future, _), response in zip(batch, responses):
+                if future.cancelled():
+                    continue
+                if isinstance(response, Exception):
+                    future.set_exception(response)
+                else:
+                    future.set_result(response)
+
+    def metrics(self):
+        """
+        Batching metrics: current and maximum queue depth, number of batches, mean batch size,
+        mean time spent by requests waiting to be batched and mean scoring time of a batch (in ms).
+        """
+        stats = self.stats
+        batches, requests = max(stats["batches"], 1), max(stats["requests"], 1)
+        return {
+            "queue_depth": self.pending.qsize(),
+            "max_queue_depth": stats["max_queue_depth"],
+            "requests": stats["requests"],
+            "batches": stats["batches"],
+            "mean_batch_requests": stats["requests"] / batches,
+            "mean_batch_queries": stats["queries"] / batches,
+            "mean_waiting_ms": 1000 * stats["waiting_time"] / requests,
+            "mean_scoring_ms": 1000 * stats["scoring_time"] / batches,
+        }
+
+
+def align_sequences(diamond, db, sequences, threads=1):
+    """
+    Align sequences ({id: sequence}) against a Diamond database. Returns the hits as a DataFrame.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        query_file = os.path.join(tmp_dir, "queries.fasta")
+        with open(query_file, "w") as f:
+            for query_id, sequence in sequences.items():
+                f.write(f">{query_id}\n{sequence}\n")
+        output_file = os.path.join(tmp_dir, "hits.tsv")
+        subprocess.run(
+            [diamond, "blastp", "--db", db, "--query", query_file, "--out", output_file]
+            + ["--threads", str(threads)],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        if os.path.getsize(output_file) == 0:
+            return pd.DataFrame(columns=list(DIAMOND_COLUMNS))
+        return pd.read_csv(
+            output_file, sep="\t", header=None, names=list(DIAMOND_COLUMNS)
+        )
+
+
+class PredictionService(object):
+    """
+    Minimal HTTP/1.1 front end of a MicroBatcher.
+    GET /health: loaded annotations. GET /metrics: batching metrics (see MicroBatcher.metrics).
+    POST /predict: JSON body with either 'hits' (list of records with 'query_id', 'subject_id', 'perc_identity',
+    'bit_score') or 'sequences' ({id: sequence}, if a Diamond database is configured), and optionally 'methods'
+    and 'propagate'. Responds with the predictions ({query: {method: {term: score}}}) and the IC of their terms.
+    """
+
+    def __init__(self, batcher, diamond="diamond", diamond_db=None):
+        self.batcher = batcher
+        self.diamond = diamond
+        self.diamond_db = diamond_db
+
+    async def predict(self, body):
+        if "sequences" in body:
+            if self.diamond_db is None:
+                raise ValueError("No Diamond database configured to align sequences")
+            hits = await asyncio.get_running_loop().run_in_executor(
+                None, align_sequences, self.diamond, self.diamond_db, body["sequences"]
+            )
+        else:
+            hits = pd.DataFrame(
+                body["hits"],
+                columns=["query_id", "subject_id", "perc_identity", "bit_score"],
+            )
+        predictions = await self.batcher.submit(
+            {
+                "hits": hits,
+                "methods": body.get("methods"),
+                "propagate": body.get("propagate", False),
+            }
+        )
+
+        ic = self.batcher.index.ic
+        terms = {
+            term
+            for methods_predictions in predictions.values()
+            for term_scores in methods_predictions.values()
+            for term in term_scores
+        }
+        return {
+            "predictions": predictions,
+            "ic": {term: ic[term] for term in terms if term in ic},
+        }
+
+    async def dispatch(self, method, path, body):
+        index = self.batcher.index
+        if (method, path) == ("GET", "/health"):
+            return 200, {
+                "status": "ok",
+                "n_subjects": len(index.subjects),
+                "n_terms": len(index.terms),
+                "methods": index.methods(),
+            }
+        if (method, path) == ("GET", "/metrics"):
+            return 200, self.batcher.metrics()
+        if (method, path) == ("POST", "/predict"):
+            try:
+                return 200, await self.predict(json.loads(body))
+            except (KeyError, ValueError, TypeError) as e:
+                return 400, {"error": str(e)}
+        return 404, {"error": f"Unknown path {method} {path}"}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode().strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, response = await self.dispatch(method, path, body)
+                payload = json.dumps(response).encode()
+                keep_alive = headers.get("connection", "").lower() == "keep-alive"
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n"
+                        "Content-Type: application/json\r\n"
+                        f"Content-Length: {len(payload)}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                    ).encode()
+                    + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8080):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving predictions on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+def serve(
+    index, host="127.0.0.1", port=8080, diamond="diamond", diamond_db=None, **batching
+):
+    """
+    Serve predictions over HTTP, until interrupted. batching holds the MicroBatcher settings.
+    """
+
+    async def run():
+        service = PredictionService(
+            MicroBatcher(index, **batching), diamond=diamond, diamond_db=diamond_db
+        )
+        await service.serve(host, port)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve annotation transfer predictions for Diamond hits of new sequences."
+    )
+    parser.add_argument(
+        "--aspect", required=True, help="Ontology aspect (BPO, CCO, MFO)."
+    )
+    parser.add_argument(
+        "--db_version",
+        default="2024_01",
+        help="SwissProt version of the training annotations.",
+    )
+    parser.add_argument(
+        "--annotations",
+        default=None,
+        help="Training annotations TSV. Defaults to the SwissProt annotations of --db_version and --aspect.",
+    )
+    parser.add_argument(
+        "--experimental_only",
+        action="store_true",
+        help="Use experimental annotations only.",
+    )
+    parser.add_argument(
+        "--k_values",
+        type=int,
+        nargs="+",
+        default=[1, 3, 5, 10, 15, 20],
+        help="k values of BlastKNN.",
+    )
+    parser.add_argument(
+        "--go_obo",
+        default="./data/go.obo",
+        help="GO OBO file, used to propagate predictions. Empty to disable propagation.",
+    )
+    parser.add_argument(
+        "--background_pkl",
+        default=None,
+        help="Background annotations pkl (see background.py), used to compute the IC of terms.",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Host to listen on.")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on.")
+    parser.add_argument(
+        "--diamond", default="diamond", help="Diamond executable, to align sequences."
+    )
+    parser.add_argument(
+        "--diamond_db",
+        default=None,
+        help="Diamond database (.dmnd) of the training proteins, to accept sequences.",
+    )
+    parser.add_argument(
+        "--max_batch_queries",
+        type=int,
+        default=1000,
+        help="Maximum number of queries scored in a batch.",
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=2.0,
+        help="Maximum time a request waits for other requests to batch with.",
+    )
+    parser.add_argument(
+        "--max_queue_size",
+        type=int,
+        default=10000,
+        help="Maximum number of requests waiting to be batched; further requests wait for room in the queue.",
+    )
+    args = parser.parse_args()
+
+    annotation_file = args.annotations or (
+        f"./data/swissprot/{args.db_version}/swissprot_{args.db_version}_{args.aspect}"
+        + ("_exp" if args.experimental_only else "")
+        + "_annotations.tsv"
+    )
+    go = None
+    if args.go_obo:
+        if args.background_pkl:
+            go = beprof_eval.load_ontology(
+                args.go_obo, beprof_eval.read_pkl(args.background_pkl)
+            )
+        else:
+            go = beprof_eval.Ontology(args.go_obo, with_rels=True)
+    index = AnnotationIndex(load_annotations(annotation_file), args.k_values, go=go)
+    print(
+        f"Loaded {len(index.subjects)} training proteins annotated with {len(index.terms)} terms"
+    )
+    serve(
+        index,
+        host=args.host,
+        port=args.port,
+        diamond=args.diamond,
+        diamond_db=args.diamond_db,
+        max_batch_queries=args.max_batch_queries,
+        max_wait_ms=args.max_wait_ms,
+        max_queue_size=args.max_queue_size,
+    )
+
+# Example usage:
+# python service.py --aspect BPO --db_version 2024_01 --background_pkl ./data/ATGO/background_ATGO.pkl --port 8080
+# curl -X POST localhost:8080/predict -d '{"hits": [{"query_id": "Q1", "subject_id": "P12345", "perc_identity": 80.0, "bit_score": 250.0}]}'
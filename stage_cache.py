@@ -0,0 +1,108 @@
+import os
+import json
+import pickle
+import hashlib
+
+
+class StageCache(object):
+    """
+    Make-like cache of pipeline stages. A stage is keyed by a fingerprint of its input files (content hashes,
+    including the code it runs), its parameters and the fingerprints of the stages it depends on (see fingerprint).
+    Its outputs are stored under <cache_dir>/<stage>/<key>.pkl, and the stage only runs when nothing is stored
+    under its current key. File hashes are only recomputed when the size or modification time of a file changes.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.hashes_path = os.path.join(cache_dir, "file_hashes.json")
+        self.file_hashes = {}
+        if os.path.exists(self.hashes_path):
+            with open(self.hashes_path) as f:
+                self.file_hashes = json.load(f)
+
+    def file_hash(self, path):
+        """Content hash of a file, or None if it does not exist."""
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        known = self.file_hashes.get(path)
+        if known is None or (known["size"], known["mtime_ns"]) != (
+            stat.st_size,
+            stat.st_mtime_ns,
+        ):
+            digest = hashlib.sha1()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+            known = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "sha1": digest.hexdigest(),
+            }
+            self.file_hashes[path] = known
+            with open(self.hashes_path + ".tmp", "w") as f:
+                json.dump(self.file_hashes, f)
+            os.replace(self.hashes_path + ".tmp", self.hashes_path)
+        return known["sha1"]
+
+    def fingerprint(self, stage, files=(), depends=(), **params):
+        """
+        Key of a stage, from the contents of its input files (missing files included), the keys of the stages
+        it depends on and its parameters (JSON serializable).
+        """
+        description = {
+            "stage": stage,
+            "files": [self.file_hash(path) for path in files],
+            "depends": list(depends),
+            "params": params,
+        }
+        return hashlib.sha1(
+            json.dumps(description, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def path(self, stage, key):
+        return os.path.join(self.cache_dir, stage, f"{key}.pkl")
+
+    def has(self, stage, key):
+        return os.path.exists(self.path(stage, key))
+
+    def load(self, stage, key):
+        with open(self.path(stage, key), "rb") as f:
+            return pickle.load(f)
+
+    def save(self, stage, key, value):
+        # Written atomically, so that an interrupted run never leaves a partial output behind
+        path = self.path(stage, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+
+
+def cached_stages(cache, keys, compute):
+    """
+    Outputs of several stages computed together, given as a dict mapping stage names to keys.
+    compute(stages) returns a dict of the outputs of the given stages, and is only called with the stages whose
+    outputs are not stored in cache (a StageCache), or with all of them if cache is None.
+    """
+    outputs = {}
+    missing = []
+    for stage, key in keys.items():
+        if cache is not None and cache.has(stage, key):
+            outputs[stage] = cache.load(stage, key)
+        else:
+            missing.append(stage)
+    if missing:
+        computed = compute(missing)
+        for stage in missing:
+            outputs[stage] = computed[stage]
+            if cache is not None:
+                cache.save(stage, keys[stage], computed[stage])
+    return {stage: outputs[stage] for stage in keys}
+
+
+def cached_stage(cache, stage, key, compute):
+    """Output of a stage, loaded from cache (a StageCache) if stored, or computed by compute() and stored."""
+    return cached_stages(cache, {stage: key}, lambda stages: {stage: compute()})[stage]
@@ -0,0 +1,75 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from alignment_store import ingest_alignment
+
+COLUMNS = ["query_id", "subject_id", "perc_identity", "bit_score"]
+
+
+def write_alignment(path, rng, n_hits=3000):
+    """Write a Diamond tabular alignment whose hits of each query are spread over the file."""
+    hits = pd.DataFrame(
+        {
+            "query_id": rng.choice([f"Q{i}" for i in range(200)], n_hits),
+            "subject_id": rng.choice([f"S{i}" for i in range(150)], n_hits),
+            "perc_identity": rng.integers(20, 100, n_hits).astype(float),
+            "bit_score": rng.integers(30, 60, n_hits).astype(float),  # Ties
+        }
+    )
+    columns = [
+        "query_id",
+        "subject_id",
+        "perc_identity",
+        "length",
+        "mismatch",
+        "gapopen",
+        "qstart",
+        "qend",
+        "sstart",
+        "send",
+        "evalue",
+        "bit_score",
+    ]
+    table = pd.DataFrame({c: hits[c] if c in hits else 1 for c in columns})
+    table.to_csv(path, sep="\t", header=False, index=False)
+    return hits
+
+
+def test_ungrouped_queries_sorted_by_chunks(tmp_path):
+    """
+    Ingesting an alignment whose queries are not grouped by small chunks gives the hits sorted by query and
+    decreasing bit score (ties in file order), truncated after sorting.
+    """
+    rng = np.random.default_rng(0)
+    alignment_file = str(tmp_path / "alignment.tsv")
+    hits = write_alignment(alignment_file, rng)
+    for max_hits in [None, 3]:
+        store = ingest_alignment(
+            alignment_file,
+            str(tmp_path / f"store_{max_hits}"),
+            chunk_size=250,
+            max_hits_per_query=max_hits,
+        )
+        frame = pd.DataFrame(
+            {
+                "query_id": store.proteins[store.query],
+                "subject_id": store.proteins[store.subject],
+                "perc_identity": store.perc_identity,
+                "bit_score": store.bit_score,
+            }
+        )
+        # Queries are numbered in order of first appearance
+        queries = hits["query_id"].unique()
+        expected = hits.assign(
+            order=pd.Categorical(hits["query_id"], categories=queries),
+            negative_bit_score=-hits["bit_score"],
+        ).sort_values(["order", "negative_bit_score"], kind="stable")
+        if max_hits is not None:
+            expected = expected.groupby("query_id", sort=False).head(max_hits)
+        assert np.array_equal(
+            frame[COLUMNS].to_numpy(), expected[COLUMNS].to_numpy()
+        ), max_hits
@@ -0,0 +1,121 @@
+import os
+import sys
+import subprocess
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from diamond_runner import run_alignment
+
+# Stub of the Diamond command-line interface: makedb copies the FASTA file, and blastp reports a hit of every
+# query on every other subject. Calls are logged to $STUB_LOG, and blastp fails for query files whose name
+# contains $STUB_FAIL.
+STUB = """
+import os
+import sys
+
+def read_fasta(path):
+    sequences = {}
+    with open(path) as f:
+        for line in f:
+            if line.startswith(">"):
+                current = line[1:].split()[0]
+                sequences[current] = ""
+            else:
+                sequences[current] += line.strip()
+    return sequences
+
+command, args = sys.argv[1], sys.argv[2:]
+option = {args[i]: args[i + 1] for i in range(len(args) - 1) if args[i].startswith("-")}
+with open(os.environ["STUB_LOG"], "a") as f:
+    f.write(f"{command} {option.get('--query', option.get('--in'))}\\n")
+if command == "makedb":
+    with open(option["--in"]) as f, open(option["-d"] + ".dmnd", "w") as out:
+        out.write(f.read())
+elif command == "blastp":
+    if os.environ.get("STUB_FAIL") and os.environ["STUB_FAIL"] in option["--query"]:
+        sys.exit(1)
+    subjects = read_fasta(option["--db"])
+    with open(option["--out"], "w") as out:
+        for query, sequence in read_fasta(option["--query"]).items():
+            for subject, subject_sequence in subjects.items():
+                if subject != query:
+                    bit_score = 100 - abs(len(sequence) - len(subject_sequence))
+                    out.write(f"{query}\\t{subject}\\t90.0\\t10\\t0\\t0\\t1\\t10\\t1\\t10\\t1e-10\\t{bit_score}\\n")
+"""
+
+
+@pytest.fixture
+def diamond(tmp_path, monkeypatch):
+    """Path of the stub Diamond executable, logging its calls."""
+    path = tmp_path / "diamond"
+    path.write_text(f"#!{sys.executable}\n{STUB}")
+    path.chmod(0o755)
+    monkeypatch.setenv("STUB_LOG", str(tmp_path / "calls.log"))
+    return str(path)
+
+
+def write_fasta(path, n_sequences):
+    with open(path, "w") as f:
+        for i in range(n_sequences):
+            f.write(f">P{i}\n{'M' * (10 + i)}\n")
+
+
+def calls(tmp_path):
+    """Stub calls since the last one, cleared."""
+    log = tmp_path / "calls.log"
+    lines = log.read_text().splitlines() if log.exists() else []
+    log.write_text("")
+    return [(line.split()[0], os.path.basename(line.split()[1])) for line in lines]
+
+
+def query_ids(alignment_file):
+    """IDs of the queries of an alignment file, in order of first appearance."""
+    with open(alignment_file) as f:
+        return list(dict.fromkeys(line.split("\t")[0] for line in f))
+
+
+def test_failed_shard_resumes(tmp_path, diamond, monkeypatch):
+    """A failed shard stops the run, and a rerun only aligns the remaining shards, merged in shard order."""
+    fasta_file = str(tmp_path / "sequences.fasta")
+    output_file = str(tmp_path / "alignment.tsv")
+    write_fasta(fasta_file, 12)
+    settings = dict(diamond=diamond, n_shards=4, jobs=1, threads=1, build_store=False)
+
+    monkeypatch.setenv("STUB_FAIL", "shard_0002")
+    with pytest.raises(subprocess.CalledProcessError):
+        run_alignment(fasta_file, output_file, **settings)
+    assert not os.path.exists(output_file)
+    assert ("makedb", "sequences.fasta") in calls(tmp_path)
+
+    monkeypatch.delenv("STUB_FAIL")
+    run_alignment(fasta_file, output_file, **settings)
+    assert calls(tmp_path) == [("blastp", "shard_0002.fasta")]
+    assert query_ids(output_file) == [f"P{i}" for i in range(12)]
+    shards = [
+        os.path.join(output_file + ".shards", f"shard_{i:04d}.tsv") for i in range(4)
+    ]
+    with open(output_file) as f:
+        merged = f.read()
+    assert merged == "".join(open(shard).read() for shard in shards)
+
+
+def test_changed_fasta_rebuilds(tmp_path, diamond):
+    """Changing the FASTA file rebuilds the database and realigns every shard."""
+    fasta_file = str(tmp_path / "sequences.fasta")
+    output_file = str(tmp_path / "alignment.tsv")
+    settings = dict(diamond=diamond, n_shards=3, jobs=2, threads=2, build_store=False)
+    write_fasta(fasta_file, 9)
+    run_alignment(fasta_file, output_file, **settings)
+    calls(tmp_path)
+    run_alignment(fasta_file, output_file, **settings)
+    assert calls(tmp_path) == []
+
+    write_fasta(fasta_file, 10)
+    run_alignment(fasta_file, output_file, **settings)
+    assert sorted(calls(tmp_path)) == [
+        ("blastp", f"shard_{i:04d}.fasta") for i in range(3)
+    ] + [("makedb", "sequences.fasta")]
+    assert query_ids(output_file) == [f"P{i}" for i in range(10)]
+    with open(output_file) as f:
+        assert any(line.split("\t")[1] == "P9" for line in f)
@@ -0,0 +1,141 @@
+import os
+import sys
+import pickle
+import logging
+import numpy as np
+import scipy.sparse as ssp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import evaluation
+import beprof_eval
+from predictions import SparsePredictions, open_prediction_writer
+
+N_TERMS = 12
+N_PROTEINS = 40
+
+
+def write_ontology(path):
+    """Write a small biological process ontology: a root and terms each child of the previous ones."""
+    with open(path, "w") as f:
+        f.write("format-version: 1.2\n\n")
+        f.write(
+            "[Term]\nid: GO:0008150\nname: biological_process\nnamespace: biological_process\n\n"
+        )
+        for i in range(N_TERMS):
+            parent = "GO:0008150" if i < 2 else f"GO:{10000 + i // 2:07d}"
+            f.write(
+                f"[Term]\nid: GO:{10000 + i:07d}\nname: t{i}\nnamespace: biological_process\n"
+                f"is_a: {parent} ! x\n\n"
+            )
+
+
+def evaluation_inputs(tmp_path, rng):
+    """Ontology, background and ground truth files of random annotations."""
+    go_obo_file = str(tmp_path / "go.obo")
+    write_ontology(go_obo_file)
+    terms = [f"GO:{10000 + i:07d}" for i in range(N_TERMS)]
+
+    def annotations(n, prefix):
+        return {
+            f"{prefix}{i}": {
+                "all_bp": set(rng.choice(terms, size=rng.integers(1, 5)).tolist()),
+                "all_cc": set(),
+                "all_mf": set(),
+            }
+            for i in range(n)
+        }
+
+    paths = []
+    for name, content in [
+        ("background.pkl", annotations(200, "B")),
+        ("gt.pkl", annotations(N_PROTEINS, "P")),
+    ]:
+        paths.append(str(tmp_path / name))
+        with open(paths[-1], "wb") as f:
+            pickle.dump(content, f)
+    return terms, paths[1], paths[0], go_obo_file
+
+
+def test_file_evaluation_matches_in_memory(tmp_path):
+    """
+    Evaluating exported prediction files (binary and TSV) gives the same metrics as evaluating predictions
+    in memory.
+    """
+    rng = np.random.default_rng(0)
+    terms, gt_pkl, background_pkl, go_obo_file = evaluation_inputs(tmp_path, rng)
+    matrix = ssp.random(N_PROTEINS, N_TERMS, density=0.4, random_state=1, format="csr")
+    # Scores just below the thresholds c/100, which single precision would round up to the thresholds
+    matrix.data = rng.integers(1, 100, size=len(matrix.data)) / 100 - 1e-9
+    predictions = SparsePredictions([f"P{i}" for i in range(N_PROTEINS)], terms, matrix)
+
+    methods = {"InMemory": predictions}
+    for method, extension in [("Binary", ".pfpb"), ("Text", ".tsv")]:
+        path = str(tmp_path / f"predictions{extension}")
+        with open_prediction_writer(path) as writer:
+            writer.write_predictions(predictions)
+        methods[method] = path
+
+    evaluation.evaluate_in_memory(
+        logging.getLogger("test"),
+        methods,
+        str(tmp_path),
+        "BPO",
+        gt_pkl,
+        background_pkl,
+        go_obo_file,
+    )
+    results = {
+        method: beprof_eval.read_pkl(
+            str(tmp_path / "evaluation" / method / "beprof_eval_results.pkl")
+        )
+        for method in methods
+    }
+    for method in ["Binary", "Text"]:
+        assert results[method].keys() == results["InMemory"].keys()
+        for key, value in results["InMemory"].items():
+            if key == "ontology":
+                continue
+            assert np.array_equal(
+                np.asarray(results[method][key]), np.asarray(value)
+            ), f"{method} {key}"
+
+
+def test_exact_curves_sparse_matches_dense():
+    """Exact curves of CSR scores, including predictions with a score of 0, match the ones of dense scores."""
+    rng = np.random.default_rng(0)
+    targets = (rng.random((30, 20)) < 0.3).astype(np.int8)
+    scores = np.round(rng.random((30, 20)), 1)  # Ties, and zero scores
+    scores[rng.random((30, 20)) < 0.5] = -1  # Unpredicted terms
+    goic, godp = rng.random(20), rng.random(20)
+
+    predicted = scores >= 0
+    sparse_scores = ssp.csr_matrix(
+        (scores[predicted], np.nonzero(predicted)), shape=scores.shape
+    )
+    assert sparse_scores.nnz == predicted.sum()  # Zero scores are stored
+    dense = beprof_eval.exact_curves(targets, scores, goic, godp)
+    sparse = beprof_eval.exact_curves(
+        ssp.csr_matrix(targets), sparse_scores, goic, godp
+    )
+    for key, values in dense.items():
+        assert np.array_equal(sparse[key], values), key
+
+
+def test_exact_curves_shared_matches_broadcast():
+    """Exact curves of scores shared by every protein match the ones of the protein x term product."""
+    rng = np.random.default_rng(0)
+    targets = (rng.random((30, 20)) < 0.3).astype(np.int8)
+    targets[0] = 0  # Protein without true terms
+    shared = np.round(rng.random(20), 1)
+    shared[rng.random(20) < 0.3] = -1
+    goic, godp = rng.random(20), rng.random(20)
+    goic[:2] = 0  # Predictions without IC
+
+    broadcast = beprof_eval.exact_curves(
+        targets, np.broadcast_to(shared, targets.shape), goic, godp
+    )
+    curves = beprof_eval.exact_curves(ssp.csr_matrix(targets), shared, goic, godp)
+    assert curves.keys() == broadcast.keys()
+    for key, values in broadcast.items():
+        assert np.allclose(curves[key], values, rtol=1e-12, atol=0), key
@@ -0,0 +1,96 @@
+import os
+import sys
+import logging
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import methods
+from alignment_store import AlignmentHits
+
+ASPECTS = ["BPO", "CCO", "MFO"]
+
+
+def synthetic_aspects(rng, n_proteins=80):
+    """
+    Random alignment hits (with tied bit scores) and per-aspect training and test sets, where some test proteins
+    of an aspect are also annotated in its training set (leakage).
+    """
+    proteins = np.array([f"P{i}" for i in range(n_proteins)], dtype=object)
+    n_hits = 1500
+    alignment = pd.DataFrame(
+        {
+            "query_id": rng.choice(proteins, n_hits),
+            "subject_id": rng.choice(proteins, n_hits),
+            "perc_identity": rng.integers(20, 100, n_hits).astype(float),
+            "bit_score": rng.integers(30, 60, n_hits).astype(float),
+        }
+    )
+    trains, tests = {}, {}
+    for i, aspect in enumerate(ASPECTS):
+        test = rng.choice(proteins, 20, replace=False)
+        annotated = rng.choice(proteins, 50, replace=False)
+        terms = [f"GO:{i}{j:05d}" for j in range(15)]
+        trains[aspect] = pd.DataFrame(
+            {
+                "EntryID": np.repeat(annotated, 3),
+                "term": rng.choice(terms, 3 * len(annotated)),
+            }
+        ).drop_duplicates()
+        tests[aspect] = pd.DataFrame({"EntryID": test})
+    return AlignmentHits.from_frame(alignment), trains, tests
+
+
+def dense(predictions):
+    return pd.DataFrame(
+        predictions.matrix.toarray(),
+        index=predictions.proteins,
+        columns=predictions.terms,
+    )
+
+
+def test_multi_aspect_matches_per_aspect():
+    """Scoring all aspects in one pass gives the same predictions as scoring each aspect separately."""
+    logger = logging.getLogger("test")
+    rng = np.random.default_rng(0)
+    alignment, trains, tests = synthetic_aspects(rng)
+    k_values = [1, 3]
+    pruning = {"BlastKNN": {"top_n": 4}}
+
+    multi = methods.multi_aspect_transfer_annotations(
+        logger,
+        alignment.restrict(
+            queries=pd.concat(tests.values())["EntryID"].unique(),
+            subjects=pd.concat(trains.values())["EntryID"].unique(),
+        ),
+        trains,
+        tests,
+        k_values,
+        pruning=pruning,
+    )
+    for aspect in ASPECTS:
+        unaligned, predictions = methods.transfer_annotations(
+            logger,
+            alignment.restrict(
+                queries=tests[aspect]["EntryID"].unique(),
+                subjects=trains[aspect]["EntryID"].unique(),
+            ),
+            trains[aspect],
+            tests[aspect],
+            k_values,
+            pruning=pruning,
+        )
+        multi_unaligned, multi_predictions = multi[aspect]
+        assert sorted(multi_unaligned) == sorted(unaligned)
+        assert multi_predictions.keys() == predictions.keys()
+        for method, method_predictions in predictions.items():
+            expected = dense(method_predictions)
+            actual = dense(multi_predictions[method]).reindex(
+                index=expected.index, columns=expected.columns
+            )
+            assert len(multi_predictions[method]) == len(method_predictions)
+            assert np.array_equal(actual.to_numpy(), expected.to_numpy()), (
+                aspect,
+                method,
+            )
@@ -0,0 +1,59 @@
+import os
+import sys
+import asyncio
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from service import AnnotationIndex, MicroBatcher
+
+
+def synthetic_requests(rng, subjects, n_requests=6):
+    """
+    Requests of random hits (with tied bit scores, unknown subjects and self-hits), some sharing query IDs,
+    one restricted to some methods.
+    """
+    requests = []
+    for i in range(n_requests):
+        queries = rng.choice([f"Q{j}" for j in range(8)] + list(subjects[:3]), 4)
+        n_hits = 40
+        hits = pd.DataFrame(
+            {
+                "query_id": rng.choice(queries, n_hits),
+                "subject_id": rng.choice(list(subjects) + ["UNKNOWN"], n_hits),
+                "perc_identity": rng.integers(20, 100, n_hits).astype(float),
+                "bit_score": rng.integers(30, 40, n_hits).astype(float),
+            }
+        )
+        requests.append({"hits": hits})
+    requests[1]["methods"] = ["BlastKNN_k3", "IDScore"]
+    return requests
+
+
+def test_micro_batcher_matches_single_requests():
+    """Requests scored together in one batch get the same responses as when scored alone."""
+    rng = np.random.default_rng(0)
+    subjects = np.array([f"S{i}" for i in range(30)], dtype=object)
+    terms = [f"GO:{i:07d}" for i in range(20)]
+    train = pd.DataFrame(
+        {
+            "EntryID": np.repeat(subjects, 3),
+            "term": rng.choice(terms, 3 * len(subjects)),
+        }
+    ).drop_duplicates()
+    index = AnnotationIndex(train, [1, 3])
+    requests = synthetic_requests(rng, subjects)
+    expected = [index.score([dict(request)])[0] for request in requests]
+
+    async def submit_all():
+        batcher = MicroBatcher(index, max_wait_ms=200)
+        responses = await asyncio.gather(
+            *(batcher.submit(dict(request)) for request in requests)
+        )
+        return responses, batcher.metrics()
+
+    responses, metrics = asyncio.run(submit_all())
+    assert responses == expected
+    assert metrics["batches"] == 1
+    assert metrics["requests"] == len(requests)